@@ -1 +1,4 @@
+import time
 
+# When the package began loading, for the startup report in web.start
+import_started = time.time()
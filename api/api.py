@@ -85,8 +85,10 @@ endpoints = [
 
         route('/download',                              Download, h='download',              m=['GET', 'POST']),
         route('/upload/<strategy:label|uid|uid-match>', Upload,   h='upload',                m=['POST']),
+        route('/upload/<strategy:label|uid|uid-match>/check', Upload, h='upload_check',      m=['POST']),
         route('/clean-packfiles',                       Upload,   h='clean_packfile_tokens', m=['POST']),
         route('/engine',                                Upload,   h='engine',                m=['POST']),
+        route('/engine/check',                          Upload,   h='engine_check',          m=['POST']),
 
 
         # Top-level endpoints
@@ -125,12 +127,15 @@ endpoints = [
         route( '/jobs',                    JobsHandler),
         prefix('/jobs', [
             route('/next',                 JobsHandler, h='next',       m=['GET']),
+            route('/lease',                JobsHandler, h='lease',      m=['POST']),
+            route('/events',               JobsHandler, h='events',     m=['GET']),
             route('/stats',                JobsHandler, h='stats',      m=['GET']),
             route('/reap',                 JobsHandler, h='reap_stale', m=['POST']),
             route('/add',                  JobsHandler, h='add',        m=['POST']),
             route('/<:[^/]+>',             JobHandler),
             route('/<:[^/]+>/config.json', JobHandler,  h='get_config'),
             route('/<:[^/]+>/retry',       JobHandler,  h='retry',      m=['POST']),
+            route('/<:[^/]+>/heartbeat',   JobHandler,  h='heartbeat',  m=['POST']),
         ]),
         route('/gears',                                  GearsHandler),
         prefix('/gears', [
@@ -234,6 +239,10 @@ endpoints = [
                 route('/packfile-start',                   FileListHandler, h='packfile_start', m=['POST']),
                 route('/packfile',                         FileListHandler, h='packfile',       m=['POST']),
                 route('/packfile-end',                     FileListHandler, h='packfile_end'),
+                route('/upload-start',                     FileListHandler, h='upload_start',   m=['POST']),
+                route('/upload-chunk',                     FileListHandler, h='upload_chunk',   m=['PUT']),
+                route('/upload-status',                    FileListHandler, h='upload_status',  m=['GET']),
+                route('/upload-end',                       FileListHandler, h='upload_end',     m=['POST']),
                 route('/<list_name:files>',                FileListHandler,                     m=['POST']),
                 route('/<list_name:files>/<name:{fname}>', FileListHandler,                     m=['GET', 'DELETE']),
 
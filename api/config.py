@@ -36,10 +36,22 @@ DEFAULT_CONFIG = {
         'registered': False,
         'ssl_cert': None
     },
+    'upload': {
+        'extra_hash_algs': None,                # comma-separated digests to compute besides sha384, e.g. 'crc32'
+        'threaded_hash_min_size': 134217728,    # hash uploads of at least this many bytes on a worker thread
+        'chunked_max_size': 1099511627776,      # largest file a chunked upload may declare; space is reserved up front
+    },
+    'download': {
+        'file_responder': 'python',             # python, file_wrapper, x-accel or x-sendfile
+        'x_accel_prefix': '/_data',             # nginx internal location aliased to the data path
+    },
     'queue': {
         'max_retries': 3,
         'retry_on_fail': False,
-        'prefetch': False
+        'prefetch': False,
+        'lease_seconds': 100,                   # running jobs without a heartbeat for this long are orphaned
+        'event_stream_seconds': 300,            # job event streams are closed after this long, for clients to reconnect
+        'event_streams_per_process': 1,         # job event streams each hold a thread; more are refused with a 503
     },
     'auth': {
         'auth_type': 'google',
@@ -82,6 +94,13 @@ __config = apply_env_variables(copy.deepcopy(DEFAULT_CONFIG))
 __config_persisted = False
 __last_update = datetime.datetime.utcfromtimestamp(0)
 
+# Incremented whenever the configuration changes, so that values derived from it can tell when to recompute
+__config_version = 0
+__listeners = []
+
+# How long the configuration is used before it is read again from the database
+REFRESH_INTERVAL = datetime.timedelta(seconds=120)
+
 if not os.path.exists(__config['persistent']['data_path']):
     os.makedirs(__config['persistent']['data_path'])
 
@@ -96,9 +115,10 @@ db = pymongo.MongoClient(
 ).get_default_database()
 log.debug(str(db))
 
+# Connects on first use, as the MongoClient does
 es = elasticsearch.Elasticsearch([__config['persistent']['elasticsearch_host']])
 
-# validate the lists of json schemas
+# json schemas, and the lists of them that check_schemas expects
 schema_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../raml/schemas')
 
 expected_mongo_schemas = set([
@@ -147,27 +167,20 @@ expected_input_schemas = set([
     'labelupload.json',
     'uidupload.json',
     'uidmatchupload.json',
+    'upload-reference.json',
+    'chunked-upload.json',
     'search.json'
 ])
-mongo_schemas = set()
-input_schemas = set()
-
-# check that the lists of schemas are correct
-for schema_filepath in glob.glob(schema_path + '/mongo/*.json'):
-    schema_file = os.path.basename(schema_filepath)
-    mongo_schemas.add(schema_file)
-    with open(schema_filepath, 'rU') as f:
-        pass
 
-assert mongo_schemas == expected_mongo_schemas, '{} is different from {}'.format(mongo_schemas, expected_mongo_schemas)
+def check_schemas():
+    """
+    Check that the lists of json schemas are correct. Called when the application is created rather than on import, to keep imports quick.
+    """
+    mongo_schemas = set(os.path.basename(path) for path in glob.glob(schema_path + '/mongo/*.json'))
+    assert mongo_schemas == expected_mongo_schemas, '{} is different from {}'.format(mongo_schemas, expected_mongo_schemas)
 
-for schema_filepath in glob.glob(schema_path + '/input/*.json'):
-    schema_file = os.path.basename(schema_filepath)
-    input_schemas.add(schema_file)
-    with open(schema_filepath, 'rU') as f:
-        pass
-
-assert input_schemas == expected_input_schemas, '{} is different from {}'.format(input_schemas, expected_input_schemas)
+    input_schemas = set(os.path.basename(path) for path in glob.glob(schema_path + '/input/*.json'))
+    assert input_schemas == expected_input_schemas, '{} is different from {}'.format(input_schemas, expected_input_schemas)
 
 def create_or_recreate_ttl_index(coll_name, index_name, ttl):
     if coll_name in db.collection_names():
@@ -198,11 +211,28 @@ def initialize_db():
     db.acquisitions.create_index('session')
     db.acquisitions.create_index('uid')
     db.acquisitions.create_index('collections')
+    # Containers a user has access to are found by their entry in the permissions list
+    db.projects.create_index([('permissions._id', 1), ('permissions.site', 1)])
+    db.sessions.create_index([('permissions._id', 1), ('permissions.site', 1)])
+    db.acquisitions.create_index([('permissions._id', 1), ('permissions.site', 1)])
+    db.collections.create_index([('permissions._id', 1), ('permissions.site', 1)])
+    db.groups.create_index([('roles._id', 1), ('roles.site', 1)])
     db.jobs.create_index([('inputs.id',1), ('inputs.type', 1)])
-    db.jobs.create_index([('state', 1),('now', 1), ('modified', 1)])
+    db.jobs.create_index([('inputs.id', 1), ('created', 1)])
+    # Must be kept in sync with jobs/queue.py DISPATCH_ORDER
+    db.jobs.create_index([('state', 1), ('now', -1), ('priority', -1), ('modified', 1)])
+    db.jobs.create_index('lease_id')
+    db.jobs.create_index([('state', 1), ('lease_expires', 1)])
+    db.jobs.create_index('previous_job_id', sparse=True)
     db.gears.create_index('name')
     db.batch.create_index('jobs')
 
+    # Must be kept in sync with jobs/events.py
+    if 'job_events' not in db.collection_names():
+        db.create_collection('job_events', capped=True, size=2**23)
+        # A tailable cursor on an empty collection dies at once; start followers with something to tail
+        db.job_events.insert_one({'state': None, 'timestamp': datetime.datetime.utcnow()})
+
     # Must be kept in sync with jobs/rules.py
     db.singletons.update({"_id" : "rules"}, {
             '$setOnInsert': {
@@ -220,8 +250,39 @@ def initialize_db():
     db.groups.update_one({'_id': 'unknown'}, {'$setOnInsert': { 'created': now, 'modified': now, 'name': 'Unknown', 'roles': []}}, upsert=True)
     db.sites.replace_one({'_id': __config['site']['id']}, {'name': __config['site']['name'], 'site_url': __config['site']['api_url']}, upsert=True)
 
+def add_listener(callback):
+    """
+    Call callback(config) whenever the configuration changes, such as when another process updates it in the database.
+    """
+    __listeners.append(callback)
+
+def get_config_version():
+    return __config_version
+
+def _set_config(new_config):
+    global __config, __config_version #pylint: disable=global-statement
+    if new_config == __config:
+        return
+    __config = new_config
+    __config_version += 1
+    for callback in __listeners:
+        try:
+            callback(__config)
+        except Exception: # pylint: disable=broad-except
+            log.error('Configuration listener failed', exc_info=True)
+
+def _merge_config(db_config):
+    # Precedence order for config is env vars -> db values -> default
+    merged = util.deep_update(copy.deepcopy(DEFAULT_CONFIG), db_config)
+    return apply_env_variables(merged)
+
 def get_config():
-    global __last_update, __config, __config_persisted #pylint: disable=global-statement
+    """
+    Return the configuration. Reads from the database happen only on first use and every REFRESH_INTERVAL;
+    otherwise this is a local lookup.
+    """
+
+    global __last_update, __config_persisted #pylint: disable=global-statement
     now = datetime.datetime.utcnow()
     if not __config_persisted:
         initialize_db()
@@ -229,24 +290,31 @@ def get_config():
 
         db_config = db.singletons.find_one({'_id': 'config'})
         if db_config is not None:
-            startup_config = copy.deepcopy(__config)
-            startup_config = util.deep_update(startup_config, db_config)
-            # Precedence order for config is env vars -> db values -> default
-            __config = apply_env_variables(startup_config)
+            startup_config = util.deep_update(copy.deepcopy(__config), db_config)
+            startup_config = apply_env_variables(startup_config)
         else:
-            __config['created'] = now
-        __config['modified'] = now
+            startup_config = copy.deepcopy(__config)
+            startup_config['created'] = now
+        startup_config['modified'] = now
 
-        db.singletons.replace_one({'_id': 'config'}, __config, upsert=True)
+        db.singletons.replace_one({'_id': 'config'}, startup_config, upsert=True)
+        _set_config(startup_config)
         __config_persisted = True
         __last_update = now
-    elif now - __last_update > datetime.timedelta(seconds=120):
+    elif now - __last_update > REFRESH_INTERVAL:
         log.debug('Refreshing configuration from database')
-        __config = db.singletons.find_one({'_id': 'config'})
         __last_update = now
-        log.setLevel(getattr(logging, __config['core']['log_level'].upper()))
+        db_config = db.singletons.find_one({'_id': 'config'})
+        if db_config is not None:
+            # Keys missing from a document persisted by an older release fall back to their defaults
+            _set_config(_merge_config(db_config))
     return __config
 
+def _set_log_level(config):
+    log.setLevel(getattr(logging, config['core']['log_level'].upper()))
+
+add_listener(_set_log_level)
+
 def get_public_config():
     return {
         'created': __config.get('created'),
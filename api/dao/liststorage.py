@@ -8,6 +8,7 @@ from . import APIStorageException, APIConflictException
 from .containerstorage import SessionStorage, AcquisitionStorage
 from .containerutil import create_filereference_from_dictionary, create_containerreference_from_dictionary, create_containerreference_from_filereference
 from ..jobs.jobs import Job
+from ..jobs.gears import get_gear_by_name
 
 log = config.log
 
@@ -291,7 +292,7 @@ class AnalysesStorage(ListStorage):
 
         destination = create_containerreference_from_dictionary({'type': 'analysis', 'id': analysis['_id']})
         job = Job(gear_name, inputs, destination=destination, tags=tags, config_=job.get('config'), origin=origin)
-        job_id = job.insert()
+        job_id = job.insert(gear=get_gear_by_name(gear_name))
         if not job_id:
             raise APIStorageException(500, 'Job not created for analysis {} of container {} {}'.format(analysis['_id'], cont_name, cid))
         result = self._update_el(cid, {'_id': analysis['_id']}, {'job': job_id}, None)
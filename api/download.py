@@ -1,12 +1,17 @@
 import bson
 import json
+import bisect
+import logging
 import pytz
 import os.path
 import tarfile
+import calendar
 import datetime
-import cStringIO
+import collections
+import multiprocessing.pool
 
 from .web import base
+from .web import fileresponse
 from . import config
 from . import util
 from . import validators
@@ -46,33 +51,293 @@ def _append_targets(targets, container, prefix, total_size, total_cnt, optional,
                 total_cnt += 1
     return total_size, total_cnt
 
+# Most container ids in a single $in query of a download preflight
+PREFLIGHT_QUERY_SIZE = 1000
+# Threads used to check that preflight files exist on disk
+PREFLIGHT_EXISTS_THREADS = 16
+
+def existing_paths(paths):
+    """
+    Return the set of the given paths that exist. On network storage each check is a round trip,
+    so many paths are checked concurrently.
+    """
+    paths = list(set(paths))
+    if len(paths) < 2:
+        return set(p for p in paths if os.path.exists(p))
+
+    pool = multiprocessing.pool.ThreadPool(min(PREFLIGHT_EXISTS_THREADS, len(paths)))
+    try:
+        exists = pool.map(os.path.exists, paths, chunksize=64)
+    finally:
+        pool.close()
+        pool.join()
+    return set(p for p, e in zip(paths, exists) if e)
+
+def _filter_query(filter_, prefix):
+    query = {}
+    for key, field in (('tags', 'tags'), ('types', 'type')):
+        property_filter = filter_.get(key, {})
+        condition = {}
+        if property_filter.get('+'):
+            condition['$in'] = property_filter['+']
+        if property_filter.get('-'):
+            condition['$nin'] = property_filter['-']
+        if condition:
+            query[prefix + field] = condition
+    return query
+
+def files_query(optional, filters, prefix='files.'):
+    """
+    Query selecting the same files as _append_targets does, for files found at prefix.
+    """
+    clauses = []
+    if not optional:
+        clauses.append({prefix + 'optional': {'$ne': True}})
+    if filters:
+        clauses.append({'$or': [_filter_query(filter_, prefix) for filter_ in filters]})
+    if len(clauses) > 1:
+        return {'$and': clauses}
+    return clauses[0] if clauses else {}
+
+def _container_files(collection, match, file_query, fields=()):
+    """
+    Stream one document per file of the matching containers, ordered by container,
+    with the given container fields and the file's name, hash and size under "files".
+    """
+    projection = {field: 1 for field in fields}
+    pipeline = [
+        {'$match': match},
+        {'$sort': {'_id': 1}},
+        {'$project': dict(projection, files=1)},
+        {'$unwind': '$files'},
+    ]
+    if file_query:
+        pipeline.append({'$match': file_query})
+    pipeline.append({'$project': dict(projection, **{'files.name': 1, 'files.hash': 1, 'files.size': 1})})
+    return collection.aggregate(pipeline, allowDiskUse=True)
+
 def symlinkarchivestream(ticket, data_path):
     for filepath, arcpath, _ in ticket['target']:
         t = tarfile.TarInfo(name=arcpath)
         t.type = tarfile.SYMTYPE
         t.linkname = os.path.relpath(filepath, data_path)
         yield t.tobuf()
-    stream = cStringIO.StringIO()
-    with tarfile.open(mode='w|', fileobj=stream) as _:
-        pass
-    yield stream.getvalue() # get tar stream trailer
-    stream.close()
-
-def archivestream(ticket):
-    BLOCKSIZE = 512
-    CHUNKSIZE = 2**20  # stream files in 1MB chunks
-    stream = cStringIO.StringIO()
-    with tarfile.open(mode='w|', fileobj=stream) as archive:
-        for filepath, arcpath, _ in ticket['target']:
-            yield archive.gettarinfo(filepath, arcpath).tobuf()
-            with open(filepath, 'rb') as fd:
-                chunk = ''
-                for chunk in iter(lambda: fd.read(CHUNKSIZE), ''): # pylint: disable=cell-var-from-loop
-                    yield chunk
-                if len(chunk) % BLOCKSIZE != 0:
-                    yield (BLOCKSIZE - (len(chunk) % BLOCKSIZE)) * b'\0'
-    yield stream.getvalue() # get tar stream trailer
-    stream.close()
+    yield TAR_TRAILER
+
+# Archive members are read with reads of this size, a multiple of the tar block size
+ARCHIVE_READ_SIZE = 2**22
+# Number of upcoming members opened and read ahead of the stream, on as many threads
+ARCHIVE_PREFETCH_FILES = 8
+# Most bytes held in memory by read-ahead at any one time
+ARCHIVE_PREFETCH_BUDGET = 2**26
+
+def tar_header(arcpath, size, mtime):
+    """
+    Build the tar header for an archive member from what the download ticket already knows,
+    rather than from a stat of the file and a lookup of its owner.
+    """
+    t = tarfile.TarInfo(name=arcpath)
+    t.size = size
+    t.mtime = mtime
+    t.mode = 0o644
+    return t.tobuf()
+
+def tar_padding(size):
+    """
+    Zero bytes that pad a member of this size out to a whole tar block.
+    """
+    remainder = size % tarfile.BLOCKSIZE
+    return (tarfile.BLOCKSIZE - remainder) * b'\0' if remainder else b''
+
+# The end-of-archive marker: two zero blocks, padded here to one whole record.
+# tarfile instead pads the whole archive to a multiple of the record size; readers only need the two blocks.
+TAR_TRAILER = b'\0' * tarfile.RECORDSIZE
+
+# Batch tickets stay valid for this long after their first download and each resumed request,
+# so that an interrupted download can be resumed
+ARCHIVE_RESUME_WINDOW = datetime.timedelta(hours=24)
+
+# Batch tickets are never extended past this long after they were made
+ARCHIVE_MAX_LIFETIME = datetime.timedelta(days=3)
+
+def archive_layout(targets, timestamp):
+    """
+    Work out the exact layout of the tar archive that archivestream produces for these targets:
+    the offset of each member, and the total size.
+
+    Stored on batch tickets, so that downloads report a Content-Length and can be resumed with a Range request.
+    """
+    mtime = calendar.timegm(timestamp.utctimetuple())
+    offsets = []
+    offset = 0
+    for _, arcpath, size in targets:
+        offsets.append(offset)
+        offset += len(tar_header(arcpath, size, mtime)) + size + len(tar_padding(size))
+    return {'mtime': mtime, 'offsets': offsets, 'size': offset + len(TAR_TRAILER)}
+
+def batch_ticket(ip, targets, filename, size, projects=None):
+    ticket = util.download_ticket(ip, 'batch', targets, filename, size, projects=projects)
+    ticket['archive'] = archive_layout(targets, ticket['timestamp'])
+    ticket['created'] = ticket['timestamp']
+    return ticket
+
+def resume_expiry(ticket, now):
+    """
+    When a batch ticket should expire, after a request resuming its download at time now.
+    """
+    # Tickets made before creation was recorded still carry it as the archive mtime
+    created = ticket.get('created') or datetime.datetime.utcfromtimestamp(ticket['archive']['mtime'])
+    return min(now + ARCHIVE_RESUME_WINDOW, created + ARCHIVE_MAX_LIFETIME)
+
+# One archive member, cut down to the part of it that falls in the requested range:
+# the slice of its header, the offset and length of the file data, and the slice of its padding
+ArchiveMember = collections.namedtuple('ArchiveMember', ['header', 'filepath', 'offset', 'length', 'padding'])
+
+def _overlap(data, offset, start, stop):
+    """
+    The part of data, found at offset in the archive, that falls within [start, stop).
+    """
+    return data[max(start - offset, 0):max(stop - offset, 0)]
+
+def _archive_members(targets, layout, start, stop):
+    offsets = layout['offsets']
+    first = max(bisect.bisect_right(offsets, start) - 1, 0)
+    for i in xrange(first, len(targets)):
+        member_start = offsets[i]
+        if member_start >= stop:
+            return
+        filepath, arcpath, size = targets[i]
+        header = tar_header(arcpath, size, layout['mtime'])
+        data_start = member_start + len(header)
+        data_end = data_start + size
+        lo, hi = max(start, data_start), min(stop, data_end)
+        yield ArchiveMember(
+            _overlap(header, member_start, start, stop),
+            filepath, lo - data_start, max(hi - lo, 0),
+            _overlap(tar_padding(size), data_end, start, stop))
+
+def _prefetch(filepath, offset, head_size):
+    """
+    Open an archive member and read head_size bytes from offset. Runs on a prefetch thread.
+    """
+    fd = open(filepath, 'rb')
+    try:
+        fd.seek(offset)
+        return fd, fd.read(head_size)
+    except Exception:
+        fd.close()
+        raise
+
+def _member_chunks(fd, head, length, filepath):
+    """
+    Yield exactly length bytes of an archive member, starting with its prefetched head.
+    """
+    yield head
+    remaining = length - len(head)
+    while remaining > 0:
+        chunk = fd.read(min(ARCHIVE_READ_SIZE, remaining))
+        if not chunk:
+            # The tar layout is fixed by the sizes on record; keep the archive readable
+            log.error('File {} is {} bytes shorter than recorded'.format(filepath, remaining))
+            chunk = remaining * b'\0'
+        remaining -= len(chunk)
+        yield chunk
+
+def archivestream(ticket, start=0, stop=None):
+    """
+    Stream a tar archive of the ticket's targets, or the [start, stop) byte range of it.
+
+    Upcoming members are opened and their leading bytes read on a pool of threads while the
+    current member streams, so that per-file latency is overlapped rather than paid in series.
+    Read-ahead is bounded both in files and in bytes.
+    """
+    layout = ticket.get('archive') or archive_layout(ticket['target'], ticket['timestamp'])
+    if stop is None:
+        stop = layout['size']
+    members = _archive_members(ticket['target'], layout, start, stop)
+
+    pool = multiprocessing.pool.ThreadPool(ARCHIVE_PREFETCH_FILES)
+    pending = collections.deque()   # (member, bytes reserved, async result) in archive order
+    waiting = None                  # next member, when it does not fit in the budget yet
+    budget = ARCHIVE_PREFETCH_BUDGET
+
+    try:
+        while True:
+            # Top up the read-ahead window, always keeping at least one member in flight
+            while len(pending) < ARCHIVE_PREFETCH_FILES:
+                if waiting is None:
+                    waiting = next(members, None)
+                    if waiting is None:
+                        break
+                head_size = min(waiting.length, ARCHIVE_READ_SIZE)
+                if pending and head_size > budget:
+                    break
+                budget -= head_size
+                result = None
+                if waiting.length:
+                    result = pool.apply_async(_prefetch, (waiting.filepath, waiting.offset, head_size))
+                pending.append((waiting, head_size, result))
+                waiting = None
+
+            if not pending:
+                break
+
+            member, head_size, result = pending.popleft()
+            budget += head_size
+
+            if member.header:
+                yield member.header
+            if result is not None:
+                fd, head = result.get()
+                try:
+                    for chunk in _member_chunks(fd, head, member.length, member.filepath):
+                        yield chunk
+                finally:
+                    fd.close()
+            if member.padding:
+                yield member.padding
+
+        trailer = _overlap(TAR_TRAILER, layout['size'] - len(TAR_TRAILER), start, stop)
+        if trailer:
+            yield trailer
+    finally:
+        # Also reached when the client goes away mid-stream: release the pool and any prefetched files
+        pool.close()
+        pool.join()
+        for _, _, result in pending:
+            if result is not None and result.successful():
+                result.get()[0].close()
+
+def send_archive(request, response, ticket):
+    """
+    Respond with the tar archive for a batch download ticket.
+
+    Tickets that record the archive layout get a Content-Length and Range support. The first download
+    and each Range request keep the ticket valid for ARCHIVE_RESUME_WINDOW, so that an interrupted download
+    can be resumed, up to ARCHIVE_MAX_LIFETIME after the ticket was made.
+    """
+    response.headers['Content-Disposition'] = 'attachment; filename=' + str(ticket['filename'])
+
+    layout = ticket.get('archive')
+    if layout is None:
+        response.app_iter = archivestream(ticket)
+        response.headers['Content-Type'] = 'application/octet-stream'
+        return
+
+    # The downloads TTL index expires tickets a minute past their timestamp.
+    # Only the first download and continuations extend a ticket, and never past its lifetime cap,
+    # so that it cannot be reused indefinitely to fetch the archive anew.
+    now = datetime.datetime.utcnow()
+    query = {'_id': ticket['_id']}
+    if 'Range' not in request.headers:
+        query['started'] = {'$exists': False}
+    config.db.downloads.update_one(query, {'$max': {'timestamp': resume_expiry(ticket, now)}, '$min': {'started': now}})
+
+    # Archive contents are fixed by the ticket, so the ticket id serves as an entity tag
+    etag = '"' + ticket['_id'] + '"'
+    response.headers['ETag'] = etag
+    ranges = fileresponse.requested_ranges(request, layout['size'], etag)
+    fileresponse.serve_ranges(response, layout['size'], ranges, lambda start, stop: archivestream(ticket, start, stop))
 
 class Download(base.RequestHandler):
 
@@ -83,6 +348,9 @@ class Download(base.RequestHandler):
         total_size = 0
         targets = []
 
+        # Group the requested files by container, so that each collection is queried with a few $in queries
+        refs = []
+        requested = collections.defaultdict(set)
         for fref in file_refs:
             cont_name   = fref.get('container_name','')+'s'
             cont_id     = fref.get('container_id', '')
@@ -90,33 +358,44 @@ class Download(base.RequestHandler):
 
             if cont_name not in ['projects', 'sessions', 'acquisitions']:
                 self.abort(400, 'Bulk download only supports files in projects, sessions and acquisitions')
-            file_obj = None
             try:
-                # Try to find the file reference in the database (filtering on user permissions)
                 bid = bson.ObjectId(cont_id)
-                query = {'_id': bid}
-                if not self.superuser_request:
-                    query['permissions._id'] = self.uid
-                file_obj = config.db[cont_name].find_one(
-                    query,
-                    {'files': { '$elemMatch': {
-                        'name': filename
-                    }}
-                })['files'][0]
             except Exception: # pylint: disable=broad-except
-                # self.abort(404, 'File {} on Container {} {} not found'.format(filename, cont_name, cont_id))
                 # silently skip missing files/files user does not have access to
                 continue
-
-            filepath = os.path.join(data_path, util.path_from_hash(file_obj['hash']))
-            if os.path.exists(filepath): # silently skip missing files
-                targets.append((filepath, cont_name+'/'+cont_id+'/'+file_obj['name'], file_obj['size']))
-                total_size += file_obj['size']
+            refs.append((cont_name, bid, cont_id, filename))
+            requested[cont_name].add(bid)
+
+        # Find the file references in the database (filtering on user permissions)
+        found = {}
+        for cont_name, ids in requested.iteritems():
+            ids = list(ids)
+            for i in xrange(0, len(ids), PREFLIGHT_QUERY_SIZE):
+                query = {'_id': {'$in': ids[i:i + PREFLIGHT_QUERY_SIZE]}}
+                if not self.superuser_request:
+                    query['permissions._id'] = self.uid
+                for container in config.db[cont_name].find(query, ['files.name', 'files.hash', 'files.size']):
+                    files_by_name = found.setdefault((cont_name, container['_id']), {})
+                    for f in container.get('files', []):
+                        files_by_name.setdefault(f.get('name'), f)
+
+        file_objs = []
+        for cont_name, bid, cont_id, filename in refs:
+            file_obj = found.get((cont_name, bid), {}).get(filename)
+            if file_obj is not None:
+                filepath = os.path.join(data_path, util.path_from_hash(file_obj['hash']))
+                file_objs.append((filepath, cont_name+'/'+cont_id+'/'+file_obj['name'], file_obj['size']))
+
+        existing = existing_paths(filepath for filepath, _, _ in file_objs)
+        for filepath, arcpath, size in file_objs:
+            if filepath in existing: # silently skip missing files
+                targets.append((filepath, arcpath, size))
+                total_size += size
                 file_cnt += 1
 
         if len(targets) > 0:
             filename = arc_prefix + '_ '+datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S') + '.tar'
-            ticket = util.download_ticket(self.request.client_addr, 'batch', targets, filename, total_size)
+            ticket = batch_ticket(self.request.client_addr, targets, filename, total_size)
             config.db.downloads.insert_one(ticket)
             return {'ticket': ticket['_id'], 'file_cnt': file_cnt, 'size': total_size}
         else:
@@ -149,37 +428,43 @@ class Download(base.RequestHandler):
                 prefix = '/'.join([arc_prefix, project['group'], project['label']])
                 total_size, file_cnt = _append_targets(targets, project, prefix, total_size, file_cnt, req_spec['optional'], data_path, req_spec.get('filters'))
 
-                sessions = config.db.sessions.find({'project': item_id}, ['label', 'files', 'uid', 'timestamp', 'timezone', 'subject'])
-                session_dict = {session['_id']: session for session in sessions}
-                acquisitions = config.db.acquisitions.find({'session': {'$in': session_dict.keys()}}, ['label', 'files', 'session', 'uid', 'timestamp', 'timezone'])
+                # One pass over slim session documents works out every subject and session path.
+                # Only the paths are kept, not the sessions.
                 session_prefixes = {}
-
-                subject_dict = {}
                 subject_prefixes = {}
-                for session in session_dict.itervalues():
-                    if session.get('subject'):
-                        code = session['subject'].get('code', 'unknown_subject')
+                sessions = config.db.sessions.find({'project': item_id}, ['label', 'uid', 'timestamp', 'timezone', 'subject']).sort('_id', 1)
+                for session in sessions:
+                    subject = session.get('subject') or {}
+                    code = subject.get('code', 'unknown_subject')
+                    if code not in subject_prefixes:
                         # This is bad and we should try to combine these somehow,
                         # or at least make sure we get all the files
-                        subject_dict[code] = session['subject']
-
-                for code, subject in subject_dict.iteritems():
-                    subject_prefix = prefix + '/' + self._path_from_container(subject, used_subpaths, project['_id'])
-                    subject_prefixes[code] = subject_prefix
-                    total_size, file_cnt = _append_targets(targets, subject, subject_prefix, total_size, file_cnt, req_spec['optional'], data_path, req_spec.get('filters'))
-
-                for session in session_dict.itervalues():
-                    subject_code = session['subject'].get('code', 'unknown_subject')
-                    subject = subject_dict[subject_code]
-                    session_prefix = subject_prefixes[subject_code] + '/' + self._path_from_container(session, used_subpaths, subject_code)
-                    session_prefixes[session['_id']] = session_prefix
-                    total_size, file_cnt = _append_targets(targets, session, session_prefix, total_size, file_cnt, req_spec['optional'], data_path, req_spec.get('filters'))
-
-                for acq in acquisitions:
-                    session = session_dict[acq['session']]
-                    acq_prefix = session_prefixes[session['_id']] + '/' + self._path_from_container(acq, used_subpaths, session['_id'])
-                    total_size, file_cnt = _append_targets(targets, acq, acq_prefix, total_size, file_cnt, req_spec['optional'], data_path, req_spec.get('filters'))
-
+                        subject_prefixes[code] = prefix + '/' + self._path_from_container(subject, used_subpaths, project['_id'])
+                        total_size, file_cnt = _append_targets(targets, subject, subject_prefixes[code], total_size, file_cnt, req_spec['optional'], data_path, req_spec.get('filters'))
+                    session_prefixes[session['_id']] = subject_prefixes[code] + '/' + self._path_from_container(session, used_subpaths, code)
+
+                # Session and acquisition files are filtered by the database and streamed back one file per document
+                file_query = files_query(req_spec['optional'], req_spec.get('filters'))
+                candidates = []
+                for doc in _container_files(config.db.sessions, {'project': item_id}, file_query):
+                    candidates.append((session_prefixes[doc['_id']], doc['files']))
+
+                acq_prefixes = {}
+                acq_match = {'session': {'$in': session_prefixes.keys()}}
+                for doc in _container_files(config.db.acquisitions, acq_match, file_query, ['label', 'session', 'uid', 'timestamp', 'timezone']):
+                    acq_prefix = acq_prefixes.get(doc['_id'])
+                    if acq_prefix is None:
+                        acq_prefix = session_prefixes[doc['session']] + '/' + self._path_from_container(doc, used_subpaths, doc['session'])
+                        acq_prefixes[doc['_id']] = acq_prefix
+                    candidates.append((acq_prefix, doc['files']))
+
+                candidates = [(os.path.join(data_path, util.path_from_hash(f['hash'])), prefix_ + '/' + f['name'], f['size']) for prefix_, f in candidates]
+                existing = existing_paths(filepath for filepath, _, _ in candidates)
+                for filepath, arcpath, size in candidates:
+                    if filepath in existing: # silently skip missing files
+                        targets.append((filepath, arcpath, size))
+                        total_size += size
+                        file_cnt += 1
 
             elif item['level'] == 'session':
                 session = config.db.sessions.find_one(base_query, ['project', 'label', 'files', 'uid', 'timestamp', 'timezone', 'subject'])
@@ -220,9 +505,10 @@ class Download(base.RequestHandler):
                 total_size, file_cnt = _append_targets(targets, acq, prefix, total_size, file_cnt, req_spec['optional'], data_path, req_spec.get('filters'))
 
         if len(targets) > 0:
-            log.debug(json.dumps(targets, sort_keys=True, indent=4, separators=(',', ': ')))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(json.dumps(targets, sort_keys=True, indent=4, separators=(',', ': ')))
             filename = arc_prefix + '_' + datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S') + '.tar'
-            ticket = util.download_ticket(self.request.client_addr, 'batch', targets, filename, total_size)
+            ticket = batch_ticket(self.request.client_addr, targets, filename, total_size)
             config.db.downloads.insert_one(ticket)
             return {'ticket': ticket['_id'], 'file_cnt': file_cnt, 'size': total_size}
         else:
@@ -270,12 +556,14 @@ class Download(base.RequestHandler):
                 self.abort(400, 'ticket not for this source IP')
             if self.get_param('symlinks'):
                 self.response.app_iter = symlinkarchivestream(ticket, config.get_item('persistent', 'data_path'))
+                self.response.headers['Content-Type'] = 'application/octet-stream'
+                self.response.headers['Content-Disposition'] = 'attachment; filename=' + str(ticket['filename'])
             else:
-                self.response.app_iter = archivestream(ticket)
-            self.response.headers['Content-Type'] = 'application/octet-stream'
-            self.response.headers['Content-Disposition'] = 'attachment; filename=' + str(ticket['filename'])
-            for project_id in ticket['projects']:
-                config.db.projects.update_one({'_id': project_id}, {'$inc': {'counter': 1}})
+                send_archive(self.request, self.response, ticket)
+            # Resumed downloads are not counted again
+            if 'Range' not in self.request.headers:
+                for project_id in ticket['projects']:
+                    config.db.projects.update_one({'_id': project_id}, {'$inc': {'counter': 1}})
         else:
             req_spec = self.request.json_body
 
@@ -1,21 +1,44 @@
 import os
 import cgi
 import json
+import zlib
+import errno
+import Queue
 import shutil
 import hashlib
+import threading
 import collections
 
 from . import util
 from . import config
 from . import tempdir as tempfile
 
+log = config.log
+
 DEFAULT_HASH_ALG='sha384'
 
+# Threaded hashing hands data to the worker in buffers of this size,
+# and at most this many buffers may be waiting to be hashed at once.
+HASH_BUFFER_SIZE = 2**20
+HASH_QUEUE_SIZE = 8
+
 def move_file(path, target_path):
-    target_dir = os.path.dirname(target_path)
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
-    shutil.move(path, target_path)
+    """
+    Move a file into place with a single rename.
+
+    The staging area lives under data_path, so this is an atomic rename on the same filesystem.
+    The target directory is only created when the first rename attempt reports it missing.
+    """
+    try:
+        os.rename(path, target_path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            util.mkdir_p(os.path.dirname(target_path))
+            os.rename(path, target_path)
+        elif e.errno == errno.EXDEV:
+            shutil.move(path, target_path)
+        else:
+            raise
 
 def move_form_file_field_into_cas(file_field):
     """
@@ -29,7 +52,66 @@ def move_form_file_field_into_cas(file_field):
 
     base   = config.get_item('persistent', 'data_path')
     cas    = util.path_from_hash(file_field.hash)
-    move_file(file_field.path, os.path.join(base, cas))
+    target = os.path.join(base, cas)
+
+    # Fields registered by reference already point into the CAS
+    if file_field.path != target:
+        move_file(file_field.path, target)
+
+def cas_lookup(hash_, size):
+    """
+    Return the on-disk path of a file already in the CAS, or None if the CAS does not hold it.
+
+    The size must match as well as the hash, so that a truncated or damaged CAS entry is never referenced.
+    """
+
+    base = config.get_item('persistent', 'data_path')
+    path = os.path.join(base, util.path_from_hash(hash_))
+
+    try:
+        if os.path.getsize(path) == size:
+            return path
+    except OSError:
+        pass
+    return None
+
+def write_chunk(path, offset, stream, length, buffer_size=2**20):
+    """
+    Write length bytes read from stream into an existing file at offset. Return the formatted hash of the chunk.
+
+    Each chunk is written through its own file handle, so chunks may be written to the same file concurrently.
+    """
+
+    hasher = hashlib.new(DEFAULT_HASH_ALG)
+    remaining = length
+
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        while remaining > 0:
+            data = stream.read(min(buffer_size, remaining))
+            if not data:
+                raise FileStoreException('chunk ended after {} of {} bytes'.format(length - remaining, length))
+            hasher.update(data)
+            f.write(data)
+            remaining -= len(data)
+
+    return util.format_hash(DEFAULT_HASH_ALG, hasher.hexdigest())
+
+def missing_ranges(chunks, size):
+    """
+    Given the chunks received so far, each a map with a start and (exclusive) end offset,
+    return the [start, end) byte ranges of a file of this size that no chunk covers yet.
+    """
+
+    missing = []
+    position = 0
+    for chunk in sorted(chunks, key=lambda c: c['start']):
+        if chunk['start'] > position:
+            missing.append([position, chunk['start']])
+        position = max(position, chunk['end'])
+    if position < size:
+        missing.append([position, size])
+    return missing
 
 def hash_file_formatted(path, hash_alg=None, buffer_size=65536):
     """
@@ -37,37 +119,188 @@ def hash_file_formatted(path, hash_alg=None, buffer_size=65536):
     """
 
     hash_alg = hash_alg or DEFAULT_HASH_ALG
-    hasher = hashlib.new(hash_alg)
+    return hash_file_formatted_many(path, [hash_alg], buffer_size=buffer_size)[hash_alg]
+
+def hash_file_formatted_many(path, hash_algs, buffer_size=65536):
+    """
+    Return a map of algorithm --> scitran-formatted hash of a file, reading the file only once.
+    """
+
+    hashers = [(hash_alg, new_hasher(hash_alg)) for hash_alg in hash_algs]
 
     with open(path, 'rb') as f:
         while True:
             data = f.read(buffer_size)
             if not data:
                 break
-            hasher.update(data)
+            for _, hasher in hashers:
+                hasher.update(data)
 
-    return util.format_hash(hash_alg, hasher.hexdigest())
+    return {hash_alg: util.format_hash(hash_alg, hasher.hexdigest()) for hash_alg, hasher in hashers}
+
+# The configured setting, and the valid digests parsed from it
+_extra_hash_algs = (None, [])
+
+def extra_hash_algs():
+    """
+    Return the configured list of digests to compute on upload in addition to DEFAULT_HASH_ALG.
+    Unknown names are dropped, and logged once each time the setting changes.
+    """
+
+    global _extra_hash_algs # pylint: disable=global-statement
+    setting = config.get_item('upload', 'extra_hash_algs') or ''
+    if setting == _extra_hash_algs[0]:
+        return _extra_hash_algs[1]
+
+    algs = []
+    for a in setting.split(','):
+        a = a.strip()
+        if not a or a == DEFAULT_HASH_ALG or a in algs:
+            continue
+        if a in hashlib.algorithms or a in Checksum.FUNCTIONS:
+            algs.append(a)
+        else:
+            log.error('Ignoring unknown digest %r in upload.extra_hash_algs', a)
+    _extra_hash_algs = (setting, algs)
+    return algs
+
+
+class Checksum(object):
+    """
+    A hashlib-like wrapper for the non-cryptographic checksums in zlib.
+    Much cheaper than a cryptographic digest, which makes them useful for quick dedup pre-checks.
+    """
+
+    FUNCTIONS = {
+        'adler32': zlib.adler32,
+        'crc32': zlib.crc32,
+    }
+
+    def __init__(self, name):
+        self.name = name
+        self.func = self.FUNCTIONS[name]
+        self.value = self.func('')
+
+    def update(self, data):
+        self.value = self.func(data, self.value)
+
+    def hexdigest(self):
+        return '%08x' % (self.value & 0xffffffff)
+
+def new_hasher(hash_alg):
+    if hash_alg in Checksum.FUNCTIONS:
+        return Checksum(hash_alg)
+    return hashlib.new(hash_alg)
+
+
+class HashWorker(object):
+    """
+    Feeds data to a set of hashers on a background thread.
+
+    Data is handed over through a bounded queue so that reading the next buffer off the network
+    overlaps with hashing the previous one. hashlib releases the GIL while hashing large buffers.
+    """
+
+    def __init__(self, hashers, queue_size=HASH_QUEUE_SIZE):
+        self.hashers = hashers
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.finished = False
+        self.thread = threading.Thread(target=self._run, name='hash-worker')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            for hasher in self.hashers:
+                hasher.update(data)
+
+    def update(self, data):
+        # Blocks while the queue is full, bounding memory use
+        self.queue.put(data)
+
+    def finish(self):
+        """
+        Wait for all queued data to be hashed and stop the worker. Safe to call more than once.
+        """
+        if not self.finished:
+            self.finished = True
+            self.queue.put(None)
+            self.thread.join()
 
 
 class FileStoreException(Exception):
     pass
 
 class HashingFile(file):
-    def __init__(self, file_path, hash_alg):
+    """
+    A writable file that hashes and sizes its contents as they are written.
+
+    Pass extra_hash_algs to compute several digests in the same pass.
+    Pass threaded=True to move hashing onto a HashWorker thread; worthwhile for large files.
+    """
+    def __init__(self, file_path, hash_alg, extra_hash_algs=None, threaded=False):
         super(HashingFile, self).__init__(file_path, "wb")
-        self.hash_alg = hashlib.new(hash_alg)
         self.hash_name = hash_alg
+        self.hash_names = [hash_alg] + [a for a in (extra_hash_algs or []) if a != hash_alg]
+        self.hashers = [new_hasher(a) for a in self.hash_names]
+        self.hash_alg = self.hashers[0]
+        self.size = 0
+
+        self.worker = HashWorker(self.hashers) if threaded else None
+        self.pending = []
+        self.pending_size = 0
 
     def write(self, data):
-        self.hash_alg.update(data)
+        self.size += len(data)
+        if self.worker is None:
+            for hasher in self.hashers:
+                hasher.update(data)
+        else:
+            # cgi.FieldStorage writes line by line; batch those up before handing them over
+            self.pending.append(data)
+            self.pending_size += len(data)
+            if self.pending_size >= HASH_BUFFER_SIZE:
+                self._flush_pending()
         return file.write(self, data)
 
+    def _flush_pending(self):
+        if self.pending:
+            self.worker.update(''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def _finish_hashing(self):
+        if self.worker is not None:
+            self._flush_pending()
+            self.worker.finish()
+
+    def close(self):
+        self._finish_hashing()
+        return file.close(self)
+
+    def __del__(self):
+        # Never leave a worker thread waiting on an abandoned file
+        if self.worker is not None and not self.worker.finished:
+            self.pending = []
+            self.worker.finish()
+
     def get_hash(self):
+        self._finish_hashing()
         return self.hash_alg.hexdigest()
 
     def get_formatted_hash(self):
         return util.format_hash(self.hash_name, self.get_hash())
 
+    def get_formatted_hashes(self):
+        """
+        Return a map of algorithm --> scitran-formatted hash for every digest computed.
+        """
+        self._finish_hashing()
+        return {name: util.format_hash(name, hasher.hexdigest()) for name, hasher in zip(self.hash_names, self.hashers)}
+
 ParsedFile = collections.namedtuple('ParsedFile', ['info', 'path'])
 
 def process_form(request, hash_alg=None):
@@ -83,6 +316,8 @@ def process_form(request, hash_alg=None):
     to a separate file on disk, as it comes in off the network stream from the client.
     Then we can rename these files to their final destination,
     without copying the data gain.
+    Each file is hashed and sized while it streams in (see HashingFile),
+    so the final rename into the CAS is the only filesystem operation left to do.
 
     Returns (tuple):
         form: HashingFieldStorage instance
@@ -102,8 +337,15 @@ def process_form(request, hash_alg=None):
     env.setdefault('CONTENT_LENGTH', '0')
     env['QUERY_STRING'] = ''
 
+    # Hash large uploads on a worker thread so hashing overlaps with reading from the network
+    try:
+        content_length = int(env['CONTENT_LENGTH'])
+    except ValueError:
+        content_length = 0
+    threaded = content_length >= int(config.get_item('upload', 'threaded_hash_min_size'))
+
     field_storage_class = getHashingFieldStorage(
-        tempdir.name, DEFAULT_HASH_ALG
+        tempdir.name, hash_alg, extra_hash_algs=extra_hash_algs(), threaded=threaded
         )
 
     form = field_storage_class(
@@ -112,7 +354,7 @@ def process_form(request, hash_alg=None):
 
     return (form, tempdir)
 
-def getHashingFieldStorage(upload_dir, hash_alg):
+def getHashingFieldStorage(upload_dir, hash_alg, extra_hash_algs=None, threaded=False):
     # pylint: disable=attribute-defined-outside-init
 
     # We dynamically create this class because we
@@ -131,7 +373,7 @@ def getHashingFieldStorage(upload_dir, hash_alg):
             self.filename = os.path.basename(self.filename)
             # self.filename = util.sanitize_string_to_filename(self.filename)
 
-            self.open_file = HashingFile(os.path.join(upload_dir, self.filename), hash_alg)
+            self.open_file = HashingFile(os.path.join(upload_dir, self.filename), hash_alg, extra_hash_algs=extra_hash_algs, threaded=threaded)
             return self.open_file
 
         # override private method __write of superclass FieldStorage
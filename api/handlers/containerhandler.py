@@ -184,43 +184,39 @@ class ContainerHandler(base.RequestHandler):
         analyses = cont.get('analyses', [])
         acquisitions = cont.get('acquisitions', [])
 
-        results = []
         if not acquisitions and not analyses:
             # no jobs
-            return {'jobs': results}
+            return {'jobs': []}
 
         # Get query params
         states      = self.request.GET.getall('states')
         tags        = self.request.GET.getall('tags')
         join_cont   = 'containers' in self.request.params.getall('join')
-
-        # search for jobs
-        if acquisitions:
-            id_array = [str(c['_id']) for c in acquisitions]
-            cont_array = [containerutil.ContainerReference('acquisition', cid) for cid in id_array]
-            results += Queue.search(cont_array, states=states, tags=tags)
-
-        if analyses:
-            id_array = [str(c['_id']) for c in analyses]
-            cont_array = [containerutil.ContainerReference('analysis', cid) for cid in id_array]
-            results += Queue.search(cont_array, states=states, tags=tags)
-
-        # Ensure job uniqueness
-        seen_jobs = []
-        jobs = []
-        for j in results:
-            if j['_id'] not in seen_jobs:
-                job  = Job.load(j)
-                jobs.append(job)
-                seen_jobs.append(job.id_)
-
-        jobs.sort(key=lambda j: j.created)
+        after       = self.request.GET.get('after')
+        limit       = self.request.GET.get('limit')
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                self.abort(400, 'limit must be an integer')
+            if limit < 1:
+                self.abort(400, 'limit must be positive')
+        if after is not None and not bson.ObjectId.is_valid(after):
+            self.abort(400, 'after must be a job id')
+
+        # search for jobs that use inputs from any of the session's acquisitions and analyses
+        cont_array = [containerutil.ContainerReference('acquisition', str(c['_id'])) for c in acquisitions]
+        cont_array += [containerutil.ContainerReference('analysis', str(c['_id'])) for c in analyses]
+        jobs = [Job.load(j) for j in Queue.search(cont_array, states=states, tags=tags, limit=limit, after=after)]
 
         response = {'jobs': jobs}
+        if limit is not None and len(jobs) == limit:
+            # Pass as after to get the next page
+            response['next'] = jobs[-1].id_
         if join_cont:
             # create a map of analyses and acquisitions by _id
             containers = dict((str(c['_id']), c) for c in analyses+acquisitions)
-            for c in containers:
+            for c in containers.itervalues():
                 # No need to return perm arrays
                 c.pop('permissions', None)
             response['containers'] = containers
@@ -5,12 +5,15 @@ import datetime
 import dateutil
 import json
 import uuid
+import webob
 import zipfile
 
 from ..web import base
+from ..web import fileresponse
 from .. import config
 from .. import upload
 from .. import download
+from .. import files
 from .. import util
 from .. import validators
 from ..auth import listauth, always_ok
@@ -19,6 +22,9 @@ from ..dao import liststorage
 from ..dao import APIStorageException
 from ..dao import hierarchy
 
+# A chunk write that has not finished after this long is presumed dead, and no longer holds up completing its upload
+CHUNK_WRITE_TIMEOUT = datetime.timedelta(hours=1)
+
 
 def initialize_list_configurations():
     """
@@ -450,13 +456,12 @@ class FileListHandler(ListHandler):
 
         # Authenticated or ticketed download request
         else:
-            self.response.app_iter = open(filepath, 'rb')
-            self.response.headers['Content-Length'] = str(fileinfo['size']) # must be set after setting app_iter
             if self.is_true('view'):
-                self.response.headers['Content-Type'] = str(fileinfo.get('mimetype', 'application/octet-stream'))
+                fileresponse.serve_file(self.request, self.response, filepath, fileinfo['size'], hash_=fileinfo['hash'],
+                    content_type=str(fileinfo.get('mimetype', 'application/octet-stream')))
             else:
-                self.response.headers['Content-Type'] = 'application/octet-stream'
-                self.response.headers['Content-Disposition'] = 'attachment; filename="' + filename + '"'
+                fileresponse.serve_file(self.request, self.response, filepath, fileinfo['size'], hash_=fileinfo['hash'],
+                    filename=filename)
 
     def post(self, cont_name, list_name, **kwargs):
         _id = kwargs.pop('cid')
@@ -576,6 +581,184 @@ class FileListHandler(ListHandler):
 
         return upload.process_upload(self.request, upload.Strategy.packfile, origin=self.origin, context={'token': token_id}, response=self.response, metadata=metadata)
 
+    def upload_start(self, cont_name, **kwargs):
+        """
+        Declare intent to upload a single file to a container in chunks, and receive an upload token identifier.
+
+        The JSON body gives the file name, its size, and optionally its hash and file metadata.
+        Chunks may then be sent to upload-chunk in any order, concurrently, and resent after a failure.
+        """
+
+        _id = kwargs.pop('cid')
+        cont_name_singular = cont_name[:-1] if cont_name.endswith('s') else cont_name
+        cont_name_plural = cont_name_singular + 's'
+
+        # Authorize
+        permchecker, _, _, _, _ = self._initialize_request(cont_name_plural, 'files', _id)
+        permchecker(noop)('POST', _id=_id)
+
+        payload = self.request.json_body
+        validators.validate_data(payload, 'chunked-upload.json', 'input', 'POST')
+        validators.validate_data(payload.get('metadata'), 'file.json', 'input', 'POST', optional=True)
+        if payload['size'] > int(config.get_item('upload', 'chunked_max_size')):
+            self.abort(413, 'File is larger than the maximum chunked upload size')
+
+        timestamp = datetime.datetime.utcnow()
+        token_id = str(uuid.uuid4())
+
+        # Reserve the whole file up front; chunks are written into it in place
+        path = upload.chunked_upload_path(token_id)
+        util.mkdir_p(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.truncate(payload['size'])
+
+        config.db['tokens'].insert_one({
+            '_id': token_id,
+            'type': 'chunked',
+            'user': self.uid,
+            'container_type': cont_name_singular,
+            'container_id': _id,
+            'name': payload['name'],
+            'size': payload['size'],
+            'hash': payload.get('hash'),
+            'metadata': payload.get('metadata'),
+            'chunks': [],
+            'created': timestamp,
+            'modified': timestamp,
+        })
+
+        return {
+            'token': token_id
+        }
+
+    def _chunked_token_query(self, _id, token_id):
+        if token_id is None:
+            self.abort(400, 'Upload token is required')
+
+        # Tokens cannot be used once finalizing has begun
+        return {
+            '_id': token_id,
+            'type': 'chunked',
+            'container_id': _id,
+            'user': self.uid,
+            'finalizing': {'$exists': False},
+        }
+
+    def _check_chunked_token(self, _id, token_id):
+        """
+        Check a chunked upload token, returning it.
+        """
+
+        token = config.db['tokens'].find_one(self._chunked_token_query(_id, token_id))
+        if token is None:
+            self.abort(404, 'Invalid or expired upload token')
+        return token
+
+    def upload_chunk(self, cont_name, **kwargs):
+        """
+        Write one chunk of a chunked upload. The request body is the chunk;
+        its position is given by a Content-Range header, e.g. ``bytes 0-1048575/20971520``.
+        """
+
+        _id = kwargs.pop('cid')
+        token_id = self.get_param('token')
+        token = self._check_chunked_token(_id, token_id)
+
+        content_range = webob.byterange.ContentRange.parse(self.request.headers.get('Content-Range'))
+        if content_range is None:
+            self.abort(400, 'Content-Range header is required')
+        if content_range.start is None:
+            # bytes */N asks about the file rather than sending a chunk of it
+            self.abort(400, 'Content-Range must give the byte range of the chunk')
+        if content_range.length is not None and content_range.length != token['size']:
+            self.abort(400, 'Content-Range length does not match the declared file size')
+        if content_range.stop > token['size']:
+            self.abort(400, 'Chunk extends past the end of the file')
+
+        length = content_range.stop - content_range.start
+        if self.request.content_length != length:
+            self.abort(400, 'Content-Length does not match Content-Range')
+
+        # Register as a writer, atomically with checking that finalizing has not begun;
+        # upload_end waits for registered writers, so that no write can land after the file is hashed and stored
+        writer = {'_id': str(bson.ObjectId()), 'started': datetime.datetime.utcnow()}
+        registered = config.db['tokens'].update_one(self._chunked_token_query(_id, token_id), {'$push': {'writers': writer}})
+        if registered.matched_count == 0:
+            self.abort(404, 'Invalid or expired upload token')
+
+        update = {'$pull': {'writers': {'_id': writer['_id']}}}
+        try:
+            chunk_hash = files.write_chunk(upload.chunked_upload_path(token_id), content_range.start, self.request.body_file, length)
+            chunk = {
+                'start': content_range.start,
+                'end': content_range.stop,
+                'hash': chunk_hash,
+            }
+            # Chunks are recorded only once fully written, so a dropped connection leaves its range missing
+            update['$push'] = {'chunks': chunk}
+            update['$set'] = {'modified': datetime.datetime.utcnow()}
+        finally:
+            config.db['tokens'].update_one({'_id': token_id}, update)
+
+        return chunk
+
+    def upload_status(self, cont_name, **kwargs):
+        """
+        Report the progress of a chunked upload, including the byte ranges that still need to be sent.
+        """
+
+        _id = kwargs.pop('cid')
+        token = self._check_chunked_token(_id, self.get_param('token'))
+
+        return {
+            'name': token['name'],
+            'size': token['size'],
+            'chunks': token['chunks'],
+            'missing': files.missing_ranges(token['chunks'], token['size']),
+        }
+
+    def upload_end(self, cont_name, **kwargs):
+        """
+        Complete a chunked upload, saving the assembled file to the container.
+        """
+
+        _id = kwargs.pop('cid')
+        token_id = self.get_param('token')
+        token = self._check_chunked_token(_id, token_id)
+
+        missing = files.missing_ranges(token['chunks'], token['size'])
+        if missing:
+            self.abort(400, 'Upload is incomplete; {} byte range(s) missing'.format(len(missing)))
+
+        # Claim the token so that chunk writes and concurrent completions are refused from here on.
+        # Only possible once no chunk is being written, short of writers presumed dead.
+        now = datetime.datetime.utcnow()
+        claimed = config.db['tokens'].find_one_and_update(
+            {
+                '_id': token_id,
+                'finalizing': {'$exists': False},
+                'writers': {'$not': {'$elemMatch': {'started': {'$gt': now - CHUNK_WRITE_TIMEOUT}}}},
+            },
+            {'$set': {'finalizing': True, 'modified': now}}
+        )
+        if claimed is None:
+            if config.db['tokens'].find_one({'_id': token_id, 'finalizing': {'$exists': False}}) is not None:
+                self.abort(409, 'Chunks are still being written; retry once they are done')
+            self.abort(409, 'Upload is already being completed')
+
+        path = upload.chunked_upload_path(token_id)
+        try:
+            result = upload.process_staged_upload(path, token['name'], upload.Strategy.targeted,
+                container_type=token['container_type'], id_=_id, origin=self.origin, metadata=token.get('metadata'),
+                expected_hash=token.get('hash'))
+        except Exception:
+            config.db['tokens'].update_one({'_id': token_id}, {'$unset': {'finalizing': ''}})
+            raise
+
+        config.db['tokens'].delete_one({'_id': token_id})
+        return result
+
+
 class AnalysesHandler(ListHandler):
 
     def _check_ticket(self, ticket_id, _id, filename):
@@ -755,7 +938,7 @@ class AnalysesHandler(ListHandler):
             else:
                 targets, total_size, file_cnt = self._prepare_batch(fileinfo)
                 filename = 'analysis_' + analysis_id + '.tar'
-                ticket = util.download_ticket(self.request.client_addr, 'batch', targets, filename, total_size)
+                ticket = download.batch_ticket(self.request.client_addr, targets, filename, total_size)
             return {
                 'ticket': config.db.downloads.insert_one(ticket).inserted_id,
                 'size': total_size,
@@ -774,13 +957,12 @@ class AnalysesHandler(ListHandler):
                 util.path_from_hash(fileinfo['hash'])
             )
             filename = fileinfo['name']
-            self.response.app_iter = open(filepath, 'rb')
-            self.response.headers['Content-Length'] = str(fileinfo['size']) # must be set after setting app_iter
             if self.is_true('view'):
-                self.response.headers['Content-Type'] = str(fileinfo.get('mimetype', 'application/octet-stream'))
+                fileresponse.serve_file(self.request, self.response, filepath, fileinfo['size'], hash_=fileinfo['hash'],
+                    content_type=str(fileinfo.get('mimetype', 'application/octet-stream')))
             else:
-                self.response.headers['Content-Type'] = 'application/octet-stream'
-                self.response.headers['Content-Disposition'] = 'attachment; filename=' + str(filename)
+                fileresponse.serve_file(self.request, self.response, filepath, fileinfo['size'], hash_=fileinfo['hash'],
+                    filename=str(filename))
 
     def _prepare_batch(self, fileinfo):
         ## duplicated code from download.py
@@ -797,9 +979,7 @@ class AnalysesHandler(ListHandler):
         return targets, total_size, total_cnt
 
     def _send_batch(self, ticket):
-        self.response.app_iter = download.archivestream(ticket)
-        self.response.headers['Content-Type'] = 'application/octet-stream'
-        self.response.headers['Content-Disposition'] = 'attachment; filename=' + str(ticket['filename'])
+        download.send_archive(self.request, self.response, ticket)
 
     def delete_note(self, cont_name, list_name, **kwargs):
         _id = kwargs.pop('cid')
@@ -3,6 +3,7 @@ import datetime
 import pymongo
 import os
 
+from ..web import authcache
 from ..web import base
 from .. import util
 from .. import config
@@ -156,10 +157,14 @@ class UserHandler(base.RequestHandler):
     def generate_api_key(self):
         if not self.uid:
             self.abort(400, 'no user is logged in')
+        old = self.storage.get_el(self.uid, projection=['api_key.key'])
         generated_key = base64.urlsafe_b64encode(os.urandom(42))
         now = datetime.datetime.utcnow()
         payload = {'api_key': {'key': generated_key, 'created': now, 'last_used': None}}
         result = self.storage.exec_op('PUT', _id=self.uid, payload=payload)
+        if old and old.get('api_key'):
+            # Other processes stop accepting the old key once their cached entries expire
+            authcache.revoke_api_key(old['api_key']['key'])
         if result.modified_count == 1:
             return {'key': generated_key}
         else:
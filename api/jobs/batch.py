@@ -64,10 +64,13 @@ def find_matching_conts(gear, containers, container_type):
     not_matched_conts = []
     ambiguous_conts = []
 
+    # Files alike across containers are only checked against the gear's inputs once
+    memo = {}
+
     for c in containers:
         files = c.get('files')
         if files:
-            suggestions = gears.suggest_for_files(gear, files)
+            suggestions = gears.suggest_for_files(gear, files, memo=memo)
 
             # Determine if any of the inputs are ambiguous or not satisfied
             ambiguous = False # Are any of the inputs ambiguous?
@@ -176,11 +179,14 @@ def run(batch_job):
                 inputs[input_name] = create_filereference_from_dictionary(fr)
             destination = create_containerreference_from_filereference(inputs[inputs.keys()[0]])
             job = Job(gear_name, inputs, destination=destination, tags=tags, config_=config_, origin=origin)
-            job_id = job.insert()
+            job_id = None # Inserted together below
 
         jobs.append(job)
         job_ids.append(job_id)
 
+    if gear.get('category') != 'analysis':
+        job_ids = Queue.enqueue(jobs)
+
     update(batch_job['_id'], {'state': 'launched', 'jobs': job_ids})
     return jobs
 
@@ -0,0 +1,139 @@
+"""
+Job state changes, published to a capped collection that engines and UIs can follow instead of polling.
+The job_events collection is created by config.initialize_db.
+"""
+
+import bson
+import datetime
+import pymongo
+import threading
+import time
+
+from .. import config
+
+# How long to wait between attempts to tail the collection, when there is nothing to tail yet
+RETRY_DELAY = 1
+
+# How long a follower may go without any output, before it is sent a keepalive
+KEEPALIVE_INTERVAL = 15
+
+# How long a client refused an event stream is asked to wait before trying again
+STREAM_RETRY_AFTER = 30
+
+
+# Event streams open in this process. Each holds a request thread for as long as it is open.
+_open_streams = 0
+_open_streams_lock = threading.Lock()
+
+
+# How long one event stream stays open; clients are expected to reconnect, resuming from their last event
+def stream_duration():
+    return int(config.get_item('queue', 'event_stream_seconds'))
+
+def open_stream():
+    """
+    Reserve a thread of this process for an event stream, returning False if too many streams are open already.
+    Every successful call must be paired with a call to close_stream.
+    """
+    global _open_streams
+    with _open_streams_lock:
+        if _open_streams >= int(config.get_item('queue', 'event_streams_per_process')):
+            return False
+        _open_streams += 1
+        return True
+
+def close_stream():
+    global _open_streams
+    with _open_streams_lock:
+        _open_streams -= 1
+
+def _publish(docs):
+    if not docs:
+        return
+    # Events are advisory, and must not slow down or fail the queue operation that publishes them
+    collection = config.db.job_events.with_options(write_concern=pymongo.WriteConcern(w=0))
+    collection.insert_many(docs, ordered=False)
+
+def _event(job, state, previous, now):
+    return {
+        'job': bson.ObjectId(job.id_),
+        'name': job.name,
+        'tags': job.tags,
+        'state': state,
+        'previous': previous,
+        'timestamp': now,
+    }
+
+def jobs_inserted(jobs):
+    now = datetime.datetime.utcnow()
+    _publish([_event(job, 'pending', None, now) for job in jobs])
+
+def state_changed(from_state, to_state, jobs):
+    if from_state != to_state:
+        now = datetime.datetime.utcnow()
+        _publish([_event(job, to_state, from_state, now) for job in jobs])
+
+def build_query(tags=None, states=None, job_ids=None):
+    """
+    Events of jobs with at least one of these tags, moving into one of these states, of one of these jobs.
+    """
+    query = {}
+    if tags:
+        query['tags'] = {'$in': tags}
+    if states:
+        query['state'] = {'$in': states}
+    if job_ids:
+        query['job'] = {'$in': job_ids}
+    return query
+
+def follow(query, after=None, duration=None):
+    """
+    Yield events matching query as they are published, for up to duration seconds.
+    Yields None after KEEPALIVE_INTERVAL without an event, so that the caller can keep its connection open.
+
+    ObjectIds made by different processes are only ordered to the second, so following resumes from the start
+    of the second of the last event seen: starting from event id after, the events of that second other than
+    after itself may be repeated, but none are missed while they remain in the collection.
+    Without after, following starts from the current second.
+    """
+
+    if duration is None:
+        duration = stream_duration()
+    deadline = time.time() + duration
+
+    last = after or bson.ObjectId()
+    seen = set([after]) if after else set()
+    idle_since = time.time()
+
+    while time.time() < deadline:
+        # Tailable cursors cannot use indexes; the filter is applied in the server's scan of the collection
+        resume = dict(query, _id={'$gte': bson.ObjectId.from_datetime(last.generation_time)})
+        cursor = config.db.job_events.find(resume, cursor_type=pymongo.CursorType.TAILABLE_AWAIT)
+
+        while cursor.alive and time.time() < deadline:
+            try:
+                doc = cursor.next()
+            except StopIteration:
+                # The server waited for new events and found none
+                if time.time() - idle_since >= KEEPALIVE_INTERVAL:
+                    idle_since = time.time()
+                    yield None
+                continue
+
+            # Skip repeats, and the placeholder the collection is created with
+            if doc['_id'] in seen or 'job' not in doc:
+                continue
+            if doc['_id'].generation_time != last.generation_time:
+                seen = set()
+            seen.add(doc['_id'])
+            last = doc['_id']
+            idle_since = time.time()
+            yield doc
+
+        cursor.close()
+        if time.time() < deadline:
+            # A tailable cursor dies if the collection is empty, or if it falls behind the capped collection's end
+            time.sleep(RETRY_DELAY)
+            if time.time() - idle_since >= KEEPALIVE_INTERVAL:
+                idle_since = time.time()
+                yield None
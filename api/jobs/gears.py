@@ -2,17 +2,42 @@
 Gears
 """
 
+import copy
+import json
+import re
+import time
+
 # import jsonschema
 from jsonschema import Draft4Validator, ValidationError
 import gear_tools
 
 from .. import config
+from .. import util
 from .jobs import Job
-from ..dao import APIValidationException
+from ..dao import APINotFoundException, APIValidationException
 from ..dao.containerstorage import ContainerStorage
 
 log = config.log
 
+# Gear documents are cached by name for this many seconds.
+# Changes made in this process drop the cached copy; changes made through another process show up once it expires.
+GEAR_CACHE_TTL = 60
+
+_gear_cache = {}
+
+# How many gear versions' input matchers stay compiled, across requests
+INPUT_MATCHER_CACHE_SIZE = 1000
+
+# Input matchers by gear id. Updating a gear replaces its document, so an id identifies one version of a gear.
+_input_matchers = util.LRUCache(INPUT_MATCHER_CACHE_SIZE)
+
+# How many file matches suggest_container remembers, across requests
+SUGGESTION_CACHE_SIZE = 100000
+
+# Matches of files against gear inputs, by gear version, input and the file attributes the input reads.
+# A file is only checked again once one of those attributes changes.
+_suggestions = util.LRUCache(SUGGESTION_CACHE_SIZE)
+
 def get_gears(fields=None):
     """
     Fetch the install-global gears from the database
@@ -32,62 +57,174 @@ def get_gears(fields=None):
 
 def get_gear_by_name(name):
 
+    cached = _gear_cache.get(name)
+    if cached is not None and cached[0] > time.time():
+        return copy.deepcopy(cached[1])
+
     # Find a gear from the list by name
     gear_doc = config.db.gears.find_one({'gear.name': name})
 
     if gear_doc is None:
-        raise Exception('Unknown gear ' + name)
+        raise APINotFoundException('Unknown gear ' + name)
 
-    return gear_doc
+    _gear_cache[name] = (time.time() + GEAR_CACHE_TTL, gear_doc)
+    return copy.deepcopy(gear_doc)
 
 def get_invocation_schema(gear):
     return gear_tools.derive_invocation_schema(gear['gear'])
 
+# JSON schema types, as Draft4Validator checks them
+_SCHEMA_TYPES = {
+    'string':   lambda v: isinstance(v, basestring),
+    'object':   lambda v: isinstance(v, dict),
+    'array':    lambda v: isinstance(v, list),
+    'boolean':  lambda v: isinstance(v, bool),
+    'null':     lambda v: v is None,
+    'integer':  lambda v: isinstance(v, (int, long)) and not isinstance(v, bool),
+    'number':   lambda v: isinstance(v, (int, long, float)) and not isinstance(v, bool),
+}
+
+# Schema keywords that compile_schema understands; schemas using any other are left to jsonschema
+_COMPILED_KEYWORDS = set(['type', 'enum', 'pattern', 'required', 'properties', 'items', 'description', 'title', '$schema'])
+
+def compile_schema(schema):
+    """
+    Compile a JSON schema made of common keywords into a predicate that agrees with Draft4Validator.is_valid.
+    Enums of strings become set lookups. Returns None if the schema uses anything else.
+    """
+
+    if not isinstance(schema, dict) or not set(schema) <= _COMPILED_KEYWORDS:
+        return None
+
+    checks = []
+
+    if 'type' in schema:
+        types = schema['type'] if isinstance(schema['type'], list) else [schema['type']]
+        if not all(t in _SCHEMA_TYPES for t in types):
+            return None
+        type_checks = [_SCHEMA_TYPES[t] for t in types]
+        checks.append(lambda v: any(check(v) for check in type_checks))
+
+    if 'enum' in schema:
+        if not all(isinstance(e, basestring) for e in schema['enum']):
+            return None
+        values = set(schema['enum'])
+        checks.append(lambda v: isinstance(v, basestring) and v in values)
+
+    if 'pattern' in schema:
+        regex = re.compile(schema['pattern'])
+        checks.append(lambda v: not isinstance(v, basestring) or regex.search(v) is not None)
+
+    if 'required' in schema:
+        required = list(schema['required'])
+        checks.append(lambda v: not isinstance(v, dict) or all(k in v for k in required))
+
+    if 'properties' in schema:
+        properties = {}
+        for k, subschema in schema['properties'].iteritems():
+            properties[k] = compile_schema(subschema)
+            if properties[k] is None:
+                return None
+        checks.append(lambda v: not isinstance(v, dict) or all(p(v[k]) for k, p in properties.iteritems() if k in v))
+
+    if 'items' in schema:
+        item = compile_schema(schema['items'])
+        if item is None:
+            return None
+        checks.append(lambda v: not isinstance(v, list) or all(item(x) for x in v))
+
+    return lambda v: all(check(v) for check in checks)
+
+class FileMatcher(object):
+    """
+    Decides whether files satisfy a gear input's file schema, as Draft4Validator(schema).is_valid would.
+
+    Common schemas are compiled with compile_schema; others are checked with jsonschema.
+    When given a memo, results are remembered by the file attributes the schema reads,
+    so that alike files (say, all dicoms, when only the type is constrained) are checked once.
+    A memo may be a dict or a util.LRUCache; cache_key keeps apart the results of different matchers in it.
+    """
+
+    def __init__(self, schema, cache_key=None):
+        self.cache_key = cache_key if cache_key is not None else id(self)
+        self._check = compile_schema(schema)
+        self.keys = None
+        if self._check is None:
+            self._check = Draft4Validator(schema).is_valid
+        elif set(schema) <= set(['type', 'required', 'properties', 'description', 'title', '$schema']):
+            self.keys = sorted(set(schema.get('properties', {})) | set(schema.get('required', [])))
+
+    def matches(self, file_, memo=None):
+        if memo is None or self.keys is None:
+            return self._check(file_)
+
+        # JSON keeps apart values that Python equality does not, such as true and 1
+        key = (self.cache_key, json.dumps({k: file_[k] for k in self.keys if k in file_}, sort_keys=True, default=str))
+        result = memo.get(key)
+        if result is None:
+            result = self._check(file_)
+            memo[key] = result
+        return result
+
+def get_input_matchers(gear):
+    """
+    Return a FileMatcher for each of the gear's inputs, compiled once per gear version.
+    """
+
+    key = gear.get('_id')
+    matchers = _input_matchers.get(key)
+    if matchers is None:
+        invocation_schema = get_invocation_schema(gear)
+        matchers = {}
+        for x in gear['gear']['inputs']:
+            cache_key = (key, x) if key is not None else None
+            matchers[x] = FileMatcher(gear_tools.isolate_file_invocation(invocation_schema, x), cache_key=cache_key)
+        if key is not None:
+            _input_matchers[key] = matchers
+    return matchers
+
 def suggest_container(gear, cont_name, cid):
     """
     Given a container reference, suggest files that would work well for each input on a gear.
     """
 
     root = ContainerStorage.factory(cont_name, True).get_container(cid, projection={'permissions':0}, get_children=True)
-    invocation_schema = get_invocation_schema(gear)
+    matchers = get_input_matchers(gear)
 
-    schemas = {}
-    for x in gear['gear']['inputs']:
-        schema = gear_tools.isolate_file_invocation(invocation_schema, x)
-        schemas[x] = Draft4Validator(schema)
+    # Results for a gear version hold across requests; without a version, only within this one
+    memo = _suggestions if gear.get('_id') is not None else {}
 
     # It would be nice to have use a visitor here instead of manual key loops.
     for acq in root.get('acquisitions', []):
         for f in acq.get('files', []):
             f['suggested'] = {}
-            for x in schemas:
-                f['suggested'][x] = schemas[x].is_valid(f)
+            for x in matchers:
+                f['suggested'][x] = matchers[x].matches(f, memo)
 
     for analysis in root.get('analyses',{}):
         files = analysis.get('files', [])
         files[:] = [x for x in files if x.get('output')]
         for f in files:
             f['suggested'] = {}
-            for x in schemas:
-                f['suggested'][x] = schemas[x].is_valid(f)
+            for x in matchers:
+                f['suggested'][x] = matchers[x].matches(f, memo)
         analysis['files'] = files
 
     return root
 
-def suggest_for_files(gear, files):
+def suggest_for_files(gear, files, memo=None):
+    """
+    Return the names of the files that suit each input on a gear.
+    Pass the same memo across calls for the same gear to check alike files once.
+    """
 
-    invocation_schema = get_invocation_schema(gear)
-    schemas = {}
-    for x in gear['gear']['inputs']:
-        schema = gear_tools.isolate_file_invocation(invocation_schema, x)
-        schemas[x] = Draft4Validator(schema)
+    matchers = get_input_matchers(gear)
 
     suggested_files = {}
-    log.debug(schemas)
-    for input_name, schema in schemas.iteritems():
+    for input_name, matcher in matchers.iteritems():
         suggested_files[input_name] = []
         for f in files:
-            if schema.is_valid(f):
+            if matcher.matches(f, memo):
                 suggested_files[input_name].append(f.get('name'))
 
     return suggested_files
@@ -120,6 +257,7 @@ def insert_gear(doc):
         del(doc["invocation-schema"])
 
     config.db.gears.insert(doc)
+    _gear_cache.pop(doc['gear']['name'], None)
 
     if config.get_item('queue', 'prefetch'):
         log.info('Queuing prefetch job for gear ' + doc['gear']['name'])
@@ -144,6 +282,7 @@ def insert_gear(doc):
 
 def remove_gear(name):
     config.db.gears.remove({'gear.name': name})
+    _gear_cache.pop(name, None)
 
 def upsert_gear(doc):
     gear_tools.validate_manifest(doc['gear'])
@@ -10,13 +10,44 @@ from ..auth import require_login, has_access
 from ..dao import APIPermissionException
 from ..dao.containerstorage import AcquisitionStorage
 from ..dao.containerutil import create_filereference_from_dictionary, create_containerreference_from_dictionary, create_containerreference_from_filereference, ContainerReference
-from ..web import base
+from ..web import base, encoder
 from .. import config
 from . import batch
+from . import events
 
 from .gears import validate_gear_config, get_gears, get_gear_by_name, get_invocation_schema, remove_gear, upsert_gear, suggest_container
 from .jobs import Job
-from .queue import Queue
+from .queue import Queue, MAX_LEASE, JOB_STATES
+
+
+def event_stream(query, after):
+    yield encoder.sse_pack({'retry': events.RETRY_DELAY * 1000})
+    for doc in events.follow(query, after=after):
+        if doc is None:
+            # A comment line, which clients ignore
+            yield ':\n\n'
+            continue
+        event_id = doc.pop('_id')
+        yield encoder.json_sse_pack({'id': event_id, 'event': 'job', 'data': doc})
+
+class EventStream(object):
+    """
+    A response body for an event stream that has been reserved with events.open_stream.
+    The reservation is released when the server closes the body, even if it was never iterated.
+    """
+
+    def __init__(self, query, after):
+        self._stream = event_stream(query, after)
+        self._open = True
+
+    def __iter__(self):
+        return self._stream
+
+    def close(self):
+        self._stream.close()
+        if self._open:
+            self._open = False
+            events.close_stream()
 
 
 class GearsHandler(base.RequestHandler):
@@ -149,6 +180,7 @@ class JobsHandler(base.RequestHandler):
         attempt_n       = submit.get('attempt_n', 1)
         previous_job_id = submit.get('previous_job_id', None)
         now_flag        = submit.get('now', False) # A flag to increase job priority
+        priority        = submit.get('priority', 0)
 
         # Add destination container, or select one
         destination = None
@@ -164,13 +196,14 @@ class JobsHandler(base.RequestHandler):
                 inputs[x].check_access(self.uid, 'ro')
             destination.check_access(self.uid, 'rw')
             now_flag = False # Only superuser requests are allowed to set "now" flag
+            priority = 0
 
         # Config manifest check
         gear = get_gear_by_name(gear_name)
         validate_gear_config(gear, config_)
 
-        job = Job(gear_name, inputs, destination=destination, tags=tags, config_=config_, now=now_flag, attempt=attempt_n, previous_job_id=previous_job_id, origin=self.origin)
-        result = job.insert()
+        job = Job(gear_name, inputs, destination=destination, tags=tags, config_=config_, now=now_flag, priority=priority, attempt=attempt_n, previous_job_id=previous_job_id, origin=self.origin)
+        result = job.insert(gear=gear)
 
         return { "_id": result }
 
@@ -195,6 +228,60 @@ class JobsHandler(base.RequestHandler):
         else:
             return job
 
+    def lease(self):
+        """Lease up to `limit` pending jobs in one request."""
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        tags = self.request.GET.getall('tags')
+        if len(tags) <= 0:
+            tags = None
+
+        try:
+            limit = int(self.request.GET.get('limit', 1))
+        except ValueError:
+            self.abort(400, 'limit must be an integer')
+        if not 1 <= limit <= MAX_LEASE:
+            self.abort(400, 'limit must be between 1 and {}'.format(MAX_LEASE))
+
+        return Queue.start_jobs(tags=tags, limit=limit)
+
+    def events(self):
+        """
+        Stream job state changes as Server-Sent Events.
+
+        Superuser only, since events are not filtered by the permissions of the containers jobs work on.
+        Each stream holds a request thread, so this only serves a few engines; everything else keeps polling.
+        """
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        states = self.request.GET.getall('states')
+        for state in states:
+            if state not in JOB_STATES:
+                self.abort(400, 'Unknown job state ' + state)
+        try:
+            job_ids = [bson.ObjectId(job_id) for job_id in self.request.GET.getall('jobs')]
+            # EventSource sends the id of the last event it received when it reconnects
+            after = self.request.headers.get('Last-Event-ID') or self.request.GET.get('after')
+            after = bson.ObjectId(after) if after else None
+        except bson.errors.InvalidId as e:
+            self.abort(400, str(e))
+
+        query = events.build_query(tags=self.request.GET.getall('tags'), states=states, job_ids=job_ids)
+
+        # Each stream holds a request thread, so that a few streams could otherwise starve the API
+        if not events.open_stream():
+            self.response.headers['Retry-After'] = str(events.STREAM_RETRY_AFTER)
+            self.abort(503, 'Too many job event streams are open; retry later')
+
+        self.response.headers['Content-Type'] = 'text/event-stream; charset=utf-8'
+        self.response.headers['Connection']   = 'keep-alive'
+        self.response.headers['Cache-Control'] = 'no-cache'
+        # Stop nginx from buffering the stream
+        self.response.headers['X-Accel-Buffering'] = 'no'
+        self.response.app_iter = EventStream(query, after)
+
     def reap_stale(self):
         if not self.superuser_request:
             self.abort(403, 'Request requires superuser')
@@ -247,6 +334,16 @@ class JobHandler(base.RequestHandler):
 
         Queue.mutate(j, mutation)
 
+    def heartbeat(self, _id):
+        """Extend the lease on a running job."""
+        if not self.superuser_request:
+            self.abort(403, 'Request requires superuser')
+
+        lease_expires = Queue.heartbeat(_id)
+        if lease_expires is None:
+            self.abort(400, 'Job is not running')
+        return {'lease_expires': lease_expires}
+
     def retry(self, _id):
         """ Retry a job.
 
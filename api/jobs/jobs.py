@@ -10,6 +10,8 @@ from ..types import Origin
 from ..dao.containerutil import create_filereference_from_dictionary, create_containerreference_from_dictionary, create_containerreference_from_filereference
 
 from .. import config
+from . import events
+from . import stats
 
 
 class Job(object):
@@ -17,7 +19,7 @@ class Job(object):
                  attempt=1, previous_job_id=None, created=None,
                  modified=None, state='pending', request=None,
                  id_=None, config_=None, now=False, origin=None,
-                 saved_files=None, produced_metadata=None):
+                 saved_files=None, produced_metadata=None, priority=0):
         """
         Creates a job.
 
@@ -46,6 +48,8 @@ class Job(object):
             The database identifier for this job.
         config: map (optional)
             The gear configuration for this job.
+        priority: integer (optional)
+            Jobs with a higher priority are dispatched first. Defaults to 0.
         """
 
         # TODO: validate inputs against the manifest
@@ -99,6 +103,7 @@ class Job(object):
         self.origin             = origin
         self.saved_files        = saved_files
         self.produced_metadata  = produced_metadata
+        self.priority           = priority
 
     @classmethod
     def load(cls, e):
@@ -134,7 +139,8 @@ class Job(object):
             now=d.get('now', False),
             origin=d.get('origin'),
             saved_files=d.get('saved_files'),
-            produced_metadata=d.get('produced_metadata'))
+            produced_metadata=d.get('produced_metadata'),
+            priority=d.get('priority', 0))
 
     @classmethod
     def get(cls, _id):
@@ -189,11 +195,37 @@ class Job(object):
 
         return d
 
-    def insert(self):
+    def insert_document(self, gear=None):
+        """
+        Assign the job an ID and return the document to insert for it.
+
+        Parameters
+        ----------
+        gear: map (optional)
+            The gear document for this job. If given, the job's request is generated now, so that
+            starting the job does not need to; otherwise it is generated when the job is started.
+        """
+
         if self.id_ is not None:
             raise Exception('Cannot insert job that has already been inserted')
 
-        result = config.db.jobs.insert_one(self.mongo())
+        # The request refers to the job's ID, so assign it up front
+        self.id_ = str(bson.ObjectId())
+        if gear is not None and self.request is None:
+            self.generate_request(gear)
+
+        doc = self.mongo()
+        doc['_id'] = doc.pop('id')
+        return doc
+
+    def insert(self, gear=None):
+        """
+        Insert the job, assigning it an ID. See insert_document.
+        """
+
+        result = config.db.jobs.insert_one(self.insert_document(gear=gear))
+        stats.jobs_inserted([self])
+        events.jobs_inserted([self])
         return result.inserted_id
 
     def save(self):
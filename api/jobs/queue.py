@@ -8,8 +8,11 @@ import pymongo
 import datetime
 
 from .. import config
+from ..dao import APINotFoundException
+from . import events
+from . import stats
 from .jobs import Job
-from .gears import get_gear_by_name
+from .gears import get_gear_by_name, validate_gear_config
 
 log = config.log
 
@@ -42,9 +45,39 @@ def max_attempts():
 def retry_on_explicit_fail():
     return config.get_item('queue', 'retry_on_fail')
 
+# How long a running job stays leased to its engine without a heartbeat, before it is considered orphaned
+def lease_duration():
+    return datetime.timedelta(seconds=int(config.get_item('queue', 'lease_seconds')))
+
 def valid_transition(from_state, to_state):
     return (from_state + ' --> ' + to_state) in JOB_TRANSITIONS or from_state == to_state
 
+# The order in which pending jobs are handed out.
+# Must be kept in sync with the jobs dispatch index in config.py
+DISPATCH_ORDER = [
+    ('now', pymongo.DESCENDING),
+    ('priority', pymongo.DESCENDING),
+    ('modified', pymongo.ASCENDING),
+]
+
+# The most jobs an engine can lease in one request
+MAX_LEASE = 100
+
+# How many orphaned jobs are failed and respawned at a time
+REAP_BATCH_SIZE = 500
+
+def _installed_gear(name, gears):
+    """
+    The gear of this name, or None if it is not installed, remembering the answer in gears.
+    """
+    if name not in gears:
+        try:
+            gears[name] = get_gear_by_name(name)
+        except APINotFoundException:
+            log.warning('Gear %s is not installed', name)
+            gears[name] = None
+    return gears[name]
+
 class Queue(object):
 
     @staticmethod
@@ -62,6 +95,10 @@ class Queue(object):
         # Any modification must be a timestamp update
         mutation['modified'] = datetime.datetime.utcnow()
 
+        # An update to a running job shows that its engine is alive
+        if mutation.get('state', job.state) == 'running':
+            mutation['lease_expires'] = mutation['modified'] + lease_duration()
+
         # Create an object with all the fields that must not have changed concurrently.
         job_query =  {
             '_id': bson.ObjectId(job.id_),
@@ -72,6 +109,13 @@ class Queue(object):
         if result.modified_count != 1:
             raise Exception('Job modification not saved')
 
+        if 'state' in mutation:
+            permafailed = int(mutation['state'] == 'failed' and job.attempt >= max_attempts())
+            stats.state_changed(job.state, mutation['state'], permafailed=permafailed)
+            events.state_changed(job.state, mutation['state'], [job])
+        if 'tags' in mutation:
+            stats.tags_changed(job.tags, mutation['tags'])
+
         # If the job did not succeed, check to see if job should be retried.
         if 'state' in mutation and mutation['state'] == 'failed' and retry_on_explicit_fail():
             job.state = 'failed'
@@ -99,117 +143,243 @@ class Queue(object):
             found = Job.load(check)
             raise Exception('Job ' + job.id_ + ' has already been retried as ' + str(found.id_))
 
-        new_job = copy.deepcopy(job)
-        new_job.id_ = None
-        new_job.previous_job_id = job.id_
+        return Queue._respawn([job])[0]
 
-        new_job.state = 'pending'
-        new_job.attempt += 1
+    @staticmethod
+    def retry_many(jobs):
+        """
+        Given failed jobs, retry those that have attempts left, as retry does, in bulk.
+        Jobs that have already been retried are skipped.
+
+        Returns the ids of the new jobs.
+        """
+
+        retryable = []
+        for job in jobs:
+            if job.state != 'failed':
+                raise Exception('Can only retry a job that is failed')
+            if job.attempt >= max_attempts():
+                log.info('Permanently failed job %s (after %d attempts)', job.id_, job.attempt)
+            else:
+                retryable.append(job)
+
+        if not retryable:
+            return []
+
+        # Best-hope check, as in retry
+        retried = config.db.jobs.find({'previous_job_id': {'$in': [job.id_ for job in retryable]}}, ['previous_job_id'])
+        retried = set(doc['previous_job_id'] for doc in retried)
+        for job_id in retried:
+            log.warning('Job %s has already been retried, not respawning', job_id)
+
+        return Queue._respawn([job for job in retryable if job.id_ not in retried])
+
+    @staticmethod
+    def _respawn(jobs):
+        """
+        Insert the next attempt of each job, and replace the failed jobs in any batch jobs lists.
+        A job whose gear has since been removed is still respawned, without a request.
+        """
+
+        if not jobs:
+            return []
 
         now = datetime.datetime.utcnow()
-        new_job.created = now
-        new_job.modified = now
+        new_jobs = []
+        for job in jobs:
+            new_job = copy.deepcopy(job)
+            new_job.id_ = None
+            new_job.previous_job_id = job.id_
+            # The request refers to the job's ID
+            new_job.request = None
+
+            new_job.state = 'pending'
+            new_job.attempt += 1
+
+            new_job.created = now
+            new_job.modified = now
+            new_jobs.append(new_job)
+
+        new_ids = Queue._insert(new_jobs, require_gears=False)
+
+        # If jobs are part of batch job runs, update the batch jobs lists
+        batch_updates = []
+        for job, new_job, new_id in zip(jobs, new_jobs, new_ids):
+            log.info('respawned job %s as %s (attempt %d)', job.id_, new_id, new_job.attempt)
+            batch_updates.append(pymongo.UpdateOne(
+                {'jobs': bson.ObjectId(job.id_)},
+                {'$set': {'jobs.$': new_id}}
+            ))
+        result = config.db.batch.bulk_write(batch_updates, ordered=False)
+        if result.modified_count > 0:
+            log.info('updated %d batch job lists', result.modified_count)
+
+        return new_ids
 
-        new_id = new_job.insert()
-        log.info('respawned job %s as %s (attempt %d)', job.id_, new_id, new_job.attempt)
+    @staticmethod
+    def enqueue(jobs):
+        """
+        Validate and insert many new jobs at once, generating their requests.
+        Each job's gear must exist, and its config, if any, must match the gear manifest.
+        Nothing is inserted unless all jobs are valid.
 
-        # If job is part of batch job run, update batch jobs list
-        result = config.db.batch.update_one(
-            {'jobs': job.id_},
-            {'$pull': {'jobs': job.id_}, '$push': {'jobs': new_id}}
-        )
-        if result.modified_count == 1:
-            log.info('updated batch job list, replacing {} with {}'.format(job.id_, new_id))
+        Returns the ids of the new jobs, in order.
+        """
+
+        # Jobs of a batch or rule usually share their gear and config; validate each pairing once
+        validated = {}
+        for job in jobs:
+            if job.id_ is not None:
+                raise Exception('Cannot insert job that has already been inserted')
+            configs = validated.setdefault(job.name, [])
+            if job.config is not None and job.config not in configs:
+                validate_gear_config(get_gear_by_name(job.name), job.config)
+                configs.append(job.config)
+
+        return Queue._insert(jobs)
 
-        return new_id
+    @staticmethod
+    def _insert(jobs, require_gears=True):
+        """
+        Insert jobs, generating their requests. Unless require_gears is set, jobs whose gear is not installed
+        are inserted without a request, as they were before requests were generated on insert.
+        """
+
+        if not jobs:
+            return []
+
+        gears = {}
+        docs = []
+        for job in jobs:
+            gear = get_gear_by_name(job.name) if require_gears else _installed_gear(job.name, gears)
+            docs.append(job.insert_document(gear=gear))
+
+        new_ids = config.db.jobs.insert_many(docs).inserted_ids
+        stats.jobs_inserted(jobs)
+        events.jobs_inserted(jobs)
+        return new_ids
 
     @staticmethod
     def start_job(tags=None):
         """
         Atomically change a 'pending' job to 'running' and returns it. Updates timestamp.
-        Will return None if there are no jobs to offer. Searches for jobs marked "now"
-        most recently first, followed by unmarked jobs in FIFO order if none are found.
+        Will return None if there are no jobs to offer.
 
         Potential jobs must match at least one tag, if provided.
         """
 
-        query = { 'state': 'pending', 'now': True }
+        jobs = Queue.start_jobs(tags=tags, limit=1)
+        return jobs[0] if jobs else None
+
+    @staticmethod
+    def start_jobs(tags=None, limit=1):
+        """
+        Lease up to limit 'pending' jobs, changing them to 'running', and return them with their requests.
 
+        Jobs are offered in DISPATCH_ORDER: jobs marked "now" first, then by descending priority, then in FIFO order.
+        Candidates are claimed together with a single update, stamped with a lease id; a candidate that another
+        engine claims first is skipped, and replaced from the queue.
+        Leases expire after lease_duration unless extended by a heartbeat or an update to the job.
+        Leased jobs whose gear has been removed since they were queued cannot be run; they are failed instead.
+
+        Potential jobs must match at least one tag, if provided.
+        """
+
+        query = {'state': 'pending'}
         if tags is not None:
-            query['tags'] = {'$in': tags }
-
-        # First look for jobs marked "now" sorted by modified most recently
-        # Mark as running if found
-        result = config.db.jobs.find_one_and_update(
-            query,
-
-            { '$set': {
-                'state': 'running',
-                'modified': datetime.datetime.utcnow()}
-            },
-            sort=[('modified', -1)],
-            return_document=pymongo.collection.ReturnDocument.AFTER
-        )
+            query['tags'] = {'$in': tags}
 
-        # If no jobs marked "now" are found, search again ordering by FIFO
-        if result is None:
-            query['now'] = {'$ne': True}
-            result = config.db.jobs.find_one_and_update(
-                query,
+        lease_id = bson.ObjectId()
+        claimed = 0
 
-                { '$set': {
+        while claimed < limit:
+            candidates = [doc['_id'] for doc in config.db.jobs.find(query, ['_id'], sort=DISPATCH_ORDER, limit=limit - claimed)]
+            if not candidates:
+                break
+
+            now = datetime.datetime.utcnow()
+            result = config.db.jobs.update_many(
+                {'_id': {'$in': candidates}, 'state': 'pending'},
+                {'$set': {
                     'state': 'running',
-                    'modified': datetime.datetime.utcnow()}
-                },
-                sort=[('modified', 1)],
-                return_document=pymongo.collection.ReturnDocument.AFTER
+                    'modified': now,
+                    'lease_id': lease_id,
+                    'lease_expires': now + lease_duration()}
+                }
             )
+            claimed += result.modified_count
 
-        if result is None:
-            return None
+        if claimed == 0:
+            return []
+        stats.state_changed('pending', 'running', n=claimed)
 
-        job = Job.load(result)
-
-        if job.request is not None:
-            log.info('Job ' + job.id_ + ' already has a request, so not generating')
-            print job.request
-            return result
-
-        # Generate, save, and return a job request.
-        request = job.generate_request(get_gear_by_name(job.name))
-        result = config.db.jobs.find_one_and_update(
-            {
-                '_id': bson.ObjectId(job.id_)
-            },
-            { '$set': {
-                'request': request }
-            },
-            return_document=pymongo.collection.ReturnDocument.AFTER
-        )
+        results = list(config.db.jobs.find({'lease_id': lease_id}, sort=DISPATCH_ORDER))
 
-        if result is None:
-            raise Exception('Marked job as running but could not generate and save formula')
+        # Requests are generated when jobs are inserted; fill in any that were inserted without one
+        gears = {}
+        requests = []
+        unrunnable = []
+        for result in results:
+            if result.get('request') is not None:
+                continue
+            job = Job.load(result)
+            gear = _installed_gear(job.name, gears)
+            if gear is None:
+                unrunnable.append(job)
+                continue
+            result['request'] = job.generate_request(gear)
+            requests.append(pymongo.UpdateOne({'_id': result['_id']}, {'$set': {'request': result['request']}}))
 
-        return result
+        if requests:
+            config.db.jobs.bulk_write(requests, ordered=False)
+
+        events.state_changed('pending', 'running', [Job.load(result) for result in results])
+
+        if unrunnable:
+            Queue._fail_unrunnable(unrunnable, lease_id)
+            failed = set(job.id_ for job in unrunnable)
+            results = [result for result in results if str(result['_id']) not in failed]
+
+        return results
+
+    @staticmethod
+    def _fail_unrunnable(jobs, lease_id):
+        """
+        Fail leased jobs that cannot be run, because their gear is not installed. They are not retried.
+        """
+
+        for job in jobs:
+            log.warning('Failed job %s: its gear %s is not installed', job.id_, job.name)
+        config.db.jobs.update_many(
+            {'_id': {'$in': [bson.ObjectId(job.id_) for job in jobs]}, 'lease_id': lease_id, 'state': 'running'},
+            {'$set': {'state': 'failed', 'modified': datetime.datetime.utcnow()}}
+        )
+        permafailed = len([job for job in jobs if job.attempt >= max_attempts()])
+        stats.state_changed('running', 'failed', n=len(jobs), permafailed=permafailed)
+        events.state_changed('running', 'failed', jobs)
 
     @staticmethod
-    def search(containers, states=None, tags=None):
+    def search(containers, states=None, tags=None, limit=None, after=None):
         """
         Search the queue for jobs that mention at least one of a set of containers and (optionally) match some set of states or tags.
-        Currently, all containers must be of the same type.
+        Containers may be of different types. Each job is found once, in order of creation.
 
         @param containers: an array of ContainerRefs
         @param states: an array of strings
         @param tags: an array of strings
+        @param limit: return at most this many jobs
+        @param after: a job id; only return jobs after this one, to fetch the next page of a search
         """
 
-        # Limitation: container types must match.
-        type1 = containers[0].type
+        ids_by_type = {}
         for container in containers:
-            if container.type != type1:
-                raise Exception('All containers passed to Queue.search must be of the same type')
+            ids_by_type.setdefault(container.type, []).append(container.id)
 
-        query = {'inputs.id': {'$in': [x.id for x in containers]}, 'inputs.type': type1}
+        # Match an input that is both of the type and one of the ids
+        query = {'$or': [
+            {'inputs': {'$elemMatch': {'type': type_, 'id': {'$in': ids}}}}
+            for type_, ids in ids_by_type.iteritems()
+        ]}
 
         if states is not None and len(states) > 0:
             query['state'] = {"$in": states}
@@ -217,65 +387,96 @@ class Queue(object):
         if tags is not None and len(tags) > 0:
             query['tags'] = {"$in": tags}
 
-        # For now, mandate reverse-crono sort
-        return config.db.jobs.find(query).sort([
-            ('modified', pymongo.DESCENDING)
+        if after is not None:
+            last = config.db.jobs.find_one({'_id': bson.ObjectId(after)}, ['created'])
+            if last is None:
+                raise APINotFoundException('Job {} not found'.format(after))
+            query = {'$and': [query, {'$or': [
+                {'created': {'$gt': last['created']}},
+                {'created': last['created'], '_id': {'$gt': last['_id']}},
+            ]}]}
+
+        cursor = config.db.jobs.find(query).sort([
+            ('created', pymongo.ASCENDING),
+            ('_id', pymongo.ASCENDING),
         ])
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return cursor
 
     @staticmethod
     def get_statistics():
         """
         Return a variety of interesting information about the job queue.
+        Counts are kept up to date as jobs change, and periodically recounted to correct any drift.
         """
 
-        # Count jobs by state
-        result = config.db.jobs.aggregate([{"$group": {"_id": "$state", "count": {"$sum": 1}}}])
-        # Map mongo result to a useful object
-        by_state = {s: 0 for s in JOB_STATES}
-        by_state.update({r['_id']: r['count'] for r in result})
+        doc = stats.get(max_attempts())
 
-        # Count jobs by tag grouping
-        result = list(config.db.jobs.aggregate([{"$group": {"_id": "$tags", "count": {"$sum": 1}}}]))
-        by_tag = []
-        for r in result:
-            by_tag.append({'tags': r['_id'], 'count': r['count']})
+        by_state = {s: 0 for s in JOB_STATES}
+        by_state.update(doc['by-state'])
 
-        # Count jobs that will not be retried
-        permafailed = config.db.jobs.count({"attempt": {"$gte": max_attempts()}, "state":"failed"})
+        by_tag = [{'tags': v['tags'], 'count': v['count']} for v in doc['by-tag'].itervalues() if v['count'] > 0]
 
         return {
             'by-state': by_state,
             'by-tag': by_tag,
-            'permafailed': permafailed
+            'permafailed': doc['permafailed']
         }
 
+    @staticmethod
+    def heartbeat(job_id):
+        """
+        Extend the lease on a running job, without otherwise touching it.
+        Returns the new expiry, or None if the job is not running.
+        """
+
+        lease_expires = datetime.datetime.utcnow() + lease_duration()
+        result = config.db.jobs.update_one(
+            {'_id': bson.ObjectId(job_id), 'state': 'running'},
+            {'$set': {'lease_expires': lease_expires}}
+        )
+        if result.matched_count != 1:
+            return None
+        return lease_expires
+
     @staticmethod
     def scan_for_orphans():
         """
         Scan the queue for orphaned jobs, mark them as failed, and possibly retry them.
         Should be called periodically.
+
+        A running job is orphaned once its lease expires. Jobs started before leases were recorded
+        are orphaned once they go a lease duration without modification.
+        Orphans are failed and respawned in batches of REAP_BATCH_SIZE.
         """
 
+        now = datetime.datetime.utcnow()
+        query = {
+            'state': 'running',
+            '$or': [
+                {'lease_expires': {'$lt': now}},
+                {'lease_expires': {'$exists': False}, 'modified': {'$lt': now - lease_duration()}},
+            ]
+        }
+
         orphaned = 0
 
         while True:
-            doc = config.db.jobs.find_one_and_update(
-                {
-                    'state': 'running',
-                    'modified': {'$lt': datetime.datetime.utcnow() - datetime.timedelta(seconds=100)},
-                },
-                {
-                    '$set': {
-                        'state': 'failed', },
-                },
-                return_document=pymongo.collection.ReturnDocument.AFTER
-            )
-
-            if doc is None:
+            candidates = [doc['_id'] for doc in config.db.jobs.find(query, ['_id'], limit=REAP_BATCH_SIZE)]
+            if not candidates:
                 break
-            else:
-                orphaned += 1
-                j = Job.load(doc)
-                Queue.retry(j)
+
+            # Repeat the expiry condition, so that a job whose lease was just extended is left alone
+            reap_id = bson.ObjectId()
+            claim = dict(query, _id={'$in': candidates})
+            config.db.jobs.update_many(claim, {'$set': {'state': 'failed', 'modified': now, 'reap_id': reap_id}})
+
+            jobs = [Job.load(doc) for doc in config.db.jobs.find({'_id': {'$in': candidates}, 'reap_id': reap_id})]
+            orphaned += len(jobs)
+            permafailed = len([job for job in jobs if job.attempt >= max_attempts()])
+            stats.state_changed('running', 'failed', n=len(jobs), permafailed=permafailed)
+            events.state_changed('running', 'failed', jobs)
+            Queue.retry_many(jobs)
 
         return orphaned
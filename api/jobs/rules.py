@@ -1,10 +1,14 @@
 import fnmatch
+import re
 
 from .. import config
+from .. import util
+from ..dao import APINotFoundException
 from ..dao.containerutil import FileReference
 
 from . import gears
 from .jobs import Job
+from .queue import Queue
 
 log = config.log
 
@@ -111,6 +115,13 @@ def queue_job_legacy(algorithm_id, input_):
     Takes a single FileReference instead of a map.
     """
 
+    return Queue.enqueue([legacy_job(algorithm_id, input_)])[0]
+
+def legacy_job(algorithm_id, input_):
+    """
+    Create, without inserting, a job for a gear of the no-manifest, single-file era.
+    """
+
     gear = gears.get_gear_by_name(algorithm_id)
 
     if len(gear['gear']['inputs']) != 1:
@@ -122,14 +133,106 @@ def queue_job_legacy(algorithm_id, input_):
         input_name: input_
     }
 
-    job = Job(algorithm_id, inputs)
-    return job.insert()
+    return Job(algorithm_id, inputs)
+
+def compile_match(match_type, match_param):
+    """
+    Given a match entry, return a predicate with the same result as eval_match.
+    The predicate takes the file, its container, and the container's file types (see file_types).
+    """
+
+    if match_type == 'file.type':
+        def match(file_, container, types):
+            try:
+                return file_['type'] == match_param
+            except KeyError:
+                _log_file_key_error(file_, container, 'has no type key')
+                return False
+
+    elif match_type == 'file.name':
+        pattern = re.compile(fnmatch.translate(match_param))
+        def match(file_, container, types):
+            return pattern.match(file_['name']) is not None
+
+    elif match_type == 'file.measurements':
+        def match(file_, container, types):
+            try:
+                return match_param in file_['measurements']
+            except KeyError:
+                _log_file_key_error(file_, container, 'has no measurements key')
+                return False
+
+    elif match_type == 'container.has-type':
+        def match(file_, container, types):
+            return match_param in types
+
+    else:
+        raise Exception('Unimplemented match type ' + match_type)
+
+    return match
+
+def compile_rule(rule):
+    """
+    Return a predicate with the same result as eval_rule, taking the arguments of a compile_match predicate.
+    """
+
+    any_ = [compile_match(m[0], m[1]) for m in rule.get('any', [])]
+    all_ = [compile_match(m[0], m[1]) for m in rule.get('all', [])]
+
+    def matches(file_, container, types):
+        if any_ and not any(m(file_, container, types) for m in any_):
+            return False
+        return all(m(file_, container, types) for m in all_)
+
+    return matches
+
+# How many projects' rules stay compiled, across uploads
+COMPILED_RULES_CACHE_SIZE = 1000
+
+# Compiled rules, keyed by project id, or None for the base rules: (rule list, [(rule, predicate)])
+# Entries are recompiled whenever the stored rules differ from the ones they were compiled from.
+_compiled_rules = util.LRUCache(COMPILED_RULES_CACHE_SIZE)
+
+def compiled_rules(key, rule_list):
+    cached = _compiled_rules.get(key)
+    if cached is None or cached[0] != rule_list:
+        cached = (rule_list, [(rule, compile_rule(rule)) for rule in rule_list])
+        _compiled_rules[key] = cached
+    return cached[1]
+
+def file_types(container):
+    """
+    Map each file type in a container to the name of its first file of that type.
+    Answers container.has-type matches, and finds the inputs of rules with a match map.
+    """
+
+    types = {}
+    for c_file in container.get('files', []):
+        if 'type' in c_file:
+            types.setdefault(c_file['type'], c_file['name'])
+    return types
+
+def rule_target(container, container_type, file_):
+    """
+    What rule evaluation needs to know of a file just saved to a container, without holding on to the whole container.
+    The container's file types are taken now, so that rules see the container as of this file, as create_jobs would.
+    """
+
+    slim = {k: container[k] for k in ('_id', 'session', 'project', 'rules') if k in container}
+    return (slim, container_type, file_, file_types(container))
 
-def find_type_in_container(container, type_):
-    for c_file in container['files']:
-        if type_ == c_file['type']:
-            return c_file
-    return None
+def _gear_installed(name, installed):
+    """
+    Whether the gear a rule names is installed, remembering the answer in installed.
+    """
+    if name not in installed:
+        try:
+            gears.get_gear_by_name(name)
+            installed[name] = True
+        except APINotFoundException:
+            log.warning('Not queueing jobs for gear %s: a rule names it, but it is not installed', name)
+            installed[name] = False
+    return installed[name]
 
 def create_jobs(db, container, container_type, file_):
     """
@@ -137,36 +240,57 @@ def create_jobs(db, container, container_type, file_):
     Returns the algorithm names that were queued.
     """
 
-    job_list = []
-
-    # Get configured rules for this project
-    rules = get_rules_for_container(db, container)
+    return create_jobs_for_files(db, [rule_target(container, container_type, file_)])
 
-    # Add hardcoded rules that cannot be removed or changed
-    for hardcoded_rule in get_base_rules():
-        rules.append(hardcoded_rule)
+def create_jobs_for_files(db, targets):
+    """
+    Check all rules that apply to each of a batch of saved files, and enqueue the jobs that should be run.
+    Targets are made with rule_target. Rules are looked up once per container, and compiled once per project;
+    the resulting jobs are inserted together. Rules naming a gear that has since been removed are skipped.
+    Returns the algorithm names that were queued.
+    """
 
-    for rule in rules:
-        if eval_rule(rule, file_, container):
+    job_list = []
+    jobs = []
+    installed = {}
+    if not targets:
+        return job_list
+
+    # Hardcoded rules that cannot be removed or changed
+    base_rules = compiled_rules(None, get_base_rules())
+    container_rules = {}
+
+    for container, container_type, file_, types in targets:
+
+        # Get configured rules for this project
+        if container['_id'] not in container_rules:
+            project = get_project_for_container(db, container)
+            project_rules = compiled_rules(project.get('_id'), project.get('rules', []))
+            container_rules[container['_id']] = project_rules + base_rules
+
+        for rule, matches in container_rules[container['_id']]:
+            if not matches(file_, container, types):
+                continue
             alg_name = rule['alg']
+            if not _gear_installed(alg_name, installed):
+                continue
 
             if rule.get('match') is None:
                 input_ = FileReference(type=container_type, id=str(container['_id']), name=file_['name'])
-                queue_job_legacy(alg_name, input_)
+                jobs.append(legacy_job(alg_name, input_))
             else:
                 inputs = { }
 
                 for input_name, match_type in rule['match'].iteritems():
-                    match = find_type_in_container(container, match_type)
-                    if match is None:
+                    if match_type not in types:
                         raise Exception("No type " + match_type + " found for alg rule " + alg_name + " that should have been satisfied")
-                    inputs[input_name] = FileReference(type=container_type, id=str(container['_id']), name=match['name'])
+                    inputs[input_name] = FileReference(type=container_type, id=str(container['_id']), name=types[match_type])
 
-                job = Job(alg_name, inputs)
-                job.insert()
+                jobs.append(Job(alg_name, inputs))
 
             job_list.append(alg_name)
 
+    Queue.enqueue(jobs)
     return job_list
 
 # TODO: consider moving to a module that has a variety of hierarchy-management helper functions
@@ -174,12 +298,18 @@ def get_rules_for_container(db, container):
     """
     Recursively walk the hierarchy until the project object is found.
     """
+    return get_project_for_container(db, container).get('rules', [])
+
+def get_project_for_container(db, container):
+    """
+    Walk up the hierarchy to the project, fetching only the fields needed on the way.
+    """
     if 'session' in container:
-        session = db.sessions.find_one({'_id': container['session']})
-        return get_rules_for_container(db, session)
+        session = db.sessions.find_one({'_id': container['session']}, ['project'])
+        return get_project_for_container(db, session)
     elif 'project' in container:
-        project = db.projects.find_one({'_id': container['project']})
-        return get_rules_for_container(db, project)
+        project = db.projects.find_one({'_id': container['project']}, ['rules'])
+        return get_project_for_container(db, project)
     else:
         # Assume container is a project, or a collection (which currently cannot have a rules property)
-        return container.get('rules', [])
+        return container
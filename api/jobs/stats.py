@@ -0,0 +1,113 @@
+"""
+Job queue statistics, counted as jobs are added and change state rather than aggregated on request.
+"""
+
+import datetime
+import hashlib
+
+from .. import config
+
+STATS_ID = 'job_stats'
+
+# Counters are recomputed from the jobs collection this often, to correct any drift
+RECONCILE_INTERVAL = datetime.timedelta(hours=1)
+
+
+def tags_key(tags):
+    """
+    Field name to count a set of tags under. Tags may contain characters that are not allowed in field names.
+    """
+    return hashlib.sha1('\0'.join(sorted(tags)).encode('utf-8')).hexdigest()
+
+def _record(states=None, tag_sets=None, permafailed=0):
+    """
+    Apply counter changes to the stats document.
+
+    states: map of state to change in its count
+    tag_sets: list of (tags, change in count) pairs
+    """
+
+    inc = {}
+    set_ = {}
+    for state, n in (states or {}).iteritems():
+        if n:
+            inc['by-state.' + state] = inc.get('by-state.' + state, 0) + n
+    for tags, n in tag_sets or []:
+        key = 'by-tag.' + tags_key(tags)
+        inc[key + '.count'] = inc.get(key + '.count', 0) + n
+        set_[key + '.tags'] = sorted(tags)
+    if permafailed:
+        inc['permafailed'] = permafailed
+
+    if not inc:
+        return
+    update = {'$inc': inc}
+    if set_:
+        update['$set'] = set_
+
+    # No upsert: until the document is first reconciled, there is nothing to keep up to date
+    config.db.singletons.update_one({'_id': STATS_ID}, update)
+
+def jobs_inserted(jobs):
+    _record(states={'pending': len(jobs)}, tag_sets=[(job.tags, 1) for job in jobs])
+
+def state_changed(from_state, to_state, n=1, permafailed=0):
+    """
+    Count n jobs moving between states, permafailed of which will not be retried.
+    """
+    if from_state != to_state:
+        _record(states={from_state: -n, to_state: n}, permafailed=permafailed)
+
+def tags_changed(old_tags, new_tags):
+    if tags_key(old_tags) != tags_key(new_tags):
+        _record(tag_sets=[(old_tags, -1), (new_tags, 1)])
+
+def reconcile(max_attempts):
+    """
+    Recount all statistics from the jobs collection, and store them.
+    Changes recorded while counting may be lost or doubled; the next reconciliation corrects them.
+    """
+
+    now = datetime.datetime.utcnow()
+
+    result = config.db.jobs.aggregate([{'$group': {'_id': '$state', 'count': {'$sum': 1}}}])
+    by_state = {r['_id']: r['count'] for r in result}
+
+    # The same tags in a different order are the same set
+    by_tag = {}
+    result = config.db.jobs.aggregate([{'$group': {'_id': '$tags', 'count': {'$sum': 1}}}], allowDiskUse=True)
+    for r in result:
+        tags = r['_id'] or []
+        entry = by_tag.setdefault(tags_key(tags), {'tags': sorted(tags), 'count': 0})
+        entry['count'] += r['count']
+
+    permafailed = config.db.jobs.count({'attempt': {'$gte': max_attempts}, 'state': 'failed'})
+
+    doc = {
+        '_id': STATS_ID,
+        'by-state': by_state,
+        'by-tag': by_tag,
+        'permafailed': permafailed,
+        'reconciled': now,
+    }
+    config.db.singletons.replace_one({'_id': STATS_ID}, doc, upsert=True)
+    return doc
+
+def get(max_attempts):
+    """
+    Return the stats document, reconciling it first if it is missing or due.
+    Only one process reconciles a due document; the others use the current counts meanwhile.
+    """
+
+    now = datetime.datetime.utcnow()
+    doc = config.db.singletons.find_one_and_update(
+        {'_id': STATS_ID, 'reconciled': {'$lt': now - RECONCILE_INTERVAL}},
+        {'$set': {'reconciled': now}}
+    )
+    if doc is not None:
+        return reconcile(max_attempts)
+
+    doc = config.db.singletons.find_one({'_id': STATS_ID})
+    if doc is None:
+        return reconcile(max_attempts)
+    return doc
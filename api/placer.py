@@ -44,6 +44,9 @@ class Placer(object):
         # A list of files that have been saved via save_file() usually returned by finalize()
         self.saved          = []
 
+        # Files saved via save_file() that rules have yet to be evaluated for; see queue_jobs()
+        self.rule_targets   = []
+
 
     def check(self):
         """
@@ -80,7 +83,7 @@ class Placer(object):
     def save_file(self, field=None, file_attrs=None):
         """
         Helper function that moves a file saved via a form field into our CAS.
-        May trigger jobs, if applicable, so this should only be called once we're ready for that.
+        May trigger jobs, if applicable, once queue_jobs() is called.
 
         Requires an augmented file field; see process_upload() for details.
         """
@@ -93,8 +96,16 @@ class Placer(object):
         if file_attrs is not None:
             self.container = hierarchy.upsert_fileinfo(self.container_type, self.id_, file_attrs)
 
-            # Queue any jobs as a result of this upload
-            rules.create_jobs(config.db, self.container, self.container_type, file_attrs)
+            # Jobs are queued for all files of the upload at once, by queue_jobs()
+            self.rule_targets.append(rules.rule_target(self.container, self.container_type, file_attrs))
+
+    def queue_jobs(self):
+        """
+        Queue any jobs as a result of the files saved so far.
+        Should be called once all of an upload's files are saved, so that rules are evaluated for them together.
+        """
+        rules.create_jobs_for_files(config.db, self.rule_targets)
+        self.rule_targets = []
 
     def recalc_session_compliance(self):
         if self.container_type in ['session', 'acquisition'] and self.id_:
@@ -105,6 +116,18 @@ class Placer(object):
             SessionStorage().recalc_session_compliance(session_id, hard=True)
 
 
+def merge_saved_files(saved_files, saved):
+    """
+    Add the names of newly saved files to a job's saved files list.
+    A job's outputs may be placed over more than one request, e.g. by reference first, then by upload.
+    """
+    names = list(saved_files or [])
+    for f in saved:
+        if f['name'] not in names:
+            names.append(f['name'])
+    return names
+
+
 class TargetedPlacer(Placer):
     """
     A placer that can accept N files to a specific container (acquisition, etc).
@@ -124,6 +147,7 @@ class TargetedPlacer(Placer):
         self.saved.append(file_attrs)
 
     def finalize(self):
+        self.queue_jobs()
         self.recalc_session_compliance()
         return self.saved
 
@@ -195,6 +219,7 @@ class UIDPlacer(Placer):
         self.saved.append(file_attrs)
 
     def finalize(self):
+        self.queue_jobs()
         if self.session_id:
             self.container_type = 'session'
             self.id_ = self.session_id
@@ -275,6 +300,7 @@ class EnginePlacer(Placer):
         self.saved.append(file_attrs)
 
     def finalize(self):
+        self.queue_jobs()
         if self.metadata is not None:
             bid = bson.ObjectId(self.id_)
 
@@ -291,7 +317,7 @@ class EnginePlacer(Placer):
 
         if self.context.get('job_id'):
             job = Job.get(self.context.get('job_id'))
-            job.saved_files = [f['name'] for f in self.saved]
+            job.saved_files = merge_saved_files(job.saved_files, self.saved)
             job.produced_metadata = self.metadata
             job.save()
 
@@ -480,11 +506,12 @@ class PackfilePlacer(Placer):
 
         # Create an anyonmous object in the style of our augmented file fields.
         # Not a great practice. See process_upload() for details.
+        hashes = files.hash_file_formatted_many(self.path, [files.DEFAULT_HASH_ALG] + files.extra_hash_algs())
         cgi_field = util.obj_from_map({
             'filename': self.name,
             'path':	 self.path,
             'size':	 os.path.getsize(self.path),
-            'hash':	 files.hash_file_formatted(self.path),
+            'hash':	 hashes[files.DEFAULT_HASH_ALG],
             'mimetype': util.guess_mimetype('lol.zip'),
             'modified': self.timestamp
         })
@@ -511,6 +538,9 @@ class PackfilePlacer(Placer):
             'origin': self.origin
         }
 
+        if len(hashes) > 1:
+            cgi_attrs['hashes'] = hashes
+
         # Get or create a session based on the hierarchy and provided labels.
         query = {
             'project': bson.ObjectId(self.p_id),
@@ -573,6 +603,7 @@ class PackfilePlacer(Placer):
         self.container	    = acquisition
 
         self.save_file(cgi_field, cgi_attrs)
+        self.queue_jobs()
 
         # Set target for session recalc
         self.container_type = 'session'
@@ -653,7 +684,7 @@ class AnalysisJobPlacer(Placer):
 
                 # Update the job with saved files list
                 job = Job.get(job_id)
-                job.saved_files = [f['name'] for f in self.saved]
+                job.saved_files = merge_saved_files(job.saved_files, self.saved)
                 job.save()
 
             config.db.sessions.update_one(q, u)
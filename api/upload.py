@@ -9,6 +9,7 @@ from . import config
 from . import files
 from . import placer as pl
 from . import util
+from . import validators
 from .dao import hierarchy
 
 log = config.log
@@ -54,14 +55,7 @@ def process_upload(request, strategy, container_type=None, id_=None, origin=None
         Creates a packfile from uploaded files |          |           |        |     X
     """
 
-    if not isinstance(strategy, Strategy):
-        raise Exception('Unknown upload strategy')
-
-    if id_ is not None and container_type == None:
-        raise Exception('Unspecified container type')
-
-    if container_type is not None and container_type not in ('acquisition', 'session', 'project', 'collection', 'analysis'):
-        raise Exception('Unknown container type')
+    check_target(strategy, container_type, id_)
 
     timestamp = datetime.datetime.utcnow()
 
@@ -101,31 +95,17 @@ def process_upload(request, strategy, container_type=None, id_=None, origin=None
         # Augment the cgi.FieldStorage with a variety of custom fields.
         # Not the best practice. Open to improvements.
         # These are presumbed to be required by every function later called with field as a parameter.
+        # Hash and size were computed while the file streamed in; no need to stat it again.
+        # Close the file so its contents are flushed before it is renamed into the CAS.
+        field.file.close()
         field.path	 = os.path.join(tempdir.name, field.filename)
-        field.size	 = os.path.getsize(field.path)
+        field.size	 = field.file.size
         field.hash	 = field.file.get_formatted_hash()
+        field.hashes   = field.file.get_formatted_hashes()
         field.mimetype = util.guess_mimetype(field.filename) # TODO: does not honor metadata's mime type if any
         field.modified = timestamp
 
-        # create a file-attribute map commonly used elsewhere in the codebase.
-        # Stands in for a dedicated object... for now.
-        file_attrs = {
-            'name':	 field.filename,
-            'modified': field.modified, #
-            'size':	 field.size,
-            'mimetype': field.mimetype,
-            'hash':	 field.hash,
-            'origin': origin,
-
-            'type': None,
-            'modality': None,
-            'measurements': [],
-            'tags': [],
-            'info': {}
-        }
-
-        file_attrs['type'] = files.guess_type_from_filename(file_attrs['name'])
-        placer.process_file_field(field, file_attrs)
+        placer.process_file_field(field, file_attrs_from_field(field, origin))
 
     # Respond either with Server-Sent Events or a standard json map
     if placer.sse and not response:
@@ -135,7 +115,154 @@ def process_upload(request, strategy, container_type=None, id_=None, origin=None
         response.headers['Connection']   = 'keep-alive'
         response.app_iter = placer.finalize()
     else:
-        return placer.finalize()
+        result = placer.finalize()
+        # Every placed file has been renamed out of the tempdir by now, so removing it is cheap.
+        # Do it here rather than waiting on garbage collection.
+        tempdir.cleanup()
+        return result
+
+
+def process_reference_upload(payload, strategy, container_type=None, id_=None, origin=None, context=None):
+    """
+    Pre-flight for process_upload: place any files the CAS already holds, without transferring them.
+
+    Format:
+        JSON payload listing the files to be uploaded, with the metadata that would accompany the upload.
+        {"metadata": {...}, "files": [{"name": "data.zip", "size": 1234, "hash": "v0-sha384-..."}]}
+
+    Files whose hash is in the CAS with a matching size are placed exactly as if they had been uploaded,
+    and reported as present if the placer saved them; a placer may skip files, as an upload would.
+    The files not in the CAS are reported as missing; send those through process_upload as usual, with the same metadata.
+
+    Placing a file by reference grants access to its contents, so callers must be trusted with every file
+    in the CAS: only drone and superuser requests may use this.
+    """
+
+    check_target(strategy, container_type, id_)
+    validators.validate_data(payload, 'upload-reference.json', 'input', 'POST')
+
+    timestamp = datetime.datetime.utcnow()
+
+    container = None
+    if container_type and id_:
+        container = hierarchy.get_container(container_type, id_)
+
+    placer_class = strategy.value
+    placer = placer_class(container_type, container, id_, payload.get('metadata'), timestamp, origin, context)
+    if placer.sse:
+        raise Exception('Upload strategy {} does not support references'.format(strategy.name))
+    placer.check()
+
+    present, missing = [], []
+    for file_ref in payload['files']:
+        saved = len(placer.saved)
+        path = files.cas_lookup(file_ref['hash'], file_ref['size'])
+        if path is None:
+            missing.append(file_ref['name'])
+            continue
+
+        # Same augmented fields as process_upload, pointing at the CAS entry instead of a tempdir
+        field = util.obj_from_map({
+            'filename': file_ref['name'],
+            'path':     path,
+            'size':     file_ref['size'],
+            'hash':     file_ref['hash'],
+            'hashes':   {files.DEFAULT_HASH_ALG: file_ref['hash']},
+            'mimetype': util.guess_mimetype(file_ref['name']),
+            'modified': timestamp
+        })
+        placer.process_file_field(field, file_attrs_from_field(field, origin))
+        if len(placer.saved) > saved:
+            present.append(file_ref['name'])
+
+    if present:
+        placer.finalize()
+
+    return {'present': present, 'missing': missing}
+
+def process_staged_upload(path, filename, strategy, container_type=None, id_=None, origin=None, context=None, metadata=None, expected_hash=None):
+    """
+    Place a single file that was assembled on disk outside of a form upload, such as a completed chunked upload.
+    The file is hashed here, then moved into the CAS by the placer exactly as a form upload would be.
+    If expected_hash is given, a file with a different hash is refused.
+    """
+
+    check_target(strategy, container_type, id_)
+
+    timestamp = datetime.datetime.utcnow()
+
+    container = None
+    if container_type and id_:
+        container = hierarchy.get_container(container_type, id_)
+
+    placer_class = strategy.value
+    placer = placer_class(container_type, container, id_, metadata, timestamp, origin, context)
+    if placer.sse:
+        raise Exception('Upload strategy {} does not support staged files'.format(strategy.name))
+    placer.check()
+
+    hashes = files.hash_file_formatted_many(path, [files.DEFAULT_HASH_ALG] + files.extra_hash_algs())
+    if expected_hash and hashes[files.DEFAULT_HASH_ALG] != expected_hash:
+        raise files.FileStoreException('Assembled file does not match the declared hash; check the chunk hashes and resend')
+    field = util.obj_from_map({
+        'filename': filename,
+        'path':     path,
+        'size':     os.path.getsize(path),
+        'hash':     hashes[files.DEFAULT_HASH_ALG],
+        'hashes':   hashes,
+        'mimetype': util.guess_mimetype(filename),
+        'modified': timestamp
+    })
+    placer.process_file_field(field, file_attrs_from_field(field, origin))
+
+    return placer.finalize()
+
+def chunked_upload_path(token_id):
+    """
+    Staging file that the chunks of a chunked upload are written into.
+    Ref FileListHandler.upload_start and upload.clean_packfile_tokens.
+    """
+    return os.path.join(config.get_item('persistent', 'data_path'), 'tokens', 'chunked', token_id)
+
+def check_target(strategy, container_type, id_):
+    if not isinstance(strategy, Strategy):
+        raise Exception('Unknown upload strategy')
+
+    if id_ is not None and container_type == None:
+        raise Exception('Unspecified container type')
+
+    if container_type is not None and container_type not in ('acquisition', 'session', 'project', 'collection', 'analysis'):
+        raise Exception('Unknown container type')
+
+def file_attrs_from_field(field, origin):
+    """
+    Create the file-attribute map commonly used elsewhere in the codebase.
+    Stands in for a dedicated object... for now.
+
+    Requires an augmented file field; see process_upload() for details.
+    """
+
+    file_attrs = {
+        'name':	 field.filename,
+        'modified': field.modified, #
+        'size':	 field.size,
+        'mimetype': field.mimetype,
+        'hash':	 field.hash,
+        'origin': origin,
+
+        'type': None,
+        'modality': None,
+        'measurements': [],
+        'tags': [],
+        'info': {}
+    }
+
+    # Only record the digest map when digests besides the CAS hash were requested
+    if len(field.hashes) > 1:
+        file_attrs['hashes'] = field.hashes
+
+    file_attrs['type'] = files.guess_type_from_filename(file_attrs['name'])
+    return file_attrs
 
 
 class Upload(base.RequestHandler):
@@ -143,6 +270,19 @@ class Upload(base.RequestHandler):
     def upload(self, strategy):
         """Receive a sortable reaper upload."""
 
+        strategy, context = self._upload_strategy(strategy)
+        return process_upload(self.request, strategy, origin=self.origin, context=context)
+
+    def upload_check(self, strategy):
+        """Place files of a sortable reaper upload that the CAS already holds; report which still need sending."""
+
+        # Naming a hash would otherwise give access to any file stored on the site, and reveal whether it is stored
+        if not self.superuser_request:
+            self.abort(403, 'Checking uploads against stored files requires a drone or superuser')
+        strategy, context = self._upload_strategy(strategy)
+        return process_reference_upload(self.request.json_body, strategy, origin=self.origin, context=context)
+
+    def _upload_strategy(self, strategy):
         if not self.superuser_request:
             user = self.uid
             if not user:
@@ -159,11 +299,21 @@ class Upload(base.RequestHandler):
             strategy = Strategy.uidmatch
         else:
             self.abort(500, 'stragegy {} not implemented'.format(strategy))
-        return process_upload(self.request, strategy, origin=self.origin, context=context)
+        return strategy, context
 
     def engine(self):
         """Handles file uploads from the engine"""
 
+        strategy, level, cid, context = self._engine_target()
+        return process_upload(self.request, strategy, container_type=level, id_=cid, origin=self.origin, context=context)
+
+    def engine_check(self):
+        """Place engine outputs that the CAS already holds; report which still need uploading"""
+
+        strategy, level, cid, context = self._engine_target()
+        return process_reference_upload(self.request.json_body, strategy, container_type=level, id_=cid, origin=self.origin, context=context)
+
+    def _engine_target(self):
         if not self.superuser_request:
             self.abort(402, 'uploads must be from an authorized drone')
         level = self.get_param('level')
@@ -178,13 +328,15 @@ class Upload(base.RequestHandler):
             cid = bson.ObjectId(cid)
         context = {'job_id': self.get_param('job')}
         if level == 'analysis':
-            return process_upload(self.request, Strategy.analysis_job, origin=self.origin, container_type=level, id_=cid, context=context)
+            return Strategy.analysis_job, level, cid, context
         else:
-            return process_upload(self.request, Strategy.engine, container_type=level, id_=cid, origin=self.origin, context=context)
+            return Strategy.engine, level, cid, context
 
     def clean_packfile_tokens(self):
         """Clean up expired upload tokens and invalid token directories.
         Ref placer.TokenPlacer and FileListHandler.packfile_start for context.
+
+        Also cleans up expired chunked uploads; ref FileListHandler.upload_start.
         """
 
         if not self.superuser_request:
@@ -192,14 +344,9 @@ class Upload(base.RequestHandler):
 
         # Race condition: we could delete tokens & directories that are currently processing.
         # For this reason, the modified timeout is long.
-        result = config.db['tokens'].delete_many({
-            'type': 'packfile',
-            'modified': {'$lt': datetime.datetime.utcnow() - datetime.timedelta(hours=1)},
-        })
-
-        removed = result.deleted_count
-        if removed > 0:
-            log.info('Removed ' + str(removed) + ' expired packfile tokens')
+        # Chunked uploads exist to survive unreliable links, so give them a much longer window to resume in.
+        removed = self._remove_expired_tokens('packfile', datetime.timedelta(hours=1))
+        removed_chunked = self._remove_expired_tokens('chunked', datetime.timedelta(hours=24))
 
         # Next, find token directories and remove any that don't map to a token.
 
@@ -210,8 +357,30 @@ class Upload(base.RequestHandler):
         #
         # It must be kept in sync between each instance.
         basepath = config.get_item('persistent', 'data_path')
-        folder = os.path.join(basepath, 'tokens', 'packfile')
+        cleaned = self._remove_orphaned_token_paths(os.path.join(basepath, 'tokens', 'packfile'), shutil.rmtree)
+        cleaned_chunked = self._remove_orphaned_token_paths(os.path.dirname(chunked_upload_path('')), os.remove)
+
+        return {
+            'removed': {
+                'tokens': removed,
+                'directories': cleaned,
+                'chunked_tokens': removed_chunked,
+                'chunked_files': cleaned_chunked,
+            }
+        }
 
+    def _remove_expired_tokens(self, token_type, timeout):
+        result = config.db['tokens'].delete_many({
+            'type': token_type,
+            'modified': {'$lt': datetime.datetime.utcnow() - timeout},
+        })
+
+        removed = result.deleted_count
+        if removed > 0:
+            log.info('Removed ' + str(removed) + ' expired ' + token_type + ' tokens')
+        return removed
+
+    def _remove_orphaned_token_paths(self, folder, remove):
         util.mkdir_p(folder)
         paths = os.listdir(folder)
         cleaned = 0
@@ -229,13 +398,8 @@ class Upload(base.RequestHandler):
                 pass
 
             if result is None:
-                log.info('Cleaning expired token directory ' + token)
-                shutil.rmtree(path)
+                log.info('Cleaning expired token path ' + token)
+                remove(path)
                 cleaned += 1
 
-        return {
-            'removed': {
-                'tokens': removed,
-                'directories': cleaned,
-            }
-        }
+        return cleaned
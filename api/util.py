@@ -1,9 +1,11 @@
+import collections
 import datetime
 import enum as baseEnum
 import errno
 import json
 import mimetypes
 import os
+import threading
 import uuid
 import requests
 import hashlib
@@ -204,3 +206,36 @@ def mkdir_p(path):
             pass
         else:
             raise
+
+class LRUCache(object):
+    """
+    A mapping that holds at most size entries, evicting the least recently used. Safe to share between threads.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def __len__(self):
+        return len(self._entries)
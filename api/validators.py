@@ -2,6 +2,7 @@ import copy
 import json
 import jsonschema
 import os
+import threading
 
 from . import config
 
@@ -30,12 +31,58 @@ def validate_data(data, schema_json, schema_type, verb, optional=False):
 def _validate_json(json_data, schema, resolver):
     jsonschema.validate(json_data, schema, resolver=resolver, format_checker=jsonschema.FormatChecker())
 
+# Schema files do not change while the process runs; each is read once.
+# The documents are shared, and must not be modified.
+_schemas = {}
+
+def _load_schema(schema_file_uri):
+    schema = _schemas.get(schema_file_uri)
+    if schema is None:
+        with open(schema_file_uri) as schema_file:
+            schema = json.load(schema_file)
+        _schemas[schema_file_uri] = schema
+    return schema
+
+def load_schemas():
+    """
+    Read all input and mongo schema files ahead of their first use.
+    """
+    for type_ in ['input', 'mongo']:
+        for schema_name in sorted(os.listdir(os.path.join(config.schema_path, type_))):
+            if schema_name.endswith('.json'):
+                _load_schema(schema_uri(type_, schema_name))
+
 def _resolve_schema(schema_file_uri):
-    with open(schema_file_uri) as schema_file:
-        base_uri = os.path.dirname(schema_file_uri)
-        schema = json.load(schema_file)
-        resolver = jsonschema.RefResolver('file://'+base_uri+'/', schema)
-        return (schema, resolver)
+    schema = _load_schema(schema_file_uri)
+    base_uri = os.path.dirname(schema_file_uri)
+    resolver = jsonschema.RefResolver('file://'+base_uri+'/', schema)
+    return (schema, resolver)
+
+# Compiled validators, by schema file and method, built on first use.
+# A RefResolver tracks its scope as it validates, so each thread keeps its own.
+_local = threading.local()
+
+def _get_validator(schema_file_uri, method):
+    """
+    The validator for payloads of this method. A PUT may be partial, so does not check required properties.
+    """
+
+    cache = getattr(_local, 'validators', None)
+    if cache is None:
+        cache = _local.validators = {}
+
+    key = (schema_file_uri, method)
+    validator = cache.get(key)
+    if validator is None:
+        schema, resolver = _resolve_schema(schema_file_uri)
+        if method == 'PUT' and schema.get('required'):
+            schema = copy.copy(schema)
+            schema.pop('required')
+        cls = jsonschema.validators.validator_for(schema)
+        cls.check_schema(schema)
+        validator = cls(schema, resolver=resolver, format_checker=jsonschema.FormatChecker())
+        cache[key] = validator
+    return validator
 
 def no_op(g, *args): # pylint: disable=unused-argument
     return g
@@ -50,19 +97,13 @@ def schema_uri(type_, schema_name):
 def decorator_from_schema_path(schema_url):
     if schema_url is None:
         return no_op
-    schema, resolver = _resolve_schema(schema_url)
     def g(exec_op):
         def validator(method, **kwargs):
             payload = kwargs['payload']
             log.debug(payload)
-            if method == 'PUT' and schema.get('required'):
-                _schema = copy.copy(schema)
-                _schema.pop('required')
-            else:
-                _schema = schema
             if method in ['POST', 'PUT']:
                 try:
-                    _validate_json(payload, _schema, resolver)
+                    _get_validator(schema_url, method).validate(payload)
                 except jsonschema.ValidationError as e:
                     raise DBValidationException(str(e))
             return exec_op(method, **kwargs)
@@ -72,17 +113,10 @@ def decorator_from_schema_path(schema_url):
 def from_schema_path(schema_url):
     if schema_url is None:
         return no_op
-    # split the url in base_uri and schema_name
-    schema, resolver = _resolve_schema(schema_url)
     def g(payload, method):
-        if method == 'PUT' and schema.get('required'):
-            _schema = copy.copy(schema)
-            _schema.pop('required')
-        else:
-            _schema = schema
         if method in ['POST', 'PUT']:
             try:
-                _validate_json(payload, _schema, resolver)
+                _get_validator(schema_url, method).validate(payload)
             except jsonschema.ValidationError as e:
                 raise InputValidationException(str(e))
     return g
@@ -104,7 +138,7 @@ def key_check(schema_url):
     """
     if schema_url is None:
         return no_op
-    schema, _ = _resolve_schema(schema_url)
+    schema = _load_schema(schema_url)
     log.debug(schema)
     if schema.get('key_fields') is None:
         return no_op
@@ -0,0 +1,70 @@
+"""
+Resolved access tokens and API keys, cached in-process so that authenticated requests do not each need
+a database lookup, and API key use is recorded at most once per LAST_USED_INTERVAL rather than on every request.
+
+Entries are per process: an API key replaced in one process is honored by others until their entries expire.
+Access tokens are never revoked here; a cached token stays trusted for up to AUTH_CACHE_TTL after it is deleted.
+"""
+
+import datetime
+import pymongo
+
+from .. import config
+from .. import util
+
+# How many tokens, and how many API keys, each process remembers
+AUTH_CACHE_SIZE = 10000
+
+# How long a resolved token or key is trusted before it is looked up again
+AUTH_CACHE_TTL = datetime.timedelta(seconds=60)
+
+# How often an API key's last_used is written, at most, by each process
+LAST_USED_INTERVAL = datetime.timedelta(seconds=60)
+
+_tokens = util.LRUCache(AUTH_CACHE_SIZE)
+_api_keys = util.LRUCache(AUTH_CACHE_SIZE)
+
+
+def _get(cache, key, now):
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    if entry['expires'] <= now:
+        cache.pop(key)
+        return None
+    return entry
+
+def get_token_uid(access_token):
+    """
+    The uid of a cached access token, or None if it must be looked up.
+    """
+    entry = _get(_tokens, access_token, datetime.datetime.utcnow())
+    return entry['uid'] if entry else None
+
+def cache_token(access_token, uid):
+    _tokens[access_token] = {'uid': uid, 'expires': datetime.datetime.utcnow() + AUTH_CACHE_TTL}
+
+def authenticate_api_key(key):
+    """
+    The uid of the user with this API key, or None if there is no such key.
+    The key's last_used is updated without waiting for the write, if it has not been this LAST_USED_INTERVAL.
+    """
+
+    now = datetime.datetime.utcnow()
+    entry = _get(_api_keys, key, now)
+    if entry is None:
+        user = config.db.users.find_one({'api_key.key': key}, ['_id'])
+        if user is None:
+            return None
+        entry = {'uid': user['_id'], 'expires': now + AUTH_CACHE_TTL, 'last_used': None}
+        _api_keys[key] = entry
+
+    if entry['last_used'] is None or now - entry['last_used'] >= LAST_USED_INTERVAL:
+        entry['last_used'] = now
+        users = config.db.users.with_options(write_concern=pymongo.WriteConcern(w=0))
+        users.update_one({'api_key.key': key}, {'$set': {'api_key.last_used': now}})
+
+    return entry['uid']
+
+def revoke_api_key(key):
+    _api_keys.pop(key)
@@ -15,6 +15,7 @@ from .. import util
 from .. import files
 from .. import config
 from ..types import Origin
+from . import authcache
 from .. import validators
 from ..dao import APIConsistencyException, APIConflictException, APINotFoundException, APIPermissionException, APIValidationException
 
@@ -109,10 +110,9 @@ class RequestHandler(webapp2.RequestHandler):
         Returns the user's UID.
         """
 
-        timestamp = datetime.datetime.utcnow()
-        user = config.db.users.find_one_and_update({'api_key.key': key}, {'$set': {'api_key.last_used': timestamp}}, ['_id'])
-        if user:
-            return user['_id']
+        uid = authcache.authenticate_api_key(key)
+        if uid:
+            return uid
         else:
             self.abort(401, 'Invalid scitran-user API key')
 
@@ -124,7 +124,10 @@ class RequestHandler(webapp2.RequestHandler):
         Returns the user's UID.
         """
 
-        uid = None
+        uid = authcache.get_token_uid(access_token)
+        if uid:
+            return uid
+
         timestamp = datetime.datetime.utcnow()
         cached_token = config.db.authtokens.find_one({'_id': access_token})
 
@@ -143,6 +146,7 @@ class RequestHandler(webapp2.RequestHandler):
             }
             config.db.authtokens.replace_one({'_id': access_token}, update, upsert=True)
 
+        authcache.cache_token(access_token, uid)
         return uid
 
     def validate_oauth_token(self, access_token, timestamp):
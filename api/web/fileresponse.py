@@ -0,0 +1,220 @@
+import os
+import uuid
+
+from .. import config
+
+# Requests for more ranges than this are answered with the whole file, rather than a long multipart body
+MAX_RANGES = 64
+
+READ_SIZE = 2**20
+
+# Responders that have the front-end server send the file, and the header naming it
+OFFLOAD_HEADERS = {
+    'x-accel': 'X-Accel-Redirect',
+    'x-sendfile': 'X-Sendfile',
+}
+
+
+def parse_range(header, size):
+    """
+    Parse a Range header against a file of this size.
+
+    Returns a list of (start, stop) pairs with an exclusive stop, sorted and with overlapping ranges merged;
+    an empty list if no range is satisfiable; or None if the header is absent or malformed and should be ignored.
+    """
+
+    if not header:
+        return None
+
+    units, _, spec = header.partition('=')
+    if units.strip().lower() != 'bytes' or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        if not sep:
+            return None
+        first, last = first.strip(), last.strip()
+        try:
+            if first:
+                start = int(first)
+                stop = int(last) + 1 if last else size
+                if start < 0 or (last and stop <= start):
+                    return None
+            else:
+                # Suffix range: the final N bytes
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                start = max(size - suffix, 0)
+                stop = size
+        except ValueError:
+            return None
+
+        if start < size:
+            ranges.append((start, min(stop, size)))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def etag_for_hash(hash_):
+    """
+    Files are content-addressed, so the stored hash makes a strong ETag.
+    """
+    return '"' + hash_ + '"'
+
+def _etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag in [tag.strip() for tag in header.split(',')]
+
+def file_iter(filepath, start=0, stop=None, read_size=READ_SIZE):
+    """
+    Iterate over the bytes of a file from start up to (excluding) stop.
+    """
+
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        remaining = None if stop is None else stop - start
+        while remaining is None or remaining > 0:
+            data = f.read(read_size if remaining is None else min(read_size, remaining))
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+def _multipart_iter(read, parts, boundary):
+    for header, start, stop in parts:
+        yield header
+        for data in read(start, stop):
+            yield data
+    yield '\r\n--' + boundary + '--\r\n'
+
+def _offload_path(filepath, responder):
+    """
+    Path to hand to the front-end server for an offloaded response.
+    """
+    if responder == 'x-accel':
+        # Map the data path onto an nginx internal location
+        data_path = config.get_item('persistent', 'data_path')
+        prefix = config.get_item('download', 'x_accel_prefix').rstrip('/')
+        return prefix + '/' + os.path.relpath(filepath, data_path)
+    return filepath
+
+def serve_file(request, response, filepath, size, hash_=None, content_type='application/octet-stream', filename=None):
+    """
+    Respond with a file, honoring Range, If-Range and If-None-Match.
+
+    If filename is given, the file is sent as an attachment of that name.
+    Ranges are answered with a 206, using multipart/byteranges when more than one range was requested.
+
+    How the body is sent depends on the download.file_responder config:
+        python          the file is read and written out by this process
+        file_wrapper    whole files are handed to wsgi.file_wrapper, which uwsgi sends with sendfile
+                        (on offload threads, if configured); ranges are sent as with python
+        x-accel         nginx sends the file, found via X-Accel-Redirect under download.x_accel_prefix
+        x-sendfile      the front-end server sends the file named by X-Sendfile, e.g. uwsgi or apache
+
+    Both header modes leave Range handling to the front-end server.
+    """
+
+    responder = config.get_item('download', 'file_responder')
+
+    etag = etag_for_hash(hash_) if hash_ else None
+
+    response.headers['Accept-Ranges'] = 'bytes'
+    if etag:
+        response.headers['ETag'] = etag
+    if filename:
+        response.headers['Content-Disposition'] = 'attachment; filename="' + filename + '"'
+
+    if etag and _etag_matches(request.headers.get('If-None-Match'), etag):
+        response.status = 304
+        return
+
+    if responder in OFFLOAD_HEADERS:
+        response.headers[OFFLOAD_HEADERS[responder]] = _offload_path(filepath, responder)
+        response.headers['Content-Type'] = content_type
+        return
+
+    ranges = requested_ranges(request, size, etag)
+
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if ranges is None and responder == 'file_wrapper' and file_wrapper is not None:
+        response.app_iter = file_wrapper(open(filepath, 'rb'), READ_SIZE)
+        response.headers['Content-Length'] = str(size) # must be set after setting app_iter
+        response.headers['Content-Type'] = content_type
+        return
+
+    serve_ranges(response, size, ranges, lambda start, stop: file_iter(filepath, start, stop), content_type=content_type)
+
+def requested_ranges(request, size, etag=None):
+    """
+    Return the byte ranges requested of a body of this size and entity tag, as parse_range does.
+    A stale If-Range means the client's partial copy is of a different body, so no ranges are returned.
+    Only entity tags are compared; a date in If-Range never matches.
+    """
+
+    ranges = parse_range(request.headers.get('Range'), size)
+
+    if_range = request.headers.get('If-Range')
+    if ranges is not None and if_range and if_range.strip() != etag:
+        ranges = None
+    return ranges
+
+def serve_ranges(response, size, ranges, read, content_type='application/octet-stream'):
+    """
+    Respond with the requested ranges of a body of known size: all of it, a 206 for one range
+    or a multipart/byteranges 206 for several, or a 416 if none can be satisfied.
+
+    read(start, stop) must return an iterator over those bytes of the body.
+    """
+
+    response.headers['Accept-Ranges'] = 'bytes'
+
+    if ranges is None:
+        response.app_iter = read(0, size)
+        response.headers['Content-Length'] = str(size) # must be set after setting app_iter
+        response.headers['Content-Type'] = content_type
+
+    elif not ranges:
+        response.status = 416
+        response.headers['Content-Range'] = 'bytes */' + str(size)
+
+    elif len(ranges) == 1:
+        start, stop = ranges[0]
+        response.status = 206
+        response.app_iter = read(start, stop)
+        response.headers['Content-Length'] = str(stop - start)
+        response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+        response.headers['Content-Type'] = content_type
+
+    else:
+        boundary = uuid.uuid4().hex
+        parts = []
+        length = len('\r\n--' + boundary + '--\r\n')
+        for start, stop in ranges:
+            header = '\r\n--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+                boundary, content_type, start, stop - 1, size)
+            parts.append((header, start, stop))
+            length += len(header) + stop - start
+
+        response.status = 206
+        response.app_iter = _multipart_iter(read, parts, boundary)
+        response.headers['Content-Length'] = str(length)
+        response.headers['Content-Type'] = 'multipart/byteranges; boundary=' + boundary
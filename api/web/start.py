@@ -2,13 +2,16 @@ import atexit
 import json
 import os
 import sys
+import time
 import traceback
 import webapp2
 
+from .. import import_started
 from ..api import endpoints
 from .. import config
 from . import encoder
 from .. import util
+from .. import validators
 from .request import SciTranRequest
 
 try:
@@ -40,8 +43,35 @@ def dispatcher(router, request, response):
             message = 'Internal Server Error'
         util.send_json_http_exception(response, message, 500)
 
+def warm_up():
+    """
+    Do the setup that would otherwise fall on a process's first request, and log how long each step took.
+
+    Under uwsgi this runs in each worker after it is forked: MongoClient is not fork-safe, so the master must not connect.
+    """
+    timings = []
+
+    start = time.time()
+    validators.load_schemas()
+    timings.append('validators {:.0f}ms'.format((time.time() - start) * 1000))
+
+    start = time.time()
+    try:
+        # Initializes the database, and loads the persisted configuration
+        config.get_config()
+    except Exception: # pylint: disable=broad-except
+        # Carry on: the database may not be up yet, and requests connect on demand
+        log.error('Warm-up could not reach the database', exc_info=True)
+    timings.append('database {:.0f}ms'.format((time.time() - start) * 1000))
+
+    log.info('Warmed up: %s', ', '.join(timings))
+
 def app_factory(*_, **__):
     # pylint: disable=protected-access,unused-argument
+    start = time.time()
+
+    # Refuse to start with schema files missing or unexpected
+    config.check_schemas()
 
     # don't use config.get_item() as we don't want to require the database at startup
     application = webapp2.WSGIApplication(endpoints, debug=config.__config['core']['debug'])
@@ -63,6 +93,10 @@ def app_factory(*_, **__):
             log.critical('New Relic detected, but configuration invalid.')
             sys.exit(1)
 
+    if uwsgi is not None:
+        uwsgi.post_fork_hook = warm_up
+    now = time.time()
+    log.info('Application created in %.0fms, %.0fms after the api package began loading', (now - start) * 1000, (now - import_started) * 1000)
     return application
 
 # Functions to enable code coverage when API is started for testing
@@ -14,7 +14,7 @@ from api.jobs.jobs import Job
 from api.jobs import gears
 from api.types import Origin
 
-CURRENT_DATABASE_VERSION = 21 # An int that is bumped when a new schema change is made
+CURRENT_DATABASE_VERSION = 22 # An int that is bumped when a new schema change is made
 
 def get_db_version():
 
@@ -635,6 +635,18 @@ def upgrade_to_21():
     query['$or'].append({'measurement': { '$exists': True}})
     dm_v2_updates(config.db.acquisitions.find(query), 'acquisitions')
 
+def upgrade_to_22():
+    """
+    Add priority to jobs
+
+    Jobs are dispatched in descending priority, and a missing priority sorts below any number.
+    The dispatch index replaces the old (state, now, modified) index.
+    """
+
+    config.db.jobs.update_many({'priority': {'$exists': False}}, {'$set': {'priority': 0}})
+    if 'state_1_now_1_modified_1' in config.db.jobs.index_information():
+        config.db.jobs.drop_index('state_1_now_1_modified_1')
+
 def upgrade_schema():
     """
     Upgrades db to the current schema version
@@ -43,6 +43,13 @@ hooks.skip("GET /jobs/{JobId} -> 404");
 // Can only retry a failed job
 hooks.skip("POST /jobs/{JobId}/retry -> 200");
 
+// Can only heartbeat a running job
+hooks.skip("POST /jobs/{JobId}/heartbeat -> 200");
+// Streams until the server closes it
+hooks.skip("GET /jobs/events -> 200");
+// Only once the per-process stream limit is reached
+hooks.skip("GET /jobs/events -> 503");
+
 // https://github.com/cybertk/abao/issues/160
 hooks.skip("GET /users/self/avatar -> 307");
 hooks.skip("GET /users/{UserId}/avatar -> 307");
@@ -61,6 +68,28 @@ hooks.skip("POST /upload/uid -> 200");
 hooks.skip("POST /upload/uid-match -> 200");
 hooks.skip("POST /upload/uid-match -> 404");
 hooks.skip("POST /engine -> 200");
+// Placing files by reference needs stored files to reference; tested in python
+hooks.skip("POST /upload/label/check -> 200");
+hooks.skip("POST /upload/uid/check -> 200");
+hooks.skip("POST /upload/uid-match/check -> 200");
+hooks.skip("POST /engine/check -> 200");
+// Chunked uploads need a token from upload-start; tested in python
+hooks.skip("POST /projects/{ProjectId}/upload-start -> 200");
+hooks.skip("PUT /projects/{ProjectId}/upload-chunk -> 200");
+hooks.skip("GET /projects/{ProjectId}/upload-status -> 200");
+hooks.skip("POST /projects/{ProjectId}/upload-end -> 200");
+hooks.skip("POST /sessions/{SessionId}/upload-start -> 200");
+hooks.skip("PUT /sessions/{SessionId}/upload-chunk -> 200");
+hooks.skip("GET /sessions/{SessionId}/upload-status -> 200");
+hooks.skip("POST /sessions/{SessionId}/upload-end -> 200");
+hooks.skip("POST /acquisitions/{AcquisitionId}/upload-start -> 200");
+hooks.skip("PUT /acquisitions/{AcquisitionId}/upload-chunk -> 200");
+hooks.skip("GET /acquisitions/{AcquisitionId}/upload-status -> 200");
+hooks.skip("POST /acquisitions/{AcquisitionId}/upload-end -> 200");
+hooks.skip("POST /collections/{CollectionId}/upload-start -> 200");
+hooks.skip("PUT /collections/{CollectionId}/upload-chunk -> 200");
+hooks.skip("GET /collections/{CollectionId}/upload-status -> 200");
+hooks.skip("POST /collections/{CollectionId}/upload-end -> 200");
 hooks.skip("POST /collections/{CollectionId}/packfile-start -> 200");
 hooks.skip("POST /collections/{CollectionId}/packfile -> 200");
 hooks.skip("GET /collections/{CollectionId}/packfile-end -> 200");
@@ -91,6 +120,14 @@ hooks.after("GET /jobs -> 200", function(test, done) {
     done();
 });
 
+hooks.before("POST /jobs/lease -> 200", function(test, done) {
+    // Lease nothing, so that the job added above stays pending for the tests below
+    test.request.query = {
+        tags: 'no-such-tag'
+    };
+    done();
+});
+
 hooks.before("GET /jobs/{JobId} -> 200", function(test, done) {
     test.request.params = {
         JobId: job_id
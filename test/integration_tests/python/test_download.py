@@ -78,3 +78,41 @@ def test_download(with_a_download_available, api_as_admin):
     for tarinfo in tar:
         assert os.path.basename(tarinfo.name) == data.file_name
     tar.close()
+
+
+def test_file_range_download(with_a_download_available, api_as_admin):
+    data = with_a_download_available
+    url = '/projects/' + data.project_id + '/files/' + data.file_name
+
+    r = api_as_admin.get(url)
+    assert r.ok
+    content = r.content
+    etag = r.headers['ETag']
+    assert r.headers['Accept-Ranges'] == 'bytes'
+
+    r = api_as_admin.get(url, headers={'Range': 'bytes=5-8'})
+    assert r.status_code == 206
+    assert r.content == content[5:9]
+    assert r.headers['Content-Range'] == 'bytes 5-8/' + str(len(content))
+
+    r = api_as_admin.get(url, headers={'If-None-Match': etag})
+    assert r.status_code == 304
+
+
+def test_batch_download_resume(with_a_download_available, api_as_admin):
+    data = with_a_download_available
+
+    payload = json.dumps({'optional': False, 'nodes': [{'level': 'project', '_id': data.project_id}]})
+    r = api_as_admin.post('/download', data=payload)
+    assert r.ok
+    ticket = json.loads(r.content)['ticket']
+
+    r = api_as_admin.get('/download', params={'ticket': ticket})
+    assert r.ok
+    archive = r.content
+    assert int(r.headers['Content-Length']) == len(archive)
+
+    # The same ticket serves the rest of the archive after an interruption
+    r = api_as_admin.get('/download', params={'ticket': ticket}, headers={'Range': 'bytes=700-'})
+    assert r.status_code == 206
+    assert r.content == archive[700:]
@@ -441,3 +441,128 @@ def test_acquisition_metadata_only_engine_upload(with_hierarchy_and_file_data, a
     m_timestamp = dateutil.parser.parse(metadata['acquisition']['timestamp'])
     assert a_timestamp == m_timestamp
     assert cmp(a['info'], metadata['acquisition']['info']) == 0
+
+def test_acquisition_engine_check(with_hierarchy_and_file_data, api_as_admin):
+
+    data = with_hierarchy_and_file_data
+
+    r = api_as_admin.post('/engine?level=acquisition&id='+data.acquisition, files=data.files)
+    assert r.ok
+
+    r = api_as_admin.get('/acquisitions/' + data.acquisition)
+    assert r.ok
+    a = json.loads(r.content)
+    uploaded = find_file_in_array('one.csv', a['files'])
+
+    # Same content under a new name is placed from the CAS; unknown content is reported missing
+    payload = {
+        'files': [
+            {'name': 'one-again.csv', 'size': uploaded['size'], 'hash': uploaded['hash']},
+            {'name': 'new.csv', 'size': 10, 'hash': 'v0-sha384-' + 'a' * 96}
+        ]
+    }
+    r = api_as_admin.post('/engine/check?level=acquisition&id='+data.acquisition, json=payload)
+    assert r.ok
+    result = json.loads(r.content)
+    assert result['present'] == ['one-again.csv']
+    assert result['missing'] == ['new.csv']
+
+    r = api_as_admin.get('/acquisitions/' + data.acquisition)
+    assert r.ok
+    a = json.loads(r.content)
+    mf = find_file_in_array('one-again.csv', a['files'])
+    assert mf is not None
+    assert mf['hash'] == uploaded['hash']
+    assert find_file_in_array('new.csv', a['files']) is None
+
+    # A size mismatch never references the CAS entry
+    payload = {'files': [{'name': 'bad.csv', 'size': uploaded['size'] + 1, 'hash': uploaded['hash']}]}
+    r = api_as_admin.post('/engine/check?level=acquisition&id='+data.acquisition, json=payload)
+    assert r.ok
+    assert json.loads(r.content)['missing'] == ['bad.csv']
+
+def test_upload_check_requires_superuser(api_as_user):
+    payload = {'metadata': {}, 'files': [{'name': 'one.csv', 'size': 10, 'hash': 'v0-sha384-' + 'a' * 96}]}
+    r = api_as_user.post('/upload/uid/check', json=payload)
+    assert r.status_code == 403
+
+def test_acquisition_chunked_upload(with_hierarchy_and_file_data, api_as_admin):
+
+    data = with_hierarchy_and_file_data
+    content = 'some,data,to,send\nanother,row,to,send\n'
+    base = '/acquisitions/' + data.acquisition
+
+    r = api_as_admin.post(base + '/upload-start', json={'name': 'chunked.csv', 'size': len(content), 'metadata': {'tags': ['chunked']}})
+    assert r.ok
+    token = json.loads(r.content)['token']
+
+    def put_chunk(start, stop):
+        return api_as_admin.put(base + '/upload-chunk?token=' + token, data=content[start:stop],
+            headers={'Content-Range': 'bytes {}-{}/{}'.format(start, stop - 1, len(content))})
+
+    # Send the second half first
+    r = put_chunk(20, len(content))
+    assert r.ok
+
+    r = api_as_admin.get(base + '/upload-status?token=' + token)
+    assert r.ok
+    assert json.loads(r.content)['missing'] == [[0, 20]]
+
+    # Cannot complete until every byte has arrived
+    r = api_as_admin.post(base + '/upload-end?token=' + token)
+    assert r.status_code == 400
+
+    r = put_chunk(0, 20)
+    assert r.ok
+
+    r = api_as_admin.post(base + '/upload-end?token=' + token)
+    assert r.ok
+
+    r = api_as_admin.get('/acquisitions/' + data.acquisition)
+    assert r.ok
+    a = json.loads(r.content)
+    mf = find_file_in_array('chunked.csv', a['files'])
+    assert mf is not None
+    assert mf['size'] == len(content)
+    assert mf['tags'] == ['chunked']
+
+    # The token is spent
+    r = api_as_admin.get(base + '/upload-status?token=' + token)
+    assert r.status_code == 404
+
+def test_chunked_upload_hash_mismatch(with_hierarchy_and_file_data, api_as_admin):
+
+    data = with_hierarchy_and_file_data
+    content = 'some,data,to,send\n'
+    base = '/acquisitions/' + data.acquisition
+
+    r = api_as_admin.post(base + '/upload-start', json={'name': 'mismatch.csv', 'size': len(content), 'hash': 'v0-sha384-' + 'a' * 96})
+    assert r.ok
+    token = json.loads(r.content)['token']
+
+    r = api_as_admin.put(base + '/upload-chunk?token=' + token, data=content,
+        headers={'Content-Range': 'bytes 0-{}/{}'.format(len(content) - 1, len(content))})
+    assert r.ok
+
+    r = api_as_admin.post(base + '/upload-end?token=' + token)
+    assert r.status_code == 400
+
+    # The token remains usable, so that the upload can be corrected
+    r = api_as_admin.get(base + '/upload-status?token=' + token)
+    assert r.ok
+
+def test_chunked_upload_bad_requests(with_hierarchy_and_file_data, api_as_admin):
+
+    data = with_hierarchy_and_file_data
+    base = '/acquisitions/' + data.acquisition
+
+    r = api_as_admin.post(base + '/upload-start', json={'name': 'huge.csv', 'size': 2 ** 62})
+    assert r.status_code == 413
+
+    r = api_as_admin.post(base + '/upload-start', json={'name': 'small.csv', 'size': 10})
+    assert r.ok
+    token = json.loads(r.content)['token']
+
+    # An unsatisfied range names no chunk
+    r = api_as_admin.put(base + '/upload-chunk?token=' + token, data='', headers={'Content-Range': 'bytes */10'})
+    assert r.status_code == 400
@@ -0,0 +1,21 @@
+import pytest
+
+from api.dao.containerutil import FileReference
+from api.jobs.jobs import Job
+
+
+@pytest.fixture
+def gear():
+    return {
+        'exchange': {
+            'rootfs-url': 'https://example.example/gear.tgz',
+            'rootfs-hash': 'sha384:oy',
+        }
+    }
+
+@pytest.fixture
+def make_job():
+    def make_job(**kwargs):
+        inputs = {'dicom': FileReference(type='acquisition', id='573c9e6a844eac7fc01747cd', name='1_1_dicom.zip')}
+        return Job('test-case-gear', inputs, **kwargs)
+    return make_job
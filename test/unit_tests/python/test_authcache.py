@@ -0,0 +1,42 @@
+import datetime
+from mock import Mock, patch
+
+from api import config
+from api.web import authcache
+
+
+@patch('api.config.db', Mock())
+def test_api_key_cached():
+    config.db.users.find_one.return_value = {'_id': 'user@example.com'}
+    users = config.db.users.with_options.return_value
+
+    assert authcache.authenticate_api_key('key-1') == 'user@example.com'
+    assert authcache.authenticate_api_key('key-1') == 'user@example.com'
+    assert config.db.users.find_one.call_count == 1
+    # Use within the interval is not recorded again
+    assert users.update_one.call_count == 1
+
+    authcache.revoke_api_key('key-1')
+    config.db.users.find_one.return_value = None
+    assert authcache.authenticate_api_key('key-1') is None
+
+@patch('api.config.db', Mock())
+def test_api_key_expiry(monkeypatch):
+    config.db.users.find_one.return_value = {'_id': 'user@example.com'}
+    users = config.db.users.with_options.return_value
+
+    monkeypatch.setattr(authcache, 'LAST_USED_INTERVAL', datetime.timedelta(0))
+    authcache.authenticate_api_key('key-2')
+    authcache.authenticate_api_key('key-2')
+    assert users.update_one.call_count == 2
+
+    monkeypatch.setattr(authcache, 'AUTH_CACHE_TTL', datetime.timedelta(0))
+    authcache.revoke_api_key('key-2')
+    authcache.authenticate_api_key('key-2')
+    authcache.authenticate_api_key('key-2')
+    assert config.db.users.find_one.call_count == 3
+
+def test_token_cache():
+    assert authcache.get_token_uid('token') is None
+    authcache.cache_token('token', 'user@example.com')
+    assert authcache.get_token_uid('token') == 'user@example.com'
@@ -0,0 +1,40 @@
+import copy
+import datetime
+from mock import Mock, patch
+
+from api import config
+
+
+@patch('api.config.db', Mock())
+def test_refresh(monkeypatch):
+    startup = copy.deepcopy(config.DEFAULT_CONFIG)
+    monkeypatch.setattr(config, '__config', startup)
+    monkeypatch.setattr(config, '__config_persisted', True)
+    monkeypatch.setattr(config, '__last_update', datetime.datetime.utcfromtimestamp(0))
+    monkeypatch.setattr(config, '__listeners', [])
+
+    # Persisted by a release without the queue settings
+    db_config = copy.deepcopy(config.DEFAULT_CONFIG)
+    db_config['core']['log_level'] = 'debug'
+    del db_config['queue']
+    config.db.singletons.find_one.return_value = db_config
+
+    changes = []
+    config.add_listener(changes.append)
+    version = config.get_config_version()
+
+    assert config.get_item('core', 'log_level') == 'debug'
+    assert config.get_item('queue', 'max_retries') == config.DEFAULT_CONFIG['queue']['max_retries']
+    assert config.get_config_version() == version + 1
+    assert len(changes) == 1
+
+    # Until the next refresh, the configuration is read locally
+    config.get_item('core', 'log_level')
+    assert config.db.singletons.find_one.call_count == 1
+
+    # An unchanged configuration is not announced
+    monkeypatch.setattr(config, '__last_update', datetime.datetime.utcfromtimestamp(0))
+    config.get_config()
+    assert config.db.singletons.find_one.call_count == 2
+    assert config.get_config_version() == version + 1
+    assert len(changes) == 1
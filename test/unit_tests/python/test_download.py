@@ -0,0 +1,123 @@
+import datetime
+import tarfile
+import cStringIO
+from mock import Mock, patch
+import webob
+
+from api import config
+from api import download
+
+
+def make_ticket(tmpdir, contents):
+    targets = []
+    for i, content in enumerate(contents):
+        path = tmpdir.join('file' + str(i))
+        path.write(content)
+        targets.append((str(path), 'prefix/file' + str(i) + '.dat', len(content)))
+    return {'target': targets, 'timestamp': datetime.datetime(2016, 10, 1, 12, 0)}
+
+def test_archivestream(tmpdir, monkeypatch):
+    # Small reads and budget, so that members span several reads and read-ahead is throttled
+    monkeypatch.setattr(download, 'ARCHIVE_READ_SIZE', 1024)
+    monkeypatch.setattr(download, 'ARCHIVE_PREFETCH_FILES', 3)
+    monkeypatch.setattr(download, 'ARCHIVE_PREFETCH_BUDGET', 2048)
+
+    contents = ['', 'a' * 10, 'b' * 1024, 'c' * 5000] + [str(i) * 700 for i in range(10)]
+    ticket = make_ticket(tmpdir, contents)
+
+    data = ''.join(download.archivestream(ticket))
+    assert data.endswith(download.TAR_TRAILER)
+
+    with tarfile.open(mode='r', fileobj=cStringIO.StringIO(data)) as tar:
+        members = tar.getmembers()
+        assert [m.name for m in members] == [t[1] for t in ticket['target']]
+        for member, content in zip(members, contents):
+            assert member.size == len(content)
+            assert member.mtime == 1475323200
+            assert tar.extractfile(member).read() == content
+
+def test_archivestream_closed_early(tmpdir):
+    ticket = make_ticket(tmpdir, ['x' * 100] * 20)
+
+    stream = download.archivestream(ticket)
+    next(stream)
+    # A client disconnect closes the generator; the read-ahead pool must shut down cleanly
+    stream.close()
+
+def test_archive_layout_matches_stream(tmpdir):
+    # Names past 100 characters take extra GNU long name blocks
+    contents = ['a' * 10, 'b' * 512, 'c' * 3000]
+    ticket = make_ticket(tmpdir, contents)
+    ticket['target'][1] = (ticket['target'][1][0], 'long/' + 'n' * 150 + '.dat', 512)
+    ticket['archive'] = download.archive_layout(ticket['target'], ticket['timestamp'])
+
+    data = ''.join(download.archivestream(ticket))
+    assert len(data) == ticket['archive']['size']
+    for offset, (_, arcpath, _) in zip(ticket['archive']['offsets'], ticket['target']):
+        header = data[offset:offset + tarfile.BLOCKSIZE]
+        assert tarfile.TarInfo.frombuf(header).name in (arcpath, '././@LongLink')
+
+def test_archivestream_ranges(tmpdir, monkeypatch):
+    monkeypatch.setattr(download, 'ARCHIVE_READ_SIZE', 512)
+    contents = ['a' * 10, '', 'b' * 1500, 'c' * 700]
+    ticket = make_ticket(tmpdir, contents)
+    ticket['archive'] = download.archive_layout(ticket['target'], ticket['timestamp'])
+    data = ''.join(download.archivestream(ticket))
+
+    size = len(data)
+    for start, stop in [(0, 1), (5, 600), (600, 2100), (1000, size), (size - 10, size), (0, size)]:
+        assert ''.join(download.archivestream(ticket, start, stop)) == data[start:stop]
+
+def test_existing_paths(tmpdir):
+    present = [str(tmpdir.join('file' + str(i))) for i in range(100)]
+    for path in present:
+        open(path, 'w').close()
+    missing = [str(tmpdir.join('missing' + str(i))) for i in range(100)]
+
+    assert download.existing_paths(present + missing + present) == set(present)
+    assert download.existing_paths(missing[:1]) == set()
+    assert download.existing_paths([]) == set()
+
+def test_files_query():
+    assert download.files_query(True, None) == {}
+    assert download.files_query(False, None) == {'files.optional': {'$ne': True}}
+    assert download.files_query(True, [{'tags': {'+': ['good'], '-': ['bad']}}, {'types': {'+': ['nifti']}}]) == {
+        '$or': [
+            {'files.tags': {'$in': ['good'], '$nin': ['bad']}},
+            {'files.type': {'$in': ['nifti']}},
+        ]
+    }
+    assert download.files_query(False, [{}]) == {'$and': [{'files.optional': {'$ne': True}}, {'$or': [{}]}]}
+
+def test_resume_expiry(tmpdir):
+    ticket = make_ticket(tmpdir, ['a' * 10])
+    ticket['archive'] = download.archive_layout(ticket['target'], ticket['timestamp'])
+    created = ticket['timestamp']
+
+    now = created + datetime.timedelta(hours=1)
+    assert download.resume_expiry(ticket, now) == now + download.ARCHIVE_RESUME_WINDOW
+
+    # Never past the lifetime cap, however recently the download was resumed
+    now = created + download.ARCHIVE_MAX_LIFETIME - datetime.timedelta(hours=1)
+    assert download.resume_expiry(ticket, now) == created + download.ARCHIVE_MAX_LIFETIME
+
+    ticket['created'] = created - datetime.timedelta(days=1)
+    assert download.resume_expiry(ticket, now) == ticket['created'] + download.ARCHIVE_MAX_LIFETIME
+
+@patch('api.config.db', Mock())
+def test_send_archive_extends_ticket(tmpdir):
+    ticket = make_ticket(tmpdir, ['a' * 10])
+    ticket.update(_id='ticket', filename='archive.tar', created=ticket['timestamp'])
+    ticket['archive'] = download.archive_layout(ticket['target'], ticket['timestamp'])
+
+    # The first download keeps the ticket for resuming, unless it has already been downloaded
+    download.send_archive(webob.Request.blank('/download'), webob.Response(), ticket)
+    query, update = config.db.downloads.update_one.call_args[0]
+    assert query == {'_id': 'ticket', 'started': {'$exists': False}}
+    assert update['$max']['timestamp'] == ticket['created'] + download.ARCHIVE_MAX_LIFETIME
+
+    # Resuming extends it again
+    download.send_archive(webob.Request.blank('/download', headers={'Range': 'bytes=100-'}), webob.Response(), ticket)
+    query, update = config.db.downloads.update_one.call_args[0]
+    assert query == {'_id': 'ticket'}
+    assert '$max' in update
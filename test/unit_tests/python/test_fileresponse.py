@@ -0,0 +1,112 @@
+import mock
+import pytest
+import webob
+
+from api.web import fileresponse
+
+
+HASH = 'v0-sha384-' + 'ab' * 48
+DATA = '0123456789abcdefghij'
+
+
+@pytest.yield_fixture(autouse=True)
+def python_responder():
+    with responder_config('python'):
+        yield
+
+@pytest.fixture
+def filepath(tmpdir):
+    path = tmpdir.join('file.bin')
+    path.write(DATA)
+    return str(path)
+
+def serve(filepath, environ=None, **headers):
+    request = webob.Request.blank('/', environ=environ, headers=headers)
+    response = webob.Response()
+    fileresponse.serve_file(request, response, filepath, len(DATA), hash_=HASH, filename='file.bin')
+    return response
+
+def test_parse_range():
+    assert fileresponse.parse_range(None, 10) is None
+    assert fileresponse.parse_range('bytes=0-4', 10) == [(0, 5)]
+    assert fileresponse.parse_range('bytes=5-', 10) == [(5, 10)]
+    assert fileresponse.parse_range('bytes=-3', 10) == [(7, 10)]
+    assert fileresponse.parse_range('bytes=8-20', 10) == [(8, 10)]
+    assert fileresponse.parse_range('bytes=4-6, 0-1, 5-8', 10) == [(0, 2), (4, 9)]
+    assert fileresponse.parse_range('bytes=10-', 10) == []
+    assert fileresponse.parse_range('bytes=5-1', 10) is None
+    assert fileresponse.parse_range('items=0-1', 10) is None
+    assert fileresponse.parse_range('bytes=a-b', 10) is None
+
+def test_full_response(filepath):
+    response = serve(filepath)
+    assert response.status_int == 200
+    assert response.body == DATA
+    assert response.headers['ETag'] == '"' + HASH + '"'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+def test_not_modified(filepath):
+    response = serve(filepath, **{'If-None-Match': '"other", "' + HASH + '"'})
+    assert response.status_int == 304
+    assert response.body == ''
+
+def test_single_range(filepath):
+    response = serve(filepath, Range='bytes=2-5')
+    assert response.status_int == 206
+    assert response.body == '2345'
+    assert response.headers['Content-Range'] == 'bytes 2-5/20'
+    assert response.headers['Content-Length'] == '4'
+
+def test_multiple_ranges(filepath):
+    response = serve(filepath, Range='bytes=0-1,-2')
+    assert response.status_int == 206
+    assert response.content_type == 'multipart/byteranges'
+    body = response.body
+    assert len(body) == int(response.headers['Content-Length'])
+    assert 'Content-Range: bytes 0-1/20\r\n\r\n01' in body
+    assert 'Content-Range: bytes 18-19/20\r\n\r\nij' in body
+
+def test_unsatisfiable_range(filepath):
+    response = serve(filepath, Range='bytes=50-60')
+    assert response.status_int == 416
+    assert response.headers['Content-Range'] == 'bytes */20'
+
+def test_if_range(filepath):
+    response = serve(filepath, Range='bytes=2-5', **{'If-Range': '"' + HASH + '"'})
+    assert response.status_int == 206
+
+    response = serve(filepath, Range='bytes=2-5', **{'If-Range': '"stale"'})
+    assert response.status_int == 200
+    assert response.body == DATA
+
+def responder_config(responder):
+    items = {
+        ('download', 'file_responder'): responder,
+        ('download', 'x_accel_prefix'): '/_data/',
+        ('persistent', 'data_path'): '/var/data',
+    }
+    return mock.patch('api.config.get_item', side_effect=lambda outer, inner: items[(outer, inner)])
+
+def test_x_accel_responder():
+    with responder_config('x-accel'):
+        response = serve('/var/data/v0/sha384/ab/ab/' + HASH, Range='bytes=2-5')
+    assert response.headers['X-Accel-Redirect'] == '/_data/v0/sha384/ab/ab/' + HASH
+    assert response.headers['ETag'] == '"' + HASH + '"'
+    assert response.status_int == 200
+    assert response.body == ''
+
+def test_x_sendfile_responder(filepath):
+    with responder_config('x-sendfile'):
+        response = serve(filepath)
+    assert response.headers['X-Sendfile'] == filepath
+    assert response.body == ''
+
+def test_file_wrapper_responder(filepath):
+    file_wrapper = mock.Mock(return_value=[DATA])
+    with responder_config('file_wrapper'):
+        response = serve(filepath, environ={'wsgi.file_wrapper': file_wrapper})
+        partial = serve(filepath, environ={'wsgi.file_wrapper': file_wrapper}, Range='bytes=2-5')
+    assert response.body == DATA
+    assert file_wrapper.call_count == 1
+    # Ranges are still served by the application
+    assert partial.body == '2345'
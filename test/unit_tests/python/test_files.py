@@ -1,3 +1,5 @@
+import zlib
+import cStringIO
 
 import pytest
 from api import files
@@ -23,3 +25,68 @@ def test_qa():
 
 def test_unknown():
     assert files.guess_type_from_filename('example.unknown') == None
+
+def test_hashing_file_size_and_hash(tmpdir):
+    path = str(tmpdir.join('data.txt'))
+    f = files.HashingFile(path, 'sha384')
+    f.write('some,data\n')
+    f.write('more,data\n')
+    f.close()
+
+    assert f.size == 20
+    assert f.get_formatted_hash() == files.hash_file_formatted(path)
+
+def test_move_file_creates_target_dir(tmpdir):
+    source = tmpdir.join('source.txt')
+    source.write('data')
+    target = tmpdir.join('v0', 'sha384', 'ab', 'cd', 'target.txt')
+
+    files.move_file(str(source), str(target))
+
+    assert not source.check()
+    assert target.read() == 'data'
+
+def test_hashing_file_threaded_multiple_algs(tmpdir):
+    path = str(tmpdir.join('data.bin'))
+    data = 'x' * (files.HASH_BUFFER_SIZE + 10)
+    f = files.HashingFile(path, 'sha384', extra_hash_algs=['crc32', 'md5'], threaded=True)
+    f.write(data[:100])
+    f.write(data[100:])
+    f.close()
+
+    hashes = f.get_formatted_hashes()
+    assert sorted(hashes) == ['crc32', 'md5', 'sha384']
+    assert hashes == files.hash_file_formatted_many(path, ['sha384', 'crc32', 'md5'])
+    assert f.get_formatted_hash() == hashes['sha384']
+    assert hashes['crc32'] == 'v0-crc32-%08x' % (zlib.crc32(data) & 0xffffffff)
+
+def test_write_chunk_out_of_order(tmpdir):
+    path = str(tmpdir.join('staged'))
+    with open(path, 'wb') as f:
+        f.truncate(12)
+
+    second = files.write_chunk(path, 6, cStringIO.StringIO('world!'), 6)
+    first = files.write_chunk(path, 0, cStringIO.StringIO('hello '), 6)
+
+    assert open(path, 'rb').read() == 'hello world!'
+    assert first != second
+    assert first.startswith('v0-sha384-')
+
+def test_write_chunk_short_body(tmpdir):
+    path = str(tmpdir.join('staged'))
+    with open(path, 'wb') as f:
+        f.truncate(12)
+
+    with pytest.raises(files.FileStoreException):
+        files.write_chunk(path, 0, cStringIO.StringIO('short'), 6)
+
+def test_missing_ranges():
+    assert files.missing_ranges([], 10) == [[0, 10]]
+    assert files.missing_ranges([], 0) == []
+    assert files.missing_ranges([{'start': 4, 'end': 6}, {'start': 0, 'end': 2}], 10) == [[2, 4], [6, 10]]
+    # Overlapping and repeated chunks, e.g. from a retried PUT
+    assert files.missing_ranges([{'start': 0, 'end': 6}, {'start': 3, 'end': 8}, {'start': 0, 'end': 6}, {'start': 8, 'end': 10}], 10) == []
+
+def test_extra_hash_algs_drops_unknown(monkeypatch):
+    monkeypatch.setattr(files.config, 'get_item', lambda outer, inner: ' md5, sha348 ,crc32,sha384')
+    assert files.extra_hash_algs() == ['md5', 'crc32']
@@ -0,0 +1,57 @@
+import itertools
+
+from jsonschema import Draft4Validator
+
+from api import util
+from api.jobs import gears
+
+
+SCHEMAS = [
+    {},
+    {'type': 'object', 'properties': {'type': {'enum': ['dicom', 'nifti']}}},
+    {'type': 'object', 'properties': {'type': {'type': 'string'}}, 'required': ['type']},
+    {'properties': {'name': {'type': 'string', 'pattern': '\\.nii(\\.gz)?$'}}},
+    {'properties': {'measurements': {'type': 'array', 'items': {'enum': ['diffusion', 'functional']}}}},
+    {'properties': {'size': {'type': ['integer', 'null']}}},
+    {'properties': {'size': {'type': 'number'}}},
+    # Not compiled, left to jsonschema
+    {'properties': {'size': {'minimum': 10}}},
+    {'properties': {'type': {'enum': [1, 'dicom']}}},
+]
+
+FILES = [
+    {},
+    {'name': 'a.dcm', 'type': 'dicom'},
+    {'name': 'a.nii.gz', 'type': 'nifti', 'measurements': ['diffusion'], 'size': 12},
+    {'name': 'a.nii', 'type': None, 'measurements': ['anatomy'], 'size': 1.5},
+    {'name': 'b.nii', 'type': 1, 'measurements': 'diffusion', 'size': True},
+    {'name': 7, 'type': ['dicom'], 'size': None},
+]
+
+def test_compile_schema():
+    assert gears.compile_schema(SCHEMAS[1]) is not None
+    assert gears.compile_schema(SCHEMAS[-2]) is None
+    assert gears.compile_schema(SCHEMAS[-1]) is None
+
+def test_file_matcher_agrees_with_jsonschema():
+    for schema in SCHEMAS:
+        validator = Draft4Validator(schema)
+        matcher = gears.FileMatcher(schema)
+        memo = {}
+        # Twice over, so that memoized results are checked too
+        for file_ in itertools.chain(FILES, FILES):
+            expected = validator.is_valid(file_)
+            assert matcher.matches(file_) == expected
+            assert matcher.matches(file_, memo) == expected
+
+def test_file_matcher_shared_cache():
+    cache = util.LRUCache(100)
+    dicom = gears.FileMatcher(SCHEMAS[1], cache_key=('gear', 'dicom'))
+    required = gears.FileMatcher(SCHEMAS[2], cache_key=('gear', 'other'))
+
+    assert dicom.matches({'name': 'a', 'type': 'dicom'}, cache)
+    assert not required.matches({'name': 'b'}, cache)
+    # Only the attributes the schemas read are remembered, once per matcher
+    assert len(cache) == 2
+    assert dicom.matches({'name': 'c', 'type': 'dicom', 'size': 1}, cache)
+    assert len(cache) == 2
@@ -0,0 +1,123 @@
+import bson
+import calendar
+import datetime
+import itertools
+from mock import Mock, patch
+
+from api import config
+from api.jobs import events, stats
+
+
+@patch('api.config.db', Mock())
+def test_insert_generates_request(gear, make_job):
+    job = make_job(config_={'two-digit multiple of ten': 20})
+
+    job.insert(gear=gear)
+
+    doc = config.db.jobs.insert_one.call_args[0][0]
+    assert str(doc['_id']) == job.id_
+    assert 'id' not in doc
+    assert doc['request']['inputs'][0]['uri'] == gear['exchange']['rootfs-url']
+    assert doc['request']['inputs'][1]['uri'] == '/jobs/' + job.id_ + '/config.json'
+    assert doc['request']['outputs'][0]['uri'].endswith('&job=' + job.id_)
+
+@patch('api.config.db', Mock())
+def test_insert_without_gear(make_job):
+    job = make_job()
+
+    job.insert()
+
+    doc = config.db.jobs.insert_one.call_args[0][0]
+    assert 'request' not in doc
+    assert doc['priority'] == 0
+
+@patch('api.config.db', Mock())
+def test_insert_counts_stats(make_job):
+    job = make_job(tags=['b', 'a'])
+
+    job.insert()
+
+    query, update = config.db.singletons.update_one.call_args[0]
+    key = 'by-tag.' + stats.tags_key(['test-case-gear', 'a', 'b'])
+    assert query == {'_id': stats.STATS_ID}
+    assert update['$inc'] == {'by-state.pending': 1, key + '.count': 1}
+    assert update['$set'] == {key + '.tags': ['a', 'b', 'test-case-gear']}
+
+@patch('api.config.db', Mock())
+def test_stats_state_changed():
+    stats.state_changed('running', 'failed', n=3, permafailed=1)
+    update = config.db.singletons.update_one.call_args[0][1]
+    assert update == {'$inc': {'by-state.running': -3, 'by-state.failed': 3, 'permafailed': 1}}
+
+    config.db.singletons.update_one.reset_mock()
+    stats.state_changed('running', 'running')
+    stats.tags_changed(['a', 'b'], ['b', 'a'])
+    assert not config.db.singletons.update_one.called
+
+@patch('api.config.db', Mock())
+def test_insert_publishes_event(make_job):
+    job = make_job(tags=['a'])
+
+    job.insert()
+
+    events_ = config.db.job_events.with_options.return_value.insert_many.call_args[0][0]
+    assert len(events_) == 1
+    assert str(events_[0]['job']) == job.id_
+    assert events_[0]['state'] == 'pending'
+    assert events_[0]['previous'] is None
+    assert sorted(events_[0]['tags']) == ['a', 'test-case-gear']
+
+class TailCursor(object):
+    """A tailable cursor that returns these results, then waits without a result until closed."""
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.alive = True
+
+    def next(self):
+        if self.results:
+            return self.results.pop(0)
+        raise StopIteration
+
+    def close(self):
+        self.alive = False
+
+def event_id(second, n):
+    """An event id made at this second past 2016-10-01 12:00, distinguished by n."""
+    timestamp = calendar.timegm(datetime.datetime(2016, 10, 1, 12, 0, second).utctimetuple())
+    return bson.ObjectId('{:08x}{:016x}'.format(timestamp, n))
+
+@patch('api.config.db', Mock())
+def test_follow_resumes_without_repeats():
+    # Events of the same second may be found before the one resumed from
+    after = event_id(0, 2)
+    results = [
+        {'_id': event_id(0, 1), 'job': 'earlier in second'},
+        {'_id': after, 'job': 'seen'},
+        {'_id': event_id(0, 3), 'state': None},
+        {'_id': event_id(1, 1), 'job': 'new'},
+    ]
+    config.db.job_events.find.return_value = TailCursor(results)
+
+    followed = events.follow(events.build_query(tags=['a']), after=after, duration=60)
+    assert [doc['job'] for doc in itertools.islice(followed, 2)] == ['earlier in second', 'new']
+
+    query = config.db.job_events.find.call_args[0][0]
+    assert query['tags'] == {'$in': ['a']}
+    assert query['_id']['$gte'].generation_time == after.generation_time
+
+@patch('api.config.db', Mock())
+def test_follow_keepalive(monkeypatch):
+    monkeypatch.setattr(events, 'KEEPALIVE_INTERVAL', 0)
+    config.db.job_events.find.return_value = TailCursor([])
+
+    followed = events.follow({}, duration=60)
+    assert next(followed) is None
+
+@patch('api.config.get_item', Mock(return_value=1))
+def test_stream_cap():
+    assert events.open_stream()
+    assert not events.open_stream()
+    events.close_stream()
+    assert events.open_stream()
+    events.close_stream()
@@ -0,0 +1,281 @@
+import bson
+import datetime
+from mock import Mock, patch
+import mongomock
+import pytest
+
+from api import config
+from api.dao import APINotFoundException
+from api.dao.containerutil import ContainerReference
+from api.jobs.jobs import Job
+from api.jobs.queue import Queue
+
+
+@pytest.yield_fixture
+def mongo():
+    db = mongomock.MongoClient().db
+    with patch('api.config.db', db), patch('api.jobs.queue.lease_duration', Mock(return_value=datetime.timedelta(seconds=100))):
+        yield db
+
+@pytest.yield_fixture
+def db():
+    db = Mock()
+    db.jobs.insert_many.side_effect = lambda docs: Mock(inserted_ids=[d['_id'] for d in docs])
+    with patch('api.config.db', db):
+        yield db
+
+@patch('api.jobs.queue.validate_gear_config')
+@patch('api.jobs.queue.get_gear_by_name')
+def test_enqueue(get_gear_by_name, validate_gear_config, db, gear, make_job):
+    get_gear_by_name.return_value = gear
+    jobs = [make_job(config_={'a': 1}) for _ in range(50)]
+
+    ids = Queue.enqueue(jobs)
+
+    assert ids == [bson.ObjectId(job.id_) for job in jobs]
+    assert db.jobs.insert_many.call_count == 1
+    docs = db.jobs.insert_many.call_args[0][0]
+    assert all(doc['request']['outputs'][0]['uri'].endswith('&job=' + str(doc['_id'])) for doc in docs)
+    # Shared configs are validated once
+    assert validate_gear_config.call_count == 1
+
+@patch('api.jobs.queue.validate_gear_config', Mock(side_effect=Exception('config did not match manifest')))
+@patch('api.jobs.queue.get_gear_by_name')
+def test_enqueue_invalid(get_gear_by_name, db, gear, make_job):
+    get_gear_by_name.return_value = gear
+    with pytest.raises(Exception):
+        Queue.enqueue([make_job(config_={'a': 1}) for _ in range(2)])
+    assert not db.jobs.insert_many.called
+
+def test_search_mixed_containers(db):
+    containers = [
+        ContainerReference('acquisition', 'a1'),
+        ContainerReference('analysis', 'b1'),
+        ContainerReference('acquisition', 'a2'),
+    ]
+
+    Queue.search(containers, states=['pending'], limit=10)
+
+    query = db.jobs.find.call_args[0][0]
+    assert sorted(query['$or']) == sorted([
+        {'inputs': {'$elemMatch': {'type': 'acquisition', 'id': {'$in': ['a1', 'a2']}}}},
+        {'inputs': {'$elemMatch': {'type': 'analysis', 'id': {'$in': ['b1']}}}},
+    ])
+    assert query['state'] == {'$in': ['pending']}
+    db.jobs.find.return_value.sort.return_value.limit.assert_called_with(10)
+
+def test_search_after(db):
+    created = datetime.datetime(2016, 10, 1)
+    last_id = bson.ObjectId()
+    db.jobs.find_one.return_value = {'_id': last_id, 'created': created}
+
+    Queue.search([ContainerReference('acquisition', 'a1')], after=str(last_id))
+
+    query = db.jobs.find.call_args[0][0]
+    assert query['$and'][1] == {'$or': [
+        {'created': {'$gt': created}},
+        {'created': created, '_id': {'$gt': last_id}},
+    ]}
+
+def running_doc(job, name=None, **fields):
+    doc = job.insert_document()
+    doc.update(state='running', **fields)
+    if name is not None:
+        doc['name'] = name
+    return doc
+
+def get_installed_gear(gear):
+    def get_gear_by_name(name):
+        if name == 'removed-gear':
+            raise APINotFoundException('Unknown gear ' + name)
+        return gear
+    return get_gear_by_name
+
+def reap_finds(db, orphans):
+    """
+    Answer the queries of one scan_for_orphans pass over a single batch of orphans.
+    """
+    candidates = iter([[{'_id': doc['_id']} for doc in orphans], []])
+    def find(query, *args, **kwargs):
+        if 'previous_job_id' in query:
+            return []
+        if 'reap_id' in query:
+            return [dict(doc, state='failed') for doc in orphans if doc['_id'] in query['_id']['$in']]
+        return next(candidates)
+    db.jobs.find.side_effect = find
+
+@patch('api.jobs.queue.max_attempts', Mock(return_value=3))
+@patch('api.jobs.queue.lease_duration', Mock(return_value=datetime.timedelta(seconds=100)))
+def test_reap_respawns_jobs_of_removed_gears(db, gear, make_job):
+    orphans = [running_doc(make_job()), running_doc(make_job(), name='removed-gear'), running_doc(make_job())]
+    reap_finds(db, orphans)
+
+    with patch('api.jobs.queue.get_gear_by_name', Mock(side_effect=get_installed_gear(gear))):
+        assert Queue.scan_for_orphans() == 3
+
+    # Every orphan is respawned; the one whose gear was removed gets its request once it is started
+    docs = db.jobs.insert_many.call_args[0][0]
+    assert [doc['previous_job_id'] for doc in docs] == [str(doc['_id']) for doc in orphans]
+    assert [doc.get('request') is not None for doc in docs] == [True, False, True]
+    assert all(doc['attempt'] == 2 and doc['state'] == 'pending' for doc in docs)
+
+@patch('api.jobs.queue.max_attempts', Mock(return_value=3))
+def test_retry_removed_gear(db, make_job):
+    failed = make_job(state='failed').insert_document()
+    failed['name'] = 'removed-gear'
+    db.jobs.find_one.return_value = None
+
+    with patch('api.jobs.queue.get_gear_by_name', Mock(side_effect=APINotFoundException('Unknown gear'))):
+        new_id = Queue.retry(Job.load(failed), force=True)
+
+    doc = db.jobs.insert_many.call_args[0][0][0]
+    assert doc['_id'] == new_id
+    assert doc['previous_job_id'] == str(failed['_id'])
+    assert 'request' not in doc
+
+@patch('api.jobs.queue.max_attempts', Mock(return_value=3))
+@patch('api.jobs.queue.lease_duration', Mock(return_value=datetime.timedelta(seconds=100)))
+def test_lease_fails_jobs_of_removed_gears(db, gear, make_job):
+    queued = [make_job().insert_document(), make_job().insert_document(), make_job().insert_document()]
+    queued[1]['name'] = 'removed-gear'
+    db.jobs.find.side_effect = [[{'_id': doc['_id']} for doc in queued], queued]
+    db.jobs.update_many.return_value = Mock(modified_count=3)
+
+    with patch('api.jobs.queue.get_gear_by_name', Mock(side_effect=get_installed_gear(gear))):
+        leased = Queue.start_jobs(limit=3)
+
+    assert [doc['_id'] for doc in leased] == [queued[0]['_id'], queued[2]['_id']]
+    assert all(doc['request'] is not None for doc in leased)
+    query, update = db.jobs.update_many.call_args[0]
+    assert query['_id'] == {'$in': [queued[1]['_id']]}
+    assert update['$set']['state'] == 'failed'
+
+def queue_job(mongo, make_job, gear=None, **kwargs):
+    job = make_job(**kwargs)
+    mongo.jobs.insert_one(job.insert_document(gear=gear))
+    return job.id_
+
+def test_lease_order(mongo, gear, make_job):
+    t = datetime.datetime(2016, 10, 1)
+    oldest = queue_job(mongo, make_job, gear, modified=t)
+    newer = queue_job(mongo, make_job, gear, modified=t + datetime.timedelta(seconds=1))
+    urgent = queue_job(mongo, make_job, gear, priority=10, modified=t + datetime.timedelta(seconds=2))
+    now = queue_job(mongo, make_job, gear, now=True, modified=t + datetime.timedelta(seconds=3))
+    low = queue_job(mongo, make_job, gear, priority=-1, modified=t)
+
+    leased = Queue.start_jobs(limit=4)
+
+    # "now" first, then by descending priority, then oldest first
+    assert [str(doc['_id']) for doc in leased] == [now, urgent, oldest, newer]
+    assert len(set(doc['lease_id'] for doc in leased)) == 1
+    assert all(doc['state'] == 'running' and doc['lease_expires'] > doc['modified'] for doc in leased)
+    assert mongo.jobs.find_one({'_id': bson.ObjectId(low)})['state'] == 'pending'
+
+    # Each lease gets its own id
+    leased_again = Queue.start_jobs(limit=4)
+    assert [str(doc['_id']) for doc in leased_again] == [low]
+    assert leased_again[0]['lease_id'] != leased[0]['lease_id']
+    assert Queue.start_jobs(limit=4) == []
+
+def test_lease_tags(mongo, gear, make_job):
+    tagged = queue_job(mongo, make_job, gear, tags=['a'])
+    queue_job(mongo, make_job, gear, tags=['b'])
+
+    assert [str(doc['_id']) for doc in Queue.start_jobs(tags=['a'], limit=2)] == [tagged]
+
+def test_lease_replaces_lost_candidates(mongo, gear, make_job):
+    ids = [queue_job(mongo, make_job, gear, modified=datetime.datetime(2016, 10, 1, 0, 0, i)) for i in range(4)]
+    update_many = mongo.jobs.update_many
+
+    def claim_first_concurrently(query, update):
+        # Another engine claims the first candidate between the selection and the claim
+        if query['_id']['$in'][0] == bson.ObjectId(ids[0]):
+            update_many({'_id': bson.ObjectId(ids[0])}, {'$set': {'state': 'running', 'lease_id': bson.ObjectId()}})
+        return update_many(query, update)
+
+    with patch.object(mongo.jobs, 'update_many', Mock(side_effect=claim_first_concurrently)):
+        leased = Queue.start_jobs(limit=2)
+
+    assert [str(doc['_id']) for doc in leased] == ids[1:3]
+    assert mongo.jobs.find_one({'_id': bson.ObjectId(ids[3])})['state'] == 'pending'
+
+def test_lease_fills_in_requests(mongo, gear, make_job):
+    job_id = queue_job(mongo, make_job)
+    assert 'request' not in mongo.jobs.find_one({'_id': bson.ObjectId(job_id)})
+
+    with patch('api.jobs.queue.get_gear_by_name', Mock(return_value=gear)):
+        leased = Queue.start_jobs(limit=1)
+
+    request = leased[0]['request']
+    assert request['outputs'][0]['uri'].endswith('&job=' + job_id)
+    assert mongo.jobs.find_one({'_id': bson.ObjectId(job_id)})['request'] == request
+
+def run_job(mongo, make_job, gear, **fields):
+    doc = make_job().insert_document(gear=gear)
+    doc.update(fields, state='running')
+    mongo.jobs.insert_one(doc)
+    return doc['_id']
+
+def job_state(mongo, job_id):
+    return mongo.jobs.find_one({'_id': job_id})['state']
+
+def respawned(mongo, job_id):
+    return mongo.jobs.find_one({'previous_job_id': str(job_id)}) is not None
+
+def test_heartbeat(mongo, gear, make_job):
+    running = run_job(mongo, make_job, gear, lease_expires=datetime.datetime(2016, 10, 1))
+
+    lease_expires = Queue.heartbeat(str(running))
+    assert lease_expires > datetime.datetime.utcnow()
+    # Stored to the millisecond
+    assert lease_expires - mongo.jobs.find_one({'_id': running})['lease_expires'] < datetime.timedelta(milliseconds=1)
+
+    mongo.jobs.update_one({'_id': running}, {'$set': {'state': 'complete'}})
+    assert Queue.heartbeat(str(running)) is None
+
+@patch('api.jobs.queue.max_attempts', Mock(return_value=3))
+def test_reap_expired_leases(mongo, gear, make_job):
+    now = datetime.datetime.utcnow()
+    expired = run_job(mongo, make_job, gear, lease_expires=now - datetime.timedelta(seconds=1))
+    leased = run_job(mongo, make_job, gear, lease_expires=now + datetime.timedelta(seconds=60))
+    # Jobs started before leases were recorded fall back to their modification time
+    stale = run_job(mongo, make_job, gear, modified=now - datetime.timedelta(seconds=101))
+    active = run_job(mongo, make_job, gear, modified=now - datetime.timedelta(seconds=10))
+
+    with patch('api.jobs.queue.get_gear_by_name', Mock(return_value=gear)):
+        assert Queue.scan_for_orphans() == 2
+
+    assert [job_state(mongo, job_id) for job_id in (expired, leased, stale, active)] == ['failed', 'running', 'failed', 'running']
+    assert [respawned(mongo, job_id) for job_id in (expired, leased, stale, active)] == [True, False, True, False]
+
+@patch('api.jobs.queue.max_attempts', Mock(return_value=3))
+def test_reap_skips_heartbeat_after_selection(mongo, gear, make_job):
+    expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    orphan = run_job(mongo, make_job, gear, lease_expires=expired)
+    alive = run_job(mongo, make_job, gear, lease_expires=expired)
+    update_many = mongo.jobs.update_many
+
+    def heartbeat_before_claim(query, update):
+        # The engine running alive sends a heartbeat between the reaper's selection and its claim
+        if update['$set'].get('state') == 'failed':
+            Queue.heartbeat(str(alive))
+        return update_many(query, update)
+
+    with patch.object(mongo.jobs, 'update_many', Mock(side_effect=heartbeat_before_claim)):
+        with patch('api.jobs.queue.get_gear_by_name', Mock(return_value=gear)):
+            assert Queue.scan_for_orphans() == 1
+
+    assert job_state(mongo, orphan) == 'failed' and respawned(mongo, orphan)
+    assert job_state(mongo, alive) == 'running' and not respawned(mongo, alive)
+
+@patch('api.jobs.queue.max_attempts', Mock(return_value=3))
+@patch('api.jobs.queue.REAP_BATCH_SIZE', 2)
+def test_reap_in_batches(mongo, gear, make_job):
+    expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    orphans = [run_job(mongo, make_job, gear, lease_expires=expired) for _ in range(5)]
+
+    with patch('api.jobs.queue.get_gear_by_name', Mock(return_value=gear)):
+        assert Queue.scan_for_orphans() == 5
+
+    assert all(job_state(mongo, job_id) == 'failed' and respawned(mongo, job_id) for job_id in orphans)
+    assert len(list(mongo.jobs.find({'state': 'pending', 'attempt': 2}))) == 5
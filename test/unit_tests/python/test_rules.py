@@ -1,5 +1,9 @@
 
 import pytest
+from mock import Mock, patch
+
+from api import util
+from api.dao import APINotFoundException
 from api.jobs import rules
 
 # Statefully holds onto some construction args and can return tuples to unroll for calling rules.eval_match.
@@ -188,3 +192,67 @@ def test_eval_rule_any_all():
     file_ = {'name': 'hello.txt', 'type': 'a'}
     result = rules.eval_rule(rule, file_, container)
     assert result == False
+
+def test_compiled_rule_matches_eval_rule():
+    container = {'_id': 'c', 'files': [{'name': 'a.bvec', 'type': 'bvec'}, {'name': 'untyped'}]}
+    types = rules.file_types(container)
+    assert types == {'bvec': 'a.bvec'}
+
+    rule_list = [
+        {'any': [['file.type', 'dicom'], ['file.name', '*.dcm']], 'all': [], 'alg': 'a'},
+        {'any': [], 'all': [['file.name', '[!x]*.nii.gz'], ['container.has-type', 'bvec']], 'alg': 'b'},
+        {'any': [['file.measurements', 'diffusion']], 'all': [['container.has-type', 'bval']], 'alg': 'c'},
+        {'any': [], 'all': [], 'alg': 'd'},
+    ]
+    files = [
+        {'name': 'hello.dcm', 'type': 'a'},
+        {'name': 'hello.txt', 'type': 'dicom'},
+        {'name': 'brain.nii.gz', 'type': 'nifti', 'measurements': ['diffusion']},
+        {'name': 'xbrain.nii.gz'},
+    ]
+
+    for rule in rule_list:
+        matches = rules.compile_rule(rule)
+        for file_ in files:
+            assert matches(file_, container, types) == rules.eval_rule(rule, file_, container)
+
+def test_compiled_rules_recompile_on_change():
+    rule_list = [{'any': [['file.type', 'dicom']], 'alg': 'a'}]
+    compiled = rules.compiled_rules('project', rule_list)
+    assert rules.compiled_rules('project', [dict(r) for r in rule_list]) is compiled
+
+    rule_list = [{'any': [['file.type', 'nifti']], 'alg': 'a'}]
+    assert rules.compiled_rules('project', rule_list) is not compiled
+
+def test_compiled_rules_bounded(monkeypatch):
+    monkeypatch.setattr(rules, '_compiled_rules', util.LRUCache(2))
+    rule_list = [{'any': [['file.type', 'dicom']], 'alg': 'a'}]
+
+    compiled = rules.compiled_rules('first', rule_list)
+    rules.compiled_rules('second', rule_list)
+    rules.compiled_rules('third', rule_list)
+    assert len(rules._compiled_rules) == 2
+
+    # The least recently used project was evicted, and is compiled anew
+    assert rules.compiled_rules('first', rule_list) is not compiled
+
+def get_gear(name):
+    if name == 'removed':
+        raise APINotFoundException('Unknown gear ' + name)
+    return {'gear': {'inputs': {'file': {}}}}
+
+@patch('api.jobs.rules.get_base_rules', Mock(return_value=[]))
+@patch('api.jobs.rules.gears.get_gear_by_name', Mock(side_effect=get_gear))
+@patch('api.jobs.rules.Queue.enqueue')
+def test_create_jobs_skips_removed_gears(enqueue):
+    project = {'_id': 'p', 'rules': [
+        {'all': [['file.type', 'dicom']], 'alg': 'removed'},
+        {'all': [['file.type', 'dicom']], 'alg': 'installed'},
+    ]}
+    file_ = {'name': 'one.dcm', 'type': 'dicom'}
+    project['files'] = [file_]
+
+    queued = rules.create_jobs_for_files(Mock(), [rules.rule_target(project, 'project', file_)])
+    assert queued == ['installed']
+    jobs = enqueue.call_args[0][0]
+    assert [job.name for job in jobs] == ['installed']
@@ -0,0 +1,18 @@
+from api import util
+
+
+def test_lru_cache():
+    cache = util.LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+
+    # 'b' is now the least recently used
+    cache['c'] = 3
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+    assert cache.pop('a') == 1
+    assert cache.get('a', 'missing') == 'missing'
@@ -3,7 +3,7 @@ import logging
 import jsonschema.exceptions
 import pytest
 
-from api import validators
+from api import config, validators
 
 log = logging.getLogger(__name__)
 sh = logging.StreamHandler()
@@ -29,3 +29,21 @@ def test_payload():
     schema, resolver = validators._resolve_schema(schema_uri)
     with pytest.raises(jsonschema.exceptions.ValidationError):
         validators._validate_json(payload, schema, resolver)
+
+def test_put_does_not_require():
+    schema_uri = validators.schema_uri("input", "project.json")
+    validate = validators.from_schema_path(schema_uri)
+    with pytest.raises(validators.InputValidationException):
+        validate({'label': 'SciTran/Testing'}, 'POST')
+    validate({'label': 'SciTran/Testing'}, 'PUT')
+    with pytest.raises(validators.InputValidationException):
+        validate({'extra_params': 'testtest'}, 'PUT')
+
+    # Validators are compiled once per schema and method
+    assert validators._get_validator(schema_uri, 'PUT') is validators._get_validator(schema_uri, 'PUT')
+    assert validators._get_validator(schema_uri, 'PUT') is not validators._get_validator(schema_uri, 'POST')
+
+def test_schema_lists():
+    config.check_schemas()
+    validators.load_schemas()
+    assert validators._load_schema(validators.schema_uri("input", "project.json"))['title'] == 'Project'